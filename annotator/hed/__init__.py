@@ -6,12 +6,10 @@
 # and in this way it works better for gradio's RGB protocol
 
 import os
-import cv2
 import torch
-import numpy as np
 
-from einops import rearrange
-from annotator.util import annotator_ckpts_path, safe_step
+import torch.nn.functional as F
+from annotator.util import annotator_ckpts_path, safe_step_tensor, TensorDetector
 
 
 class DoubleConvBlock(torch.nn.Module):
@@ -53,7 +51,9 @@ class ControlNetHED_Apache2(torch.nn.Module):
         return projection1, projection2, projection3, projection4, projection5
 
 
-class HEDdetector:
+class HEDdetector(TensorDetector):
+    networks = ('netNetwork', )
+
     def __init__(self):
         remote_model_path = "https://huggingface.co/lllyasviel/Annotators/resolve/main/ControlNetHED.pth"
         modelpath = os.path.join(annotator_ckpts_path, "ControlNetHED.pth")
@@ -63,18 +63,11 @@ class HEDdetector:
         self.netNetwork = ControlNetHED_Apache2().float().cuda().eval()
         self.netNetwork.load_state_dict(torch.load(modelpath))
 
-    def __call__(self, input_image, safe=False):
-        assert input_image.ndim == 3
-        H, W, C = input_image.shape
-        with torch.no_grad():
-            image_hed = torch.from_numpy(input_image.copy()).float().cuda()
-            image_hed = rearrange(image_hed, 'h w c -> 1 c h w')
-            edges = self.netNetwork(image_hed)
-            edges = [e.detach().cpu().numpy().astype(np.float32)[0, 0] for e in edges]
-            edges = [cv2.resize(e, (W, H), interpolation=cv2.INTER_LINEAR) for e in edges]
-            edges = np.stack(edges, axis=2)
-            edge = 1 / (1 + np.exp(-np.mean(edges, axis=2).astype(np.float64)))
-            if safe:
-                edge = safe_step(edge)
-            edge = (edge * 255.0).clip(0, 255).astype(np.uint8)
-            return edge
+    def forward(self, x, safe=False):
+        H, W = x.shape[2:]
+        edges = self.netNetwork(x * 255.0)
+        edges = [F.interpolate(e.float(), size=(H, W), mode='bilinear', align_corners=False) for e in edges]
+        edge = torch.sigmoid(torch.cat(edges, dim=1).mean(dim=1, keepdim=True))
+        if safe:
+            edge = safe_step_tensor(edge)
+        return edge
@@ -2,13 +2,10 @@
 # MIT License
 
 import os
-import cv2
 import torch
-import numpy as np
 
 import torch.nn as nn
-from einops import rearrange
-from annotator.util import annotator_ckpts_path
+from annotator.util import annotator_ckpts_path, TensorDetector
 
 
 norm_layer = nn.InstanceNorm2d
@@ -91,7 +88,9 @@ class Generator(nn.Module):
         return out
 
 
-class LineartDetector:
+class LineartDetector(TensorDetector):
+    networks = ('model', 'model_coarse')
+
     def __init__(self):
         self.model = self.load_model('sk_model.pth')
         self.model_coarse = self.load_model('sk_model2.pth')
@@ -108,17 +107,6 @@ class LineartDetector:
         model = model.cuda()
         return model
 
-    def __call__(self, input_image, coarse):
+    def forward(self, x, coarse=False):
         model = self.model_coarse if coarse else self.model
-        assert input_image.ndim == 3
-        image = input_image
-        with torch.no_grad():
-            image = torch.from_numpy(image).float().cuda()
-            image = image / 255.0
-            image = rearrange(image, 'h w c -> 1 c h w')
-            line = model(image)[0][0]
-
-            line = line.cpu().numpy()
-            line = (line * 255.0).clip(0, 255).astype(np.uint8)
-
-            return line
+        return model(x).float()
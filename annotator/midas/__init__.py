@@ -12,41 +12,33 @@
 # From https://github.com/isl-org/MiDaS
 # MIT LICENSE
 
-import cv2
 import numpy as np
 import torch
+import torch.nn.functional as F
 
-from einops import rearrange
 from .api import MiDaSInference
+from annotator.util import TensorDetector
 
 
-class MidasDetector:
+class MidasDetector(TensorDetector):
+    """Returns the depth [B, 1, H, W] and the normal [B, 3, H, W] estimated from it."""
+    networks = ('model', )
+
     def __init__(self):
         self.model = MiDaSInference(model_type="dpt_large").cuda()
 
-    def __call__(self, input_image, a=np.pi * 0.2, bg_th=0.02):
-        assert input_image.ndim == 3
-        image_depth = input_image
-        with torch.no_grad():
-            image_depth = torch.from_numpy(image_depth).float().cuda()
-            image_depth = image_depth / 127.5 - 1.0
-            image_depth = rearrange(image_depth, 'h w c -> 1 c h w')
-            depth = self.model(image_depth)[0]
-
-            depth_pt = depth.clone()
-            depth_pt -= torch.min(depth_pt)
-            depth_pt /= torch.max(depth_pt)
-            depth_pt = depth_pt.cpu().numpy()
-            depth_image = (depth_pt * 255.0).clip(0, 255).astype(np.uint8)
-
-            depth_np = depth.cpu().numpy()
-            x = cv2.Sobel(depth_np, cv2.CV_32F, 1, 0, ksize=3)
-            y = cv2.Sobel(depth_np, cv2.CV_32F, 0, 1, ksize=3)
-            z = np.ones_like(x) * a
-            x[depth_pt < bg_th] = 0
-            y[depth_pt < bg_th] = 0
-            normal = np.stack([x, y, z], axis=2)
-            normal /= np.sum(normal ** 2.0, axis=2, keepdims=True) ** 0.5
-            normal_image = (normal * 127.5 + 127.5).clip(0, 255).astype(np.uint8)
-
-            return depth_image, normal_image
+    def forward(self, x, a=np.pi * 0.2, bg_th=0.02):
+        depth = self.model(x * 2.0 - 1.0).float()[:, None]
+
+        depth_min = depth.amin(dim=(2, 3), keepdim=True)
+        depth_pt = depth - depth_min
+        depth_pt = depth_pt / depth_pt.amax(dim=(2, 3), keepdim=True)
+
+        # Sobel filters of size 3, with the reflect-101 border of cv2.Sobel
+        kx = torch.tensor([[-1., 0., 1.], [-2., 0., 2.], [-1., 0., 1.]], device=depth.device)
+        kernels = torch.stack([kx, kx.t()])[:, None]
+        grad = F.conv2d(F.pad(depth, (1, 1, 1, 1), mode='reflect'), kernels)
+        grad = grad.masked_fill(depth_pt < bg_th, 0)
+        normal = torch.cat([grad, torch.full_like(depth, a)], dim=1)
+        normal = normal / (normal ** 2.0).sum(dim=1, keepdim=True) ** 0.5
+        return depth_pt, (normal * 0.5 + 0.5).clip(0, 1)
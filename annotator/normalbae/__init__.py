@@ -4,16 +4,16 @@
 import os
 import types
 import torch
-import numpy as np
 
-from einops import rearrange
 from .models.NNET import NNET
 from .utils import utils
-from annotator.util import annotator_ckpts_path
+from annotator.util import annotator_ckpts_path, TensorDetector
 import torchvision.transforms as transforms
 
 
-class NormalBaeDetector:
+class NormalBaeDetector(TensorDetector):
+    networks = ('model', )
+
     def __init__(self):
         remote_model_path = "https://huggingface.co/lllyasviel/Annotators/resolve/main/scannet.pt"
         modelpath = os.path.join(annotator_ckpts_path, "scannet.pt")
@@ -33,23 +33,10 @@ class NormalBaeDetector:
         self.model = model
         self.norm = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
 
-    def __call__(self, input_image):
-        assert input_image.ndim == 3
-        image_normal = input_image
-        with torch.no_grad():
-            image_normal = torch.from_numpy(image_normal).float().cuda()
-            image_normal = image_normal / 255.0
-            image_normal = rearrange(image_normal, 'h w c -> 1 c h w')
-            image_normal = self.norm(image_normal)
-
-            normal = self.model(image_normal)
-            normal = normal[0][-1][:, :3]
-            # d = torch.sum(normal ** 2.0, dim=1, keepdim=True) ** 0.5
-            # d = torch.maximum(d, torch.ones_like(d) * 1e-5)
-            # normal /= d
-            normal = ((normal + 1) * 0.5).clip(0, 1)
-
-            normal = rearrange(normal[0], 'c h w -> h w c').cpu().numpy()
-            normal_image = (normal * 255.0).clip(0, 255).astype(np.uint8)
-
-            return normal_image
+    def forward(self, x):
+        normal = self.model(self.norm(x))
+        normal = normal[0][-1][:, :3].float()
+        # d = torch.sum(normal ** 2.0, dim=1, keepdim=True) ** 0.5
+        # d = torch.maximum(d, torch.ones_like(d) * 1e-5)
+        # normal /= d
+        return ((normal + 1) * 0.5).clip(0, 1)
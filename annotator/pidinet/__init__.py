@@ -3,13 +3,13 @@
 
 import os
 import torch
-import numpy as np
-from einops import rearrange
 from annotator.pidinet.model import pidinet
-from annotator.util import annotator_ckpts_path, safe_step
+from annotator.util import annotator_ckpts_path, safe_step_tensor, TensorDetector
 
 
-class PidiNetDetector:
+class PidiNetDetector(TensorDetector):
+    networks = ('netNetwork', )
+
     def __init__(self):
         remote_model_path = "https://huggingface.co/lllyasviel/Annotators/resolve/main/table5_pidinet.pth"
         modelpath = os.path.join(annotator_ckpts_path, "table5_pidinet.pth")
@@ -21,16 +21,8 @@ class PidiNetDetector:
         self.netNetwork = self.netNetwork.cuda()
         self.netNetwork.eval()
 
-    def __call__(self, input_image, safe=False):
-        assert input_image.ndim == 3
-        input_image = input_image[:, :, ::-1].copy()
-        with torch.no_grad():
-            image_pidi = torch.from_numpy(input_image).float().cuda()
-            image_pidi = image_pidi / 255.0
-            image_pidi = rearrange(image_pidi, 'h w c -> 1 c h w')
-            edge = self.netNetwork(image_pidi)[-1]
-            edge = edge.cpu().numpy()
-            if safe:
-                edge = safe_step(edge)
-            edge = (edge * 255.0).clip(0, 255).astype(np.uint8)
-            return edge[0][0]
+    def forward(self, x, safe=False):
+        edge = self.netNetwork(x.flip(1))[-1].float()  # BGR input
+        if safe:
+            edge = safe_step_tensor(edge)
+        return edge
@@ -3,6 +3,7 @@ import random
 import numpy as np
 import cv2
 import os
+import torch
 
 
 annotator_ckpts_path = os.path.join(os.path.dirname(__file__), 'ckpts')
@@ -96,3 +97,81 @@ def img2mask(img, H, W, low=10, high=90):
         y = 255 - y
 
     return y < np.percentile(y, random.randrange(low, high))
+
+
+class TensorDetector:
+    """
+    Common interface of the neural detectors, which can be called with
+
+    - a float tensor [B, 3, H, W] of RGB images in [0, 1], on any device: the images are processed as one batch
+      and the result is returned as float tensor(s) [B, C, H, W] in [0, 1] on the device of the detector, without
+      any round-trip through numpy;
+    - a HWC uint8 numpy image, as before: a thin wrapper converting it to a batch of one and back to uint8.
+
+    Subclasses implement `forward(x, **kwargs)` on the batch (already on the device, in the detector dtype) and
+    list their networks in `networks`. `half()` runs them in float16.
+    """
+    networks = ()
+
+    @property
+    def device(self):
+        return next(getattr(self, self.networks[0]).parameters()).device
+
+    @property
+    def dtype(self):
+        return getattr(self, '_dtype', torch.float32)
+
+    def half(self):
+        for name in self.networks:
+            setattr(self, name, getattr(self, name).half())
+        self._dtype = torch.float16
+        return self
+
+    def forward(self, x, **kwargs):
+        raise NotImplementedError
+
+    def __call__(self, x, **kwargs):
+        if isinstance(x, torch.Tensor):
+            with torch.no_grad():
+                return self.forward(x.to(self.device, self.dtype), **kwargs)
+        assert x.ndim == 3
+        with torch.no_grad():
+            out = self.forward(image_to_tensor(x, self.device, self.dtype), **kwargs)
+        if isinstance(out, tuple):
+            return tuple(tensor_to_image(o)[0] for o in out)
+        return tensor_to_image(out)[0]
+
+    def detect_batch(self, images, **kwargs):
+        """Numpy images in, numpy images out, calling `forward` once per group of images of the same size."""
+        outputs = [None] * len(images)
+        groups = dict()
+        for i, image in enumerate(images):
+            groups.setdefault(image.shape, []).append(i)
+        for indices in groups.values():
+            x = torch.stack([image_to_tensor(images[i], self.device, self.dtype)[0] for i in indices])
+            with torch.no_grad():
+                out = self.forward(x, **kwargs)
+            if isinstance(out, tuple):
+                out = list(zip(*[tensor_to_image(o) for o in out]))
+            else:
+                out = tensor_to_image(out)
+            for i, o in zip(indices, out):
+                outputs[i] = o
+        return outputs
+
+
+def image_to_tensor(image, device, dtype=torch.float32):
+    """HWC uint8 numpy image -> [1, 3, H, W] tensor in [0, 1]."""
+    x = torch.from_numpy(np.ascontiguousarray(image)).to(device)
+    return x.permute(2, 0, 1)[None].to(dtype) / 255.0
+
+
+def tensor_to_image(x):
+    """[B, C, H, W] tensor in [0, 1] -> B uint8 numpy images, HW if C == 1 else HWC."""
+    x = (x.float() * 255.0).clamp(0, 255).to(torch.uint8).cpu().numpy()
+    return x[:, 0] if x.shape[1] == 1 else x.transpose(0, 2, 3, 1)
+
+
+def safe_step_tensor(x, step=2):
+    """`safe_step` for tensors."""
+    return torch.floor(x * float(step + 1)) / float(step)
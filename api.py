@@ -1,6 +1,7 @@
 from share import *
 
 import os
+import cv2
 import einops
 import numpy as np
 from PIL import Image
@@ -10,12 +11,21 @@ import torch
 from cldm.model import create_model, load_state_dict
 from cldm.ddim_hacked import DDIMSampler
 from annotator.util import HWC3
+from ldm.modules.diffusionmodules.util import make_generators
+from utils.result_cache import ResultCache, array_hash, files_fingerprint
 
 
 class CtrLoRA:
-    def __init__(self, num_loras=1):
+    def __init__(self, num_loras=1, cache_dir=None, cache_max_gb=10):
+        """
+        With `cache_dir`, the samples drawn with a seed are stored there, addressed by the hash of the condition
+        images, prompts, sampler params, seed and loaded weights, and returned from the cache without running the
+        model when requested again. At most `cache_max_gb` GB are kept, the least recently used being evicted.
+        """
         self.model = None
         self.num_loras = num_loras
+        self.fingerprint = None
+        self.cache = ResultCache(cache_dir, max_bytes=int(cache_max_gb * 2 ** 30)) if cache_dir is not None else None
 
         if num_loras == 1:
             self.config_file = 'configs/inference/ctrlora_sd15_rank128_1lora.yaml'
@@ -60,8 +70,14 @@ class CtrLoRA:
             self.model.load_state_dict(lora_state_dict, strict=False)
             self.model.control_model.copy_weights_to_switchable()
             del lora_state_dict
+        self.fingerprint = files_fingerprint(self.config_file, sd_file, basecn_file, *lora_files)
 
-    def sample(self, cond_image_paths, prompt, n_prompt='', num_samples=1, ddim_steps=20, scale=7.5, lora_weights=(1.0, 1.0)):
+    def sample(self, cond_image_paths, prompt, n_prompt='', num_samples=1, ddim_steps=20, scale=7.5, lora_weights=(1.0, 1.0),
+               seed=None, eta=0.0):
+        """
+        Sample i is drawn from seed + i if `seed` is given (see `generators` of DDIMSampler.sample), so that it only
+        depends on the inputs and can be cached; otherwise from the global random state, and never cached.
+        """
         assert self.model is not None, 'Model is not loaded. Please call create_model() first.'
         if not isinstance(cond_image_paths, (tuple, list)):
             cond_image_paths = (cond_image_paths, )
@@ -72,15 +88,35 @@ class CtrLoRA:
             detected_image = np.array(Image.open(cond_image_path))
             detected_image = HWC3(detected_image)
             detected_images.append(detected_image)
-        # sample
+        seeds = [seed + i for i in range(num_samples)] if seed is not None else None
+        if self.cache is None or seeds is None:
+            return self._sample(detected_images, prompt, n_prompt, num_samples, ddim_steps, scale, lora_weights, seeds, eta)
+        # look up the cache, then only sample the missing seeds
+        keys = [self.cache.key(
+            cond=[array_hash(im) for im in detected_images], prompt=prompt, n_prompt=n_prompt, ddim_steps=ddim_steps,
+            scale=scale, eta=eta, lora_weights=list(lora_weights) if self.num_loras > 1 else None, seed=s,
+            model=self.fingerprint,
+        ) for s in seeds]
+        results = [self.cache.get(key) for key in keys]
+        missing = [i for i, image in enumerate(results) if image is None]
+        if missing:
+            samples = self._sample(detected_images, prompt, n_prompt, len(missing), ddim_steps, scale, lora_weights,
+                                   [seeds[i] for i in missing], eta)
+            for i, sample in zip(missing, samples):
+                results[i] = np.array(sample)
+                self.cache.put(keys[i], results[i])
+        return [Image.fromarray(image) for image in results]
+
+    def _sample(self, detected_images, prompt, n_prompt, num_samples, ddim_steps, scale, lora_weights, seeds, eta):
         if self.num_loras == 1:
-            return self.sample_1lora(detected_images[0], prompt, n_prompt, num_samples, ddim_steps, scale)
+            return self.sample_1lora(detected_images[0], prompt, n_prompt, num_samples, ddim_steps, scale, seeds, eta)
         elif self.num_loras == 2:
-            return self.sample_2loras(detected_images, prompt, n_prompt, num_samples, ddim_steps, scale, lora_weights)
+            return self.sample_2loras(detected_images, prompt, n_prompt, num_samples, ddim_steps, scale, lora_weights,
+                                      seeds, eta)
         else:
             raise ValueError('Invalid number of LoRAs. Only 1 or 2 are supported.')
 
-    def sample_1lora(self, detected_image, prompt, n_prompt='', num_samples=1, ddim_steps=20, scale=7.5):
+    def sample_1lora(self, detected_image, prompt, n_prompt='', num_samples=1, ddim_steps=20, scale=7.5, seeds=None, eta=0.0):
         H, W, C = detected_image.shape
         ddim_sampler = DDIMSampler(self.model)
         with torch.no_grad():
@@ -96,7 +132,7 @@ class CtrLoRA:
             shape = (4, H // 8, W // 8)
             samples, intermediates = ddim_sampler.sample(
                 ddim_steps, num_samples,
-                shape, cond, verbose=False, eta=0,
+                shape, cond, verbose=False, eta=eta, generators=seeds,
                 unconditional_guidance_scale=scale,
                 unconditional_conditioning=un_cond,
             )
@@ -106,7 +142,8 @@ class CtrLoRA:
             results = [Image.fromarray(x_samples[i]) for i in range(num_samples)]
         return results
 
-    def sample_2loras(self, detected_images, prompt, n_prompt='', num_samples=1, ddim_steps=20, scale=7.5, lora_weights=(1.0, 1.0)):
+    def sample_2loras(self, detected_images, prompt, n_prompt='', num_samples=1, ddim_steps=20, scale=7.5, lora_weights=(1.0, 1.0),
+                      seeds=None, eta=0.0):
         detected_image, detected_image2 = detected_images
         # center crop to smaller image
         H, W, C = detected_image.shape
@@ -144,7 +181,7 @@ class CtrLoRA:
             shape = (4, H // 8, W // 8)
             samples, intermediates = ddim_sampler.sample(
                 ddim_steps, num_samples,
-                shape, [cond, cond2], verbose=False, eta=0,
+                shape, [cond, cond2], verbose=False, eta=eta, generators=seeds,
                 unconditional_guidance_scale=scale,
                 unconditional_conditioning=[un_cond, un_cond2],
             )
@@ -153,3 +190,96 @@ class CtrLoRA:
             x_samples = (einops.rearrange(x_samples, 'b c h w -> b h w c') * 127.5 + 127.5).cpu().numpy().clip(0, 255).astype(np.uint8)
             results = [Image.fromarray(x_samples[i]) for i in range(num_samples)]
         return results
+
+    @staticmethod
+    def _read_image(image):
+        if isinstance(image, str):
+            image = Image.open(image)
+        return HWC3(np.array(image.convert('RGB') if isinstance(image, Image.Image) else image))
+
+    def refine(self, init_images, cond_images, prompts, n_prompt='', strength=0.5, ddim_steps=20, scale=7.5,
+               lora_weights=(1.0, 1.0), seed=None, eta=0.0, batch_size=8):
+        """
+        SDEdit / img2img: re-generate existing images (e.g., re-stain or refine patches) with a new prompt and
+        condition, keeping their content to an extent set by `strength`. The latents of the inputs are noised to
+        step strength * ddim_steps of the DDIM schedule, and only the remaining steps are run, so that refining is
+        about 1 / strength times faster than sampling from noise. The inputs are batched by size.
+
+        init_images: list of images (paths, PIL images or h x w x 3 uint8 arrays), or of latents (4 x h/8 x w/8
+            arrays or tensors, unscaled as stored by scripts/generate_latents.py)
+        cond_images: list of condition images (paths, PIL images or arrays), one per input (a tuple of 2 with
+            2 LoRAs), resized to the size of their input if needed
+        prompts: a prompt, or a list of prompts, one per input
+        Input i is noised from seed + i if `seed` is given, else from the global random state.
+        Returns the list of the refined PIL images.
+        """
+        assert self.model is not None, 'Model is not loaded. Please call create_model() first.'
+        assert 0 < strength <= 1, f'Expected 0 < strength <= 1, got {strength}'
+        n = len(init_images)
+        prompts = [prompts] * n if isinstance(prompts, str) else list(prompts)
+        assert len(cond_images) == n and len(prompts) == n, 'Expected one condition image and prompt per input'
+        model = self.model
+
+        # read the inputs and group them by size
+        inits, conds, groups = [], [], dict()
+        for i in range(n):
+            init = init_images[i]
+            if isinstance(init, (np.ndarray, torch.Tensor)) and init.ndim == 3 and init.shape[0] == model.channels:
+                init = torch.as_tensor(np.asarray(init, dtype=np.float32) if isinstance(init, np.ndarray) else init)
+                H, W = init.shape[1] * 8, init.shape[2] * 8
+            else:
+                init = self._read_image(init)
+                H, W = init.shape[:2]
+                assert H % 8 == 0 and W % 8 == 0, f'The size of the images must be a multiple of 8, got {H}x{W}'
+            cond = cond_images[i] if isinstance(cond_images[i], (tuple, list)) else (cond_images[i], )
+            assert len(cond) == self.num_loras, f'Expected {self.num_loras} condition images, got {len(cond)}'
+            cond = [self._read_image(c) for c in cond]
+            cond = [c if c.shape[:2] == (H, W) else cv2.resize(c, (W, H), interpolation=cv2.INTER_LINEAR) for c in cond]
+            inits.append(init)
+            conds.append(cond)
+            groups.setdefault((H, W), []).append(i)
+
+        ddim_sampler = DDIMSampler(model)
+        ddim_sampler.make_schedule(ddim_num_steps=ddim_steps, ddim_eta=eta, verbose=False)
+        t_enc = max(int(round(strength * ddim_steps)), 1)
+        model.control_scales = [1] * 13
+        if self.num_loras == 2:
+            model.lora_weights = [lora_weights[0], lora_weights[1]]
+
+        results = [None] * n
+        with torch.no_grad():
+            for indices in groups.values():
+                for start in range(0, len(indices), batch_size):
+                    batch = indices[start:start + batch_size]
+                    b = len(batch)
+                    if isinstance(inits[batch[0]], torch.Tensor):
+                        z = torch.stack([inits[i] for i in batch]).cuda() * model.scale_factor
+                    else:
+                        x = torch.from_numpy(np.stack([inits[i] for i in batch])).cuda().float() / 127.5 - 1.0
+                        x = einops.rearrange(x, 'b h w c -> b c h w')
+                        z = model.encode_first_stage(x).mode() * model.scale_factor
+
+                    c = model.get_learned_conditioning([prompts[i] for i in batch])
+                    uc = model.get_learned_conditioning([n_prompt] * b)
+                    cond, un_cond = [], []
+                    for k in range(self.num_loras):
+                        control = torch.from_numpy(np.stack([conds[i][k] for i in batch])).float().cuda() / 255.0
+                        control = einops.rearrange(control, 'b h w c -> b c h w').clone()
+                        cond.append({"c_concat": [control], "c_crossattn": [c]})
+                        un_cond.append({"c_concat": [control], "c_crossattn": [uc]})
+                    if self.num_loras == 1:
+                        cond, un_cond = cond[0], un_cond[0]
+
+                    # the same generators draw the encoding noise, then the step noise if eta > 0
+                    generators = make_generators([seed + i for i in batch]) if seed is not None else None
+                    # noised to the level of the first step that is run, timesteps[t_enc - 1]
+                    t = torch.full((b, ), t_enc - 1, device=z.device, dtype=torch.long)
+                    z = ddim_sampler.stochastic_encode(z, t, generators=generators)
+                    samples = ddim_sampler.decode(z, cond, t_enc, unconditional_guidance_scale=scale,
+                                                  unconditional_conditioning=un_cond, generators=generators)
+
+                    x_samples = model.decode_first_stage(samples)
+                    x_samples = (einops.rearrange(x_samples, 'b c h w -> b h w c') * 127.5 + 127.5).cpu().numpy().clip(0, 255).astype(np.uint8)
+                    for i, x_sample in zip(batch, x_samples):
+                        results[i] = Image.fromarray(x_sample)
+        return results
@@ -19,15 +19,19 @@ from pytorch_lightning import seed_everything
 from annotator.util import resize_image, HWC3
 from cldm.model import create_model, load_state_dict
 from cldm.ddim_hacked import DDIMSampler
+from cldm.preview import LatentPreviewer, iterate_with_previews
 
 
 CKPT_DIR = './ckpts'
 CKPT_SD15_DIR = os.path.join(CKPT_DIR, 'sd15')
 CKPT_CN_DIR = os.path.join(CKPT_DIR, 'controlnet')
 CONFIG_DIR = './configs'
+# made by scripts/tool_fit_preview_decoder.py, the default linear projection is used if missing
+PREVIEW_CKPT = os.path.join(CKPT_DIR, 'preview', 'sd15_preview.pt')
 
 model: Any = None
 ddim_sampler: Any = None
+previewer: Any = None
 preprocessor: Any = None
 last_config = None
 last_ckpts = (None, None)
@@ -83,7 +87,7 @@ def get_config(cn_ckpt):
 
 
 def build_model(sd_ckpt, cn_ckpt):
-    global model, ddim_sampler, last_ckpts, last_config
+    global model, ddim_sampler, previewer, last_ckpts, last_config
     assert sd_ckpt is not None
     assert cn_ckpt is not None
 
@@ -94,6 +98,7 @@ def build_model(sd_ckpt, cn_ckpt):
         last_config = current_config
         model = create_model(current_config).cuda()
         ddim_sampler = DDIMSampler(model)
+        previewer = LatentPreviewer(PREVIEW_CKPT if os.path.isfile(PREVIEW_CKPT) else None).cuda()
         print(f'Config loaded')
 
     if last_ckpts != (sd_ckpt, cn_ckpt):
@@ -284,11 +289,20 @@ def process(det, detected_image, prompt, n_prompt, num_samples, ddim_steps, gues
         # Magic number. IDK why. Perhaps because 0.825**12<0.01 but 0.826**12>0.01
 
         shape = (4, H // 8, W // 8)
-        samples, intermediates = ddim_sampler.sample(ddim_steps, num_samples,
+
+    # stream cheap previews of pred_x0 at every step, the sampler runs in a thread meanwhile
+    for kind, value, _ in iterate_with_previews(
+            lambda img_callback: ddim_sampler.sample(ddim_steps, num_samples,
                                                      shape, cond, verbose=False, eta=eta,
                                                      unconditional_guidance_scale=scale,
-                                                     unconditional_conditioning=un_cond)
+                                                     unconditional_conditioning=un_cond,
+                                                     img_callback=img_callback),
+            previewer, size=(H, W)):
+        if kind == 'preview':
+            yield [detected_image] + list(value)
+    samples, intermediates = value
 
+    with torch.no_grad():
         if config.save_memory:
             model.low_vram_shift(is_diffusing=False)
 
@@ -296,7 +310,7 @@ def process(det, detected_image, prompt, n_prompt, num_samples, ddim_steps, gues
         x_samples = (einops.rearrange(x_samples, 'b c h w -> b h w c') * 127.5 + 127.5).cpu().numpy().clip(0, 255).astype(np.uint8)
 
         results = [x_samples[i] for i in range(num_samples)]
-    return [detected_image] + results
+    yield [detected_image] + results
 
 
 def listdir_r(path):
@@ -0,0 +1,321 @@
+"""
+Asynchronous HTTP inference server for CtrLoRA, batching the concurrent requests dynamically.
+
+Requirements: fastapi, uvicorn (installed with gradio)
+
+POST /generate with a JSON body:
+    cond_images: list of base64-encoded condition images (PNG / JPEG bytes), one per LoRA
+    prompt, n_prompt: str
+    num_samples: int, ddim_steps: int, scale: float, seed: int (random if omitted)
+    resolution: int, resize the condition images as the gradio app does (their size must be a multiple of 8 if omitted)
+    lora_weights: list of float, one per LoRA
+    preview: bool, stream previews of the samples during sampling, every preview_every: int steps
+returns a stream of JSON lines (application/x-ndjson):
+    {"event": "queued", "position": ...}
+    {"event": "started", "batch_size": ..., "queue_time": ...}
+    {"event": "preview", "step": ..., "index": ..., "png": base64-encoded PNG}   (if preview, see cldm/preview.py)
+    {"event": "image", "index": ..., "png": base64-encoded PNG}     (one per sample)
+    {"event": "done", "seed": ..., "latency": ...}  or  {"event": "error", "detail": ...}
+GET /stats returns the numbers of requests, batches and images served so far.
+
+Requests are queued and run by a single GPU worker thread. The worker takes the oldest request and batches it with
+the queued requests sharing its (height, width, steps, scale, LoRA weights), waiting up to `--max_wait_ms` after the
+arrival of the oldest request for more of them, and up to `--max_batch_size` samples per batch. Sample i of a request
+draws its noise from seed + i only (see `generators` of DDIMSampler.sample), so that a request gets the same noise
+whatever it is batched with.
+"""
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from share import *
+
+import json
+import time
+import base64
+import random
+import asyncio
+import argparse
+import threading
+from typing import List, Optional
+
+import cv2
+import einops
+import numpy as np
+import torch
+import uvicorn
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+from annotator.util import HWC3, resize_image
+from cldm.model import create_model
+from cldm.ddim_hacked import DDIMSampler
+from cldm.preview import LatentPreviewer
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default='127.0.0.1', help='host to listen on')
+    parser.add_argument("--port", type=int, default=8000, help='port to listen on')
+    parser.add_argument("--sd_file", type=str, default='ckpts/sd15/v1-5-pruned.ckpt', help='path to the SD1.5 checkpoint')
+    parser.add_argument("--basecn_file", type=str, default='ckpts/ctrlora-basecn/ctrlora_sd15_basecn700k.ckpt',
+                        help='path to the base ControlNet checkpoint')
+    parser.add_argument("--lora_files", type=str, nargs='+',
+                        default=['ckpts/ctrlora-loras/novel-conditions/ctrlora_sd15_basecn700k_lineart_rank128_1kimgs_1ksteps.ckpt'],
+                        help='paths to the LoRA checkpoints, 1 or 2')
+    parser.add_argument("--tiny", action='store_true', default=False,
+                        help='serve a tiny randomly initialized model (configs/inference/ctrlora_tiny_1lora.yaml), '
+                             'to test and benchmark the server on CPU')
+    parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help='device')
+    parser.add_argument("--preview_ckpt", type=str, default=None,
+                        help='previewer made by scripts/tool_fit_preview_decoder.py, default: a linear projection')
+    parser.add_argument("--max_batch_size", type=int, default=8, help='maximum number of samples per batch')
+    parser.add_argument("--max_wait_ms", type=float, default=50,
+                        help='maximum time to wait for compatible requests after the oldest one, in milliseconds')
+    return parser
+
+
+class GenerateRequest(BaseModel):
+    cond_images: List[str]
+    prompt: str = ''
+    n_prompt: str = 'worst quality'
+    num_samples: int = 1
+    ddim_steps: int = 20
+    scale: float = 7.5
+    seed: Optional[int] = None
+    resolution: Optional[int] = None
+    lora_weights: Optional[List[float]] = None
+    preview: bool = False
+    preview_every: int = 1
+
+
+class Job:
+    def __init__(self, request: GenerateRequest, cond_images: List[np.ndarray], loop: asyncio.AbstractEventLoop):
+        self.prompt = request.prompt
+        self.n_prompt = request.n_prompt
+        self.num_samples = request.num_samples
+        self.preview = request.preview
+        self.preview_every = max(request.preview_every, 1)
+        self.seed = random.randint(0, 2 ** 31 - 1) if request.seed is None else request.seed
+        self.cond_images = cond_images
+        height, width = cond_images[0].shape[:2]
+        lora_weights = request.lora_weights or [1.0 / len(cond_images)] * len(cond_images)
+        # requests with the same key can be batched together
+        self.key = (height, width, request.ddim_steps, request.scale, tuple(lora_weights))
+        self.loop = loop
+        self.events = asyncio.Queue()
+        self.arrival = time.perf_counter()
+
+    def send(self, event: dict):
+        """Send an event to the response stream, from any thread."""
+        self.loop.call_soon_threadsafe(self.events.put_nowait, event)
+
+
+class DynamicBatcher:
+    def __init__(self, model, previewer=None, max_batch_size: int = 8, max_wait: float = 0.05):
+        self.model = model
+        self.previewer = previewer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.stats = dict(requests=0, batches=0, images=0, busy_time=0.)
+
+        self._pending = []  # in arrival order
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='gpu-worker', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+
+    def submit(self, job: Job):
+        with self._cond:
+            self._pending.append(job)
+            self.stats['requests'] += 1
+            job.send(dict(event='queued', position=len(self._pending) - 1))
+            self._cond.notify()
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending and not self._stopped:
+                self._cond.wait()
+            if self._stopped:
+                return None
+            first = self._pending[0]
+            deadline = first.arrival + self.max_wait
+            while True:
+                batch, n = [], 0
+                for job in self._pending:
+                    if job.key == first.key and (not batch or n + job.num_samples <= self.max_batch_size):
+                        batch.append(job)
+                        n += job.num_samples
+                remaining = deadline - time.perf_counter()
+                if n >= self.max_batch_size or remaining <= 0 or self._stopped:
+                    break
+                self._cond.wait(timeout=remaining)
+            self._pending = [job for job in self._pending if job not in batch]
+            return batch
+
+    def _run(self):
+        while True:
+            jobs = self._next_batch()
+            if jobs is None:
+                return
+            start = time.perf_counter()
+            for job in jobs:
+                job.send(dict(event='started', batch_size=sum(j.num_samples for j in jobs), queue_time=start - job.arrival))
+            try:
+                images = self.generate(jobs)
+            except Exception as e:
+                for job in jobs:
+                    job.send(dict(event='error', detail=f'{type(e).__name__}: {e}'))
+                continue
+            i = 0
+            for job in jobs:
+                for index in range(job.num_samples):
+                    job.send(dict(event='image', index=index, image=images[i]))
+                    i += 1
+                job.send(dict(event='done', seed=job.seed, latency=time.perf_counter() - job.arrival))
+            self.stats['batches'] += 1
+            self.stats['images'] += len(images)
+            self.stats['busy_time'] += time.perf_counter() - start
+
+    @torch.no_grad()
+    def generate(self, jobs: List[Job]):
+        model = self.model
+        height, width, ddim_steps, scale, lora_weights = jobs[0].key
+        n = sum(job.num_samples for job in jobs)
+        shape = (model.channels, height // 8, width // 8)
+
+        c = model.get_learned_conditioning([job.prompt for job in jobs for _ in range(job.num_samples)])
+        uc = model.get_learned_conditioning([job.n_prompt for job in jobs for _ in range(job.num_samples)])
+        conds, un_conds = [], []
+        for i in range(len(lora_weights)):
+            control = np.stack([job.cond_images[i] for job in jobs for _ in range(job.num_samples)])
+            control = torch.from_numpy(control).to(model.device).float() / 255.0
+            control = einops.rearrange(control, 'b h w c -> b c h w')
+            conds.append({"c_concat": [control], "c_crossattn": [c]})
+            un_conds.append({"c_concat": [control], "c_crossattn": [uc]})
+
+        # the noise of each sample only depends on the seed of its request and its index in the request
+        seeds = [job.seed + index for job in jobs for index in range(job.num_samples)]
+
+        def img_callback(pred_x0, i):
+            wanted = [job.preview and i % job.preview_every == 0 for job in jobs]
+            if not any(wanted):
+                return
+            previews = self.previewer.to_images(pred_x0)
+            start = 0
+            for job, want in zip(jobs, wanted):
+                if want:
+                    for index in range(job.num_samples):
+                        job.send(dict(event='preview', step=i, index=index, image=previews[start + index]))
+                start += job.num_samples
+
+        model.control_scales = [1] * 13
+        model.lora_weights = list(lora_weights)
+        samples, _ = DDIMSampler(model).sample(
+            ddim_steps, n, shape, conds if len(conds) > 1 else conds[0], verbose=False, eta=0, generators=seeds,
+            img_callback=img_callback if self.previewer is not None else None,
+            unconditional_guidance_scale=scale,
+            unconditional_conditioning=un_conds if len(un_conds) > 1 else un_conds[0],
+        )
+        x_samples = model.decode_first_stage(samples)
+        x_samples = (einops.rearrange(x_samples, 'b c h w -> b h w c') * 127.5 + 127.5).cpu().numpy().clip(0, 255).astype(np.uint8)
+        return list(x_samples)
+
+
+def decode_images(cond_images: List[str], resolution: Optional[int]):
+    images = []
+    for data in cond_images:
+        image = cv2.imdecode(np.frombuffer(base64.b64decode(data), dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError('Cannot decode the condition image')
+        image = HWC3(image[..., ::-1].copy())
+        if resolution is not None:
+            image = resize_image(image, resolution)
+        images.append(image)
+    if any(image.shape != images[0].shape for image in images):
+        raise ValueError('The condition images must have the same size')
+    height, width = images[0].shape[:2]
+    if height % 8 or width % 8:
+        raise ValueError(f'The size of the condition images must be a multiple of 8, got {height}x{width}, '
+                         f'or set resolution to resize them')
+    return images
+
+
+def encode_png(image: np.ndarray):
+    return base64.b64encode(cv2.imencode('.png', image[..., ::-1])[1].tobytes()).decode()
+
+
+def create_app(batcher: DynamicBatcher, num_loras: int):
+    app = FastAPI()
+
+    @app.post('/generate')
+    async def generate(request: GenerateRequest):
+        if len(request.cond_images) != num_loras:
+            raise HTTPException(400, f'Expected {num_loras} condition images, got {len(request.cond_images)}')
+        if request.lora_weights is not None and len(request.lora_weights) != num_loras:
+            raise HTTPException(400, f'Expected {num_loras} LoRA weights, got {len(request.lora_weights)}')
+        if request.num_samples < 1 or request.ddim_steps < 1:
+            raise HTTPException(400, 'num_samples and ddim_steps must be positive')
+        loop = asyncio.get_running_loop()
+        try:
+            cond_images = await loop.run_in_executor(None, decode_images, request.cond_images, request.resolution)
+        except ValueError as e:
+            raise HTTPException(400, str(e))
+
+        job = Job(request, cond_images, loop)
+        batcher.submit(job)
+
+        async def stream():
+            while True:
+                event = await job.events.get()
+                if event['event'] in ('image', 'preview'):
+                    image = event.pop('image')
+                    event['png'] = await loop.run_in_executor(None, encode_png, image)
+                yield json.dumps(event) + '\n'
+                if event['event'] in ('done', 'error'):
+                    return
+
+        return StreamingResponse(stream(), media_type='application/x-ndjson')
+
+    @app.get('/stats')
+    async def stats():
+        return dict(batcher.stats, pending=len(batcher._pending))
+
+    return app
+
+
+def main():
+    args = get_parser().parse_args()
+
+    if args.tiny:
+        torch.manual_seed(0)
+        model = create_model('configs/inference/ctrlora_tiny_1lora.yaml').to(args.device).eval()
+        num_loras = 1
+    else:
+        from api import CtrLoRA
+        ctrlora = CtrLoRA(num_loras=len(args.lora_files))
+        ctrlora.create_model(sd_file=args.sd_file, basecn_file=args.basecn_file, lora_files=args.lora_files)
+        model = ctrlora.model.to(args.device).eval()
+        num_loras = len(args.lora_files)
+
+    previewer = LatentPreviewer(args.preview_ckpt).to(args.device)
+    batcher = DynamicBatcher(model, previewer, max_batch_size=args.max_batch_size, max_wait=args.max_wait_ms / 1000)
+    batcher.start()
+    try:
+        uvicorn.run(create_app(batcher, num_loras), host=args.host, port=args.port)
+    finally:
+        batcher.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -60,7 +60,10 @@ class ControlFinetuneLDM(ControlLDM):
     def sample_log(self, cond, batch_size, ddim, ddim_steps, **kwargs):
         ddim_sampler = DDIMSampler(self)
         b, c, h, w = cond["c_concat"][0].shape
-        shape = (self.channels, h // 8, w // 8)
+        if cond.get("c_concat_encoded", False):
+            shape = (self.channels, h, w)
+        else:
+            shape = (self.channels, h // 8, w // 8)
         samples, intermediates = ddim_sampler.sample(ddim_steps, batch_size, shape, cond, verbose=False, **kwargs)
         return samples, intermediates
 
@@ -71,13 +74,18 @@ class ControlFinetuneLDM(ControlLDM):
         cond_txt = torch.cat(cond['c_crossattn'], 1)
 
         if cond['c_concat'] is None:
-            eps = diffusion_model(x=x_noisy, timesteps=t, context=cond_txt, control=None, only_mid_control=self.only_mid_control)
+            with self.profile_stage('unet_forward'):
+                eps = diffusion_model(x=x_noisy, timesteps=t, context=cond_txt, control=None, only_mid_control=self.only_mid_control)
         else:
             hint = torch.cat(cond['c_concat'], 1)
-            hint = self.get_first_stage_encoding(self.encode_first_stage(hint))
-            control = self.control_model(hint=hint, timesteps=t, context=cond_txt)
+            if not cond.get('c_concat_encoded', False):
+                with self.profile_stage('get_input'):  # VAE encoding of the hint
+                    hint = self.get_first_stage_encoding(self.encode_first_stage(hint))
+            with self.profile_stage('control_forward'):
+                control = self.control_model(hint=hint, timesteps=t, context=cond_txt)
             control = [c * scale for c, scale in zip(control, self.control_scales)]
-            eps = diffusion_model(x=x_noisy, timesteps=t, context=cond_txt, control=control, only_mid_control=self.only_mid_control)
+            with self.profile_stage('unet_forward'):
+                eps = diffusion_model(x=x_noisy, timesteps=t, context=cond_txt, control=control, only_mid_control=self.only_mid_control)
 
         return eps
 
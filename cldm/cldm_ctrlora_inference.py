@@ -113,21 +113,46 @@ class ControlNetInference(ControlNet):
 
         return outs
 
+    def build_lora_bindings(self):
+        """The (setter, layer) pairs to call for each lora index, in the order of named_modules()."""
+        bindings = []
+        for index in range(self.lora_num):
+            lora = iter(self.loras_list[index])
+            zero_convs = iter(self.zero_convs_list[index])
+            norms = iter(self.norms_list[index])
+            binding = []
+            for n, m in self.named_modules():
+                if isinstance(m, LoRACompatibleLinear):
+                    binding.append((m.set_lora_layer, next(lora)))
+                elif isinstance(m, SwitchableConv2d):
+                    binding.append((m.set_conv_layer, next(zero_convs)))
+                elif isinstance(m, (SwitchableGroupNorm, SwitchableLayerNorm)):
+                    binding.append((m.set_norm_layer, next(norms)))
+            bindings.append(binding)
+        return bindings
+
+    def invalidate_lora_bindings(self):
+        """Drop the cached bindings and current index, so that the next switch_lora() rebinds every layer."""
+        for k in ('_lora_bindings', '_lora_bindings_owner', '_current_index'):
+            self.__dict__.pop(k, None)
+
     def switch_lora(self, index: int):
-        lora = self.loras_list[index]
-        zero_convs = self.zero_convs_list[index]
-        norms = self.norms_list[index]
-        idx, idx_zero, idx_norm = 0, 0, 0
-        for n, m in self.named_modules():
-            if isinstance(m, LoRACompatibleLinear):
-                m.set_lora_layer(lora[idx])  # type: ignore
-                idx += 1
-            elif isinstance(m, SwitchableConv2d):
-                m.set_conv_layer(zero_convs[idx_zero])  # type: ignore
-                idx_zero += 1
-            elif isinstance(m, (SwitchableGroupNorm, SwitchableLayerNorm)):
-                m.set_norm_layer(norms[idx_norm])  # type: ignore
-                idx_norm += 1
+        # bindings copied from another module (deepcopy, pickle) point to the layers of that module
+        if self.__dict__.get('_lora_bindings_owner') != id(self):
+            self.invalidate_lora_bindings()
+        # called for every lora on every forward, so skip if nothing changes and avoid traversing all modules
+        if index == self.__dict__.get('_current_index'):
+            return
+        if '_lora_bindings' not in self.__dict__:
+            self._lora_bindings = self.build_lora_bindings()
+            self._lora_bindings_owner = id(self)
+        for setter, layer in self._lora_bindings[index]:
+            setter(layer)
+        self._current_index = index
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        super()._load_from_state_dict(*args, **kwargs)
+        self.invalidate_lora_bindings()
 
     def copy_weights_to_switchable(self):
         """
@@ -137,6 +162,7 @@ class ControlNetInference(ControlNet):
         for n, m in self.named_modules():
             if isinstance(m, (SwitchableConv2d, SwitchableGroupNorm, SwitchableLayerNorm)):
                 m.copy_weights()
+        self.invalidate_lora_bindings()
 
 
 class ControlInferenceLDM(ControlLDM):
@@ -149,7 +175,10 @@ class ControlInferenceLDM(ControlLDM):
     def sample_log(self, cond, batch_size, ddim, ddim_steps, **kwargs):
         ddim_sampler = DDIMSampler(self)
         b, c, h, w = cond["c_concat"][0].shape
-        shape = (self.channels, h // 8, w // 8)
+        if cond.get("c_concat_encoded", False):
+            shape = (self.channels, h, w)
+        else:
+            shape = (self.channels, h // 8, w // 8)
         samples, intermediates = ddim_sampler.sample(ddim_steps, batch_size, shape, cond, verbose=False, **kwargs)
         return samples, intermediates
 
@@ -167,7 +196,8 @@ class ControlInferenceLDM(ControlLDM):
         for i, cond in enumerate(conds):
             self.control_model.switch_lora(i)
             hint = torch.cat(cond['c_concat'], 1)
-            hint = self.get_first_stage_encoding(self.encode_first_stage(hint))
+            if not cond.get('c_concat_encoded', False):
+                hint = self.get_first_stage_encoding(self.encode_first_stage(hint))
             control = self.control_model(hint=hint, timesteps=t, context=cond_txt)
             control = [c * scale for c, scale in zip(control, self.control_scales)]
             controls.append(control)
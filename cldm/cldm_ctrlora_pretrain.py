@@ -2,7 +2,11 @@ import einops
 
 import torch
 import torch.nn as nn
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+from torch.nn.parallel import DistributedDataParallel
 from torchvision.utils import make_grid
+from pytorch_lightning.plugins import DDPPlugin
 
 from cldm.ddim_hacked import DDIMSampler
 from cldm.cldm import ControlNet, ControlLDM
@@ -65,23 +69,107 @@ class ControlNetPretrain(ControlNet):
 
         return outs
 
+    def build_lora_bindings(self):
+        """Pair each LoRACompatibleLinear with its lora layer of every task, in the order of named_modules()."""
+        lora_linears = [m for m in self.modules() if isinstance(m, LoRACompatibleLinear)]
+        return {task: list(zip(lora_linears, self.loras_dict[task])) for task in self.tasks}
+
+    def invalidate_lora_bindings(self):
+        """Drop the cached bindings and current task, so that the next switch_lora() rebinds every layer."""
+        for k in ('_lora_bindings', '_lora_bindings_owner', '_current_task'):
+            self.__dict__.pop(k, None)
+
     def switch_lora(self, task: str):
         assert task in self.tasks
-        lora = self.loras_dict[task]
-        idx = 0
-        for n, m in self.named_modules():
-            if isinstance(m, LoRACompatibleLinear):
-                m.set_lora_layer(lora[idx])
-                idx += 1
+        # bindings copied from another module (deepcopy, pickle) point to the layers of that module
+        if self.__dict__.get('_lora_bindings_owner') != id(self):
+            self.invalidate_lora_bindings()
+        # called on every forward, so skip if nothing changes and avoid traversing all modules otherwise;
+        # the lora layers are still registered under each linear, so that state_dict() keeps the same keys
+        if task == self.__dict__.get('_current_task'):
+            return
+        if '_lora_bindings' not in self.__dict__:
+            self._lora_bindings = self.build_lora_bindings()
+            self._lora_bindings_owner = id(self)
+        for m, lora_layer in self._lora_bindings[task]:
+            m.set_lora_layer(lora_layer)
+        self._current_task = task
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        super()._load_from_state_dict(*args, **kwargs)
+        self.invalidate_lora_bindings()
+
+
+class TaskLoRADDPPlugin(DDPPlugin):
+    """
+    DDP for the multi-task pretraining, where each step only uses the LoRAs of one task, the same on every rank
+    (see BatchSchedulerSampler). The LoRAs of all the tasks are left out of DDP, so that DDP neither scans the graph
+    for unused parameters (find_unused_parameters=False) nor reduces the gradients of the inactive tasks; the
+    gradients of the active task's LoRAs are reduced by ControlPretrainLDM.on_after_backward instead.
+
+    The parameters that the optimizers do not update (e.g., the locked UNet) are left out of DDP as well, so that
+    they may stop requiring gradients after the model is wrapped (see CheckpointPolicyTuner).
+    """
+    # checked by CheckpointPolicyTuner, freezing the non-optimized parameters does not need find_unused_parameters
+    ignores_unoptimized_parameters = True
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('find_unused_parameters', False)
+        super().__init__(**kwargs)
+
+    def _setup_model(self, model):
+        pl_module = self.lightning_module
+        # by identity rather than by name, as a bound lora layer is also reachable as `<linear>.lora_layer`
+        loras = {id(p) for p in pl_module.control_model.loras_dict.parameters()}
+        optimized = {id(p) for opt in pl_module.trainer.optimizers for group in opt.param_groups for p in group['params']}
+        ignored = [n for n, p in model.named_parameters() if id(p) in loras or id(p) not in optimized]
+        DistributedDataParallel._set_params_and_buffers_to_ignore_for_model(model, ignored)
+        ddp_model = super()._setup_model(model)
+        # DDP only broadcasts the parameters it manages, start from the same weights on every rank
+        ignored = set(ignored)
+        for n, p in model.named_parameters():
+            if n in ignored and p.requires_grad:
+                dist.broadcast(p.data, src=0)
+        pl_module.sync_task_loras = True
+        return ddp_model
 
 
 class ControlPretrainLDM(ControlLDM):
+    # set by TaskLoRADDPPlugin, which leaves the LoRAs out of DDP
+    sync_task_loras = False
+
+    def on_load_checkpoint(self, checkpoint):
+        super().on_load_checkpoint(checkpoint)
+        # the lora layers bound by switch_lora() are also saved under each linear (`...lora_layer.*`), duplicating
+        # `loras_dict.*`; a model built from the config has none bound, so these keys would fail the strict load
+        state_dict = checkpoint['state_dict']
+        for k in [k for k in state_dict if k.startswith('control_model.') and '.lora_layer.' in k]:
+            del state_dict[k]
+
+    def on_after_backward(self):
+        if not self.sync_task_loras:
+            return
+        task = self.control_model.__dict__.get('_current_task')
+        if task is None:
+            return
+        grads = [p.grad for p in self.control_model.loras_dict[task].parameters() if p.grad is not None]
+        if not grads:
+            return
+        # averaging is linear, so reducing the accumulated gradients after each micro-batch is still exact
+        flat = _flatten_dense_tensors(grads)
+        dist.all_reduce(flat)
+        flat /= dist.get_world_size()
+        for g, synced in zip(grads, _unflatten_dense_tensors(flat, grads)):
+            g.copy_(synced)
 
     @torch.no_grad()
     def sample_log(self, cond, batch_size, ddim, ddim_steps, **kwargs):
         ddim_sampler = DDIMSampler(self)
         b, c, h, w = cond["c_concat"][0].shape
-        shape = (self.channels, h // 8, w // 8)
+        if cond.get("c_concat_encoded", False):
+            shape = (self.channels, h, w)
+        else:
+            shape = (self.channels, h // 8, w // 8)
         samples, intermediates = ddim_sampler.sample(ddim_steps, batch_size, shape, cond, verbose=False, **kwargs)
         return samples, intermediates
 
@@ -99,14 +187,19 @@ class ControlPretrainLDM(ControlLDM):
         cond_txt = torch.cat(cond['c_crossattn'], 1)
 
         if cond['c_concat'] is None:
-            eps = diffusion_model(x=x_noisy, timesteps=t, context=cond_txt, control=None, only_mid_control=self.only_mid_control)
+            with self.profile_stage('unet_forward'):
+                eps = diffusion_model(x=x_noisy, timesteps=t, context=cond_txt, control=None, only_mid_control=self.only_mid_control)
         else:
             self.control_model.switch_lora(cond['task'])
             hint = torch.cat(cond['c_concat'], 1)
-            hint = self.get_first_stage_encoding(self.encode_first_stage(hint))
-            control = self.control_model(hint=hint, timesteps=t, context=cond_txt)
+            if not cond.get('c_concat_encoded', False):
+                with self.profile_stage('get_input'):  # VAE encoding of the hint
+                    hint = self.get_first_stage_encoding(self.encode_first_stage(hint))
+            with self.profile_stage('control_forward'):
+                control = self.control_model(hint=hint, timesteps=t, context=cond_txt)
             control = [c * scale for c, scale in zip(control, self.control_scales)]
-            eps = diffusion_model(x=x_noisy, timesteps=t, context=cond_txt, control=control, only_mid_control=self.only_mid_control)
+            with self.profile_stage('unet_forward'):
+                eps = diffusion_model(x=x_noisy, timesteps=t, context=cond_txt, control=control, only_mid_control=self.only_mid_control)
 
         return eps
 
@@ -120,11 +213,12 @@ class ControlPretrainLDM(ControlLDM):
 
         log = dict()
         z, c = self.get_input(batch, self.first_stage_key, bs=N)
+        encoded = c.get("c_concat_encoded", False)
         c_cat, c, task = c["c_concat"][0][:N], c["c_crossattn"][0][:N], c["task"]
         N = min(z.shape[0], N)
         n_row = min(z.shape[0], n_row)
         log["reconstruction"] = self.decode_first_stage(z)
-        log["control"] = c_cat * 2.0 - 1.0
+        log["control"] = (self.decode_first_stage(c_cat) if encoded else c_cat) * 2.0 - 1.0
         log["conditioning"] = log_txt_as_img((512, 512), batch[self.cond_stage_key], size=16)
 
         if plot_diffusion_rows:
@@ -147,7 +241,7 @@ class ControlPretrainLDM(ControlLDM):
 
         if sample:
             # get denoise row
-            samples, z_denoise_row = self.sample_log(cond={"c_concat": [c_cat], "c_crossattn": [c], "task": task},
+            samples, z_denoise_row = self.sample_log(cond={"c_concat": [c_cat], "c_crossattn": [c], "task": task, "c_concat_encoded": encoded},
                                                      batch_size=N, ddim=use_ddim,
                                                      ddim_steps=ddim_steps, eta=ddim_eta)
             x_samples = self.decode_first_stage(samples)
@@ -159,8 +253,8 @@ class ControlPretrainLDM(ControlLDM):
         if unconditional_guidance_scale > 1.0:
             uc_cross = self.get_unconditional_conditioning(N)
             uc_cat = c_cat  # torch.zeros_like(c_cat)
-            uc_full = {"c_concat": [uc_cat], "c_crossattn": [uc_cross], "task": task}
-            samples_cfg, _ = self.sample_log(cond={"c_concat": [c_cat], "c_crossattn": [c], "task": task},
+            uc_full = {"c_concat": [uc_cat], "c_crossattn": [uc_cross], "task": task, "c_concat_encoded": encoded}
+            samples_cfg, _ = self.sample_log(cond={"c_concat": [c_cat], "c_crossattn": [c], "task": task, "c_concat_encoded": encoded},
                                              batch_size=N, ddim=use_ddim,
                                              ddim_steps=ddim_steps, eta=ddim_eta,
                                              unconditional_guidance_scale=unconditional_guidance_scale,
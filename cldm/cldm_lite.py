@@ -13,7 +13,7 @@ from einops import rearrange, repeat
 from torchvision.utils import make_grid
 from ldm.modules.diffusionmodules.openaimodel import UNetModel, TimestepEmbedSequential, Downsample, normalization
 from ldm.models.diffusion.ddpm import LatentDiffusion
-from ldm.util import log_txt_as_img, instantiate_from_config
+from ldm.util import log_txt_as_img, instantiate_from_config, images_to_float
 from ldm.models.diffusion.ddim import DDIMSampler
 
 
@@ -179,9 +179,8 @@ class ControlLiteLDM(LatentDiffusion):
         control = batch[self.control_key]
         if bs is not None:
             control = control[:bs]
-        control = control.to(self.device)
-        control = einops.rearrange(control, 'b h w c -> b c h w')
-        control = control.to(memory_format=torch.contiguous_format).float()
+        # uint8 hints are normalized to [0, 1] on the device
+        control = images_to_float(control, self.device)
         return x, dict(c_crossattn=[c], c_concat=[control])
 
     def apply_model(self, x_noisy, t, cond, *args, **kwargs):
@@ -191,11 +190,14 @@ class ControlLiteLDM(LatentDiffusion):
         cond_txt = torch.cat(cond['c_crossattn'], 1)
 
         if cond['c_concat'] is None:
-            eps = diffusion_model(x=x_noisy, timesteps=t, context=cond_txt, control=None)
+            with self.profile_stage('unet_forward'):
+                eps = diffusion_model(x=x_noisy, timesteps=t, context=cond_txt, control=None)
         else:
-            control = self.control_model(x=x_noisy, hint=torch.cat(cond['c_concat'], 1), timesteps=t, context=cond_txt)
+            with self.profile_stage('control_forward'):
+                control = self.control_model(x=x_noisy, hint=torch.cat(cond['c_concat'], 1), timesteps=t, context=cond_txt)
             control = [c * scale for c, scale in zip(control, self.control_scales)]
-            eps = diffusion_model(x=x_noisy, timesteps=t, context=cond_txt, control=control)
+            with self.profile_stage('unet_forward'):
+                eps = diffusion_model(x=x_noisy, timesteps=t, context=cond_txt, control=control)
 
         return eps
 
@@ -27,7 +27,7 @@ from ldm.modules.diffusionmodules.openaimodel import (
     TimestepBlock
 )
 from ldm.models.diffusion.ddpm import LatentDiffusion
-from ldm.util import log_txt_as_img, exists, instantiate_from_config
+from ldm.util import log_txt_as_img, exists, instantiate_from_config, images_to_float
 from ldm.models.diffusion.ddim import DDIMSampler
 
 
@@ -1242,9 +1242,8 @@ class TwoStreamControlLDM(LatentDiffusion):
         control = batch[self.control_key]
         if bs is not None:
             control = control[:bs]
-        control = control.to(self.device)
-        control = rearrange(control, 'b h w c -> b c h w')
-        control = control.to(memory_format=torch.contiguous_format).float()
+        # uint8 hints are normalized to [0, 1] on the device
+        control = images_to_float(control, self.device)
         return x, dict(c_crossattn=[c], c_concat=[control])
 
     def apply_model(self, x_noisy, t, cond, precomputed_hint=False, *args, **kwargs):
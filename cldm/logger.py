@@ -1,4 +1,12 @@
 import os
+import csv
+import copy
+import json
+import time
+import queue
+import threading
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
@@ -8,14 +16,22 @@ import pytorch_lightning as pl
 from pytorch_lightning.callbacks import Callback
 from pytorch_lightning.utilities.distributed import rank_zero_only
 
+from ldm.modules.checkpoint_policy import CheckpointPolicy, tune_policy
+
 
 class ImageLogger(Callback):
     """
     Adapted from https://github.com/lllyasviel/ControlNet/blob/main/cldm/logger.py
+
+    With `background=True`, images are sampled off the training critical path: rank 0 keeps a replica of the
+    model that shares the frozen weights, and at each logging step only snapshots the optimized weights and
+    the batch into a bounded queue (dropping the stale request if the previous one is still waiting). A worker
+    thread then loads the snapshot into the replica, samples on a separate CUDA stream and writes the grids.
+    An exception of the worker is re-raised, with its traceback, at the next logging step or at the end of training.
     """
     def __init__(self, batch_frequency=2000, max_images=4, clamp=True, increase_log_steps=True,
                  rescale=True, disabled=False, log_on_batch_idx=False, log_first_step=False,
-                 log_images_kwargs=None):
+                 log_images_kwargs=None, background=False, max_queue_size=1):
         super().__init__()
         self.rescale = rescale
         self.batch_freq = batch_frequency
@@ -27,6 +43,13 @@ class ImageLogger(Callback):
         self.log_on_batch_idx = log_on_batch_idx
         self.log_images_kwargs = log_images_kwargs if log_images_kwargs else {}
         self.log_first_step = log_first_step
+        self.background = background
+        self.max_queue_size = max_queue_size
+        self._replica = None
+        self._trainable = None
+        self._queue = None
+        self._worker = None
+        self._error = None
 
     @rank_zero_only
     def log_local(self, save_dir, split, images, global_step, current_epoch, batch_idx):
@@ -43,6 +66,16 @@ class ImageLogger(Callback):
             os.makedirs(os.path.split(path)[0], exist_ok=True)
             Image.fromarray(grid).save(path)
 
+    def postprocess(self, images):
+        for k in images:
+            N = min(images[k].shape[0], self.max_images)
+            images[k] = images[k][:N]
+            if isinstance(images[k], torch.Tensor):
+                images[k] = images[k].detach().cpu()
+                if self.clamp:
+                    images[k] = torch.clamp(images[k], -1., 1.)
+        return images
+
     def log_img(self, trainer, pl_module, batch, batch_idx, split="train"):
         check_idx = batch_idx if self.log_on_batch_idx else pl_module.global_step
         if (self.check_frequency(check_idx) and
@@ -50,6 +83,11 @@ class ImageLogger(Callback):
                 callable(pl_module.log_images) and
                 self.max_images > 0):
 
+            if self.background:
+                if trainer.is_global_zero:
+                    self.submit(trainer, pl_module, batch, batch_idx, split)
+                return
+
             is_train = pl_module.training
             if is_train:
                 pl_module.eval()
@@ -57,19 +95,107 @@ class ImageLogger(Callback):
             with torch.no_grad():
                 images = pl_module.log_images(batch, split=split, **self.log_images_kwargs)
 
-            for k in images:
-                N = min(images[k].shape[0], self.max_images)
-                images[k] = images[k][:N]
-                if isinstance(images[k], torch.Tensor):
-                    images[k] = images[k].detach().cpu()
-                    if self.clamp:
-                        images[k] = torch.clamp(images[k], -1., 1.)
-
+            images = self.postprocess(images)
             self.log_local(trainer.log_dir, split, images, pl_module.global_step, pl_module.current_epoch, batch_idx)
 
             if is_train:
                 pl_module.train()
 
+    def build_replica(self, trainer, pl_module):
+        """A copy of `pl_module` for sampling, sharing the weights that are not optimized."""
+        optimized = {id(p) for opt in trainer.optimizers for group in opt.param_groups for p in group['params']}
+        # shared (not copied) objects: the frozen weights, the trainer and the caches
+        memo = {id(p): p for p in pl_module.parameters() if id(p) not in optimized}
+        for name in ['trainer', 'prompt_cache', 'model_ema', 'stage_profiler']:
+            if getattr(pl_module, name, None) is not None:
+                memo[id(getattr(pl_module, name))] = getattr(pl_module, name)
+        replica = copy.deepcopy(pl_module, memo)
+        replica.eval()
+        self._trainable = [
+            (p, q) for p, q in zip(pl_module.parameters(), replica.parameters()) if id(p) in optimized
+        ]
+        return replica
+
+    def check_worker(self):
+        """Re-raise in the training thread the exception of a failed background logging, if any."""
+        if self._error is not None:
+            global_step, error = self._error
+            self._error = None
+            raise RuntimeError(f'ImageLogger: failed to log images at step {global_step}') from error
+
+    def submit(self, trainer, pl_module, batch, batch_idx, split):
+        self.check_worker()
+        if self._replica is None:
+            self._replica = self.build_replica(trainer, pl_module)
+            self._queue = queue.Queue(maxsize=self.max_queue_size)
+            self._worker = threading.Thread(target=self._work, daemon=True)
+            self._worker.start()
+        with torch.no_grad():
+            # LoRA weights are small, so the snapshot is a plain copy on the training stream
+            weights = [p.detach().clone() for p, _ in self._trainable]
+            batch = self.snapshot_batch(batch, self.log_images_kwargs.get('N', self.max_images))
+        event = None
+        if pl_module.device.type == 'cuda':
+            event = torch.cuda.Event()
+            event.record(torch.cuda.current_stream(pl_module.device))
+        request = (
+            weights, batch, event, trainer.log_dir, split, pl_module.global_step, pl_module.current_epoch, batch_idx,
+        )
+        while True:
+            try:
+                self._queue.put_nowait(request)
+                break
+            except queue.Full:
+                # the worker is still busy, drop the stale request waiting in the queue
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    @staticmethod
+    def snapshot_batch(batch, n):
+        if isinstance(batch, torch.Tensor):
+            return batch[:n].clone()
+        if isinstance(batch, dict):
+            return {k: ImageLogger.snapshot_batch(v, n) for k, v in batch.items()}
+        if isinstance(batch, (list, tuple)):
+            return type(batch)(batch[:n])
+        return batch
+
+    def _work(self):
+        device = self._replica.device
+        stream = torch.cuda.Stream(device=device) if device.type == 'cuda' else None
+        while True:
+            request = self._queue.get()
+            if request is None:
+                break
+            weights, batch, event, save_dir, split, global_step, current_epoch, batch_idx = request
+            try:
+                with torch.no_grad(), torch.cuda.stream(stream) if stream is not None else nullcontext():
+                    if event is not None:
+                        stream.wait_event(event)
+                    if stream is not None:
+                        # allocated on the training stream, must not be reused before this stream is done
+                        for t in weights + [v for v in (batch.values() if isinstance(batch, dict) else []) if isinstance(v, torch.Tensor)]:
+                            t.record_stream(stream)
+                    for (_, q), w in zip(self._trainable, weights):
+                        q.copy_(w)
+                    del weights
+                    images = self._replica.log_images(batch, split=split, **self.log_images_kwargs)
+                    images = self.postprocess(images)
+                self.log_local(save_dir, split, images, global_step, current_epoch, batch_idx)
+            except Exception as e:
+                # kept with its traceback, the first failure is the one reported
+                if self._error is None:
+                    self._error = (global_step, e)
+
+    def on_train_end(self, trainer, pl_module):
+        if self._worker is not None:
+            self._queue.put(None)
+            self._worker.join()
+            self._worker = None
+        self.check_worker()
+
     def check_frequency(self, check_idx):
         return check_idx == 0 or (check_idx + 1) % self.batch_freq == 0
 
@@ -124,3 +250,410 @@ class CheckpointEveryNSteps(Callback):
 
     def check_frequency(self, check_idx):
         return check_idx == 0 or (check_idx + 1) % self.save_step_frequency == 0
+
+
+class TrainableCheckpointEveryNSteps(Callback):
+    """
+    Save only the optimized parameters (and optionally the optimizer state) every N steps.
+
+    The state is copied to pinned CPU buffers without blocking, and written to disk by a background thread,
+    so training continues meanwhile. The parameters are stored under `state_dict` with their full names
+    (e.g., `control_model.input_blocks.1.1.proj_in.lora_layer.down.weight`), hence the files of a LoRA
+    finetune can be loaded by `api.CtrLoRA` as they are, without `scripts/tool_extract_weights.py`.
+    """
+
+    def __init__(self, save_step_frequency, prefix="N-Step-Trainable", keep_last=None, save_optimizer=True):
+        """
+        Args:
+            save_step_frequency: how often to save in steps
+            prefix: add a prefix to the name
+            keep_last: only keep the last N checkpoints, keep all if None
+            save_optimizer: also save the optimizer states, to resume training
+        """
+        self.save_step_frequency = save_step_frequency
+        self.prefix = prefix
+        self.keep_last = keep_last
+        self.save_optimizer = save_optimizer
+        self.saved_paths = []
+        self._trainable = None
+        self._buffers = dict()
+        self._executor = None
+        self._pending = None
+
+    def check_frequency(self, check_idx):
+        return check_idx == 0 or (check_idx + 1) % self.save_step_frequency == 0
+
+    @staticmethod
+    def get_trainable_parameters(trainer, pl_module):
+        """(name, parameter) of the parameters optimized by any optimizer of the trainer."""
+        optimized = {id(p) for opt in trainer.optimizers for group in opt.param_groups for p in group['params']}
+        return [(n, p) for n, p in pl_module.named_parameters() if id(p) in optimized]
+
+    def _snapshot(self, key, value):
+        """Copy tensors (possibly nested in dicts / lists) to reused pinned buffers, without blocking."""
+        if isinstance(value, torch.Tensor):
+            buf = self._buffers.get(key)
+            if buf is None or buf.shape != value.shape or buf.dtype != value.dtype:
+                buf = torch.empty(value.shape, dtype=value.dtype, pin_memory=torch.cuda.is_available())
+                self._buffers[key] = buf
+            buf.copy_(value.detach(), non_blocking=True)
+            return buf
+        if isinstance(value, dict):
+            return {k: self._snapshot(key + (k, ), v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return type(value)(self._snapshot(key + (i, ), v) for i, v in enumerate(value))
+        return value
+
+    def on_batch_end(self, trainer: pl.Trainer, pl_module):
+        """ Check if we should save a checkpoint after every train batch """
+        epoch = trainer.current_epoch
+        global_step = trainer.global_step
+        if not self.check_frequency(global_step) or not trainer.is_global_zero:
+            return
+        # the previous checkpoint must be written before its buffers are reused
+        self.wait()
+        if self._trainable is None:
+            self._trainable = self.get_trainable_parameters(trainer, pl_module)
+        checkpoint = dict(
+            epoch=epoch, global_step=global_step,
+            state_dict={n: self._snapshot(('state_dict', n), p) for n, p in self._trainable},
+        )
+        if self.save_optimizer:
+            checkpoint['optimizer_states'] = [
+                self._snapshot(('optimizer_states', i), opt.state_dict()) for i, opt in enumerate(trainer.optimizers)
+            ]
+        event = None
+        if torch.cuda.is_available() and pl_module.device.type == 'cuda':
+            event = torch.cuda.Event()
+            event.record(torch.cuda.current_stream(pl_module.device))
+        filename = f"{self.prefix}_{epoch=}_{global_step=}.ckpt"
+        ckpt_path = os.path.join(trainer.checkpoint_callback.dirpath, filename)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = self._executor.submit(self._write, checkpoint, ckpt_path, event)
+
+    def _write(self, checkpoint, ckpt_path, event):
+        if event is not None:
+            event.synchronize()
+        os.makedirs(os.path.dirname(ckpt_path), exist_ok=True)
+        # write to a temporary file first, so that an interrupted write does not leave a broken checkpoint
+        torch.save(checkpoint, ckpt_path + '.tmp')
+        os.replace(ckpt_path + '.tmp', ckpt_path)
+        self.saved_paths.append(ckpt_path)
+        if self.keep_last is not None:
+            while len(self.saved_paths) > self.keep_last:
+                old_path = self.saved_paths.pop(0)
+                if os.path.isfile(old_path):
+                    os.remove(old_path)
+
+    def wait(self):
+        """Wait for the pending write, if any."""
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def on_train_end(self, trainer, pl_module):
+        self.wait()
+
+
+class SamplerStateCallback(Callback):
+    """
+    Save the state of a resumable sampler (e.g., `datasets.multi_task_scheduler.BatchSchedulerSampler`) in the
+    checkpoints, and restore it when resuming with `trainer.fit(..., ckpt_path=...)`, so that training continues
+    from the same position in the epoch instead of restarting it.
+    """
+    def __init__(self, sampler):
+        self.sampler = sampler
+        self.num_consumed = 0
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, *args):
+        self.num_consumed += 1
+
+    def on_save_checkpoint(self, trainer, pl_module, checkpoint):
+        # the dataloader prefetches batches ahead of training, only count the ones trained on
+        return self.sampler.state_dict(num_consumed=self.num_consumed)
+
+    def on_load_checkpoint(self, trainer, pl_module, callback_state):
+        if callback_state:
+            self.sampler.load_state_dict(callback_state)
+            self.num_consumed = 0
+
+
+class StageProfiler(Callback):
+    """
+    Break down the time of each training step into stages, to find where the time goes when throughput regresses:
+
+    - `data_wait`: waiting for the dataloader, from the end of the previous step to the start of this one
+    - `get_input`: `get_input` of the model (VAE encoding, text encoding), and the VAE encoding of the hints
+    - `control_forward` / `unet_forward`: the forward of the ControlNet / the UNet
+    - `backward`, `optimizer`: the backward pass and the optimizer step
+    - `ema`: the EMA update, if any
+    - `other`: the rest of the step (loss, logging, other callbacks, ...)
+
+    The model stages are timed through `profile_stage()` of the model, the others through the Lightning hooks.
+    On CUDA, the stages are measured with events recorded on the current stream and read one or more steps later,
+    once they have completed, so the profiler never synchronizes the device; `step` is measured on the host.
+
+    Rank 0 writes `summary.json` (mean / percentiles of each stage in ms, and its share of the step), `steps.csv`
+    (one row per step) and, with `chrome_trace=True`, `trace.json` (open with chrome://tracing or Perfetto) to
+    `save_dir` every `save_every` steps and at the end of training.
+    """
+
+    STAGES = ['data_wait', 'get_input', 'control_forward', 'unet_forward', 'backward', 'optimizer', 'ema']
+
+    def __init__(self, save_dir=None, warmup_steps=10, save_every=500, chrome_trace=False, trace_steps=20):
+        """
+        Args:
+            save_dir: where to write the results, `{log_dir}/profile` if None
+            warmup_steps: number of steps skipped at the beginning (cudnn autotuning, allocator warm-up, ...)
+            save_every: how often to write the results in steps
+            chrome_trace: also write the stages of the first `trace_steps` profiled steps as a Chrome trace
+            trace_steps: number of steps in the Chrome trace
+        """
+        self.save_dir = save_dir
+        self.warmup_steps = warmup_steps
+        self.save_every = save_every
+        self.chrome_trace = chrome_trace
+        self.trace_steps = trace_steps
+        self.records = []  # one dict of stage times (ms) per profiled step
+        self.trace_events = []
+        self._cuda = False
+        self._ref = None  # (event, host time) to place the device events on the host timeline
+        self._active = False
+        self._step = 0
+        self._open = dict()
+        self._intervals = []
+        self._pending = []
+        self._step_start = None
+        self._last_end = None
+        self._data_wait = None
+
+    def _mark(self):
+        if self._cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def _elapsed(self, start, end):
+        if self._cuda:
+            return start.elapsed_time(end)
+        return (end - start) * 1000
+
+    def _to_host_time(self, mark):
+        """Time of a mark in ms on the host timeline."""
+        if self._cuda:
+            event, t_ref = self._ref
+            return t_ref * 1000 + event.elapsed_time(mark)
+        return mark * 1000
+
+    @contextmanager
+    def stage(self, name):
+        if not self._active:
+            yield
+            return
+        start = self._mark()
+        try:
+            yield
+        finally:
+            self._intervals.append((name, start, self._mark()))
+
+    def begin(self, name):
+        if self._active:
+            self._open[name] = self._mark()
+
+    def end(self, name):
+        start = self._open.pop(name, None)
+        if start is not None:
+            self._intervals.append((name, start, self._mark()))
+
+    def on_train_start(self, trainer, pl_module):
+        pl_module.stage_profiler = self
+        self._cuda = pl_module.device.type == 'cuda'
+        if self._cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            event.synchronize()
+            self._ref = (event, time.perf_counter())
+        if self.save_dir is None:
+            self.save_dir = os.path.join(trainer.log_dir, 'profile')
+
+    def on_batch_start(self, trainer, pl_module):
+        now = time.perf_counter()
+        self._active = self._step >= self.warmup_steps
+        self._data_wait = (now - self._last_end) * 1000 if self._active and self._last_end is not None else None
+        self._step_start = now
+
+    def on_before_backward(self, trainer, pl_module, loss):
+        self.begin('backward')
+
+    def on_after_backward(self, trainer, pl_module):
+        self.end('backward')
+
+    def on_before_optimizer_step(self, trainer, pl_module, optimizer, opt_idx):
+        self.begin('optimizer')
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, *args):
+        # the callbacks run before the model hook, i.e., before the EMA update
+        self.end('optimizer')
+
+    def on_batch_end(self, trainer, pl_module):
+        now = time.perf_counter()
+        if self._active:
+            self._pending.append(dict(
+                step=trainer.global_step, host_start=self._step_start, data_wait=self._data_wait,
+                step_time=(now - (self._last_end or self._step_start)) * 1000, intervals=self._intervals,
+            ))
+        self._intervals, self._open = [], dict()
+        self._active = False
+        self._last_end = now
+        self._step += 1
+        self._resolve()
+        if self._step % self.save_every == 0:
+            self.save(trainer)
+
+    def _resolve(self, wait=False):
+        """Convert the marks of the completed steps into stage times."""
+        while self._pending:
+            pending = self._pending[0]
+            if self._cuda and pending['intervals']:
+                last = pending['intervals'][-1][2]
+                if wait:
+                    last.synchronize()
+                elif not last.query():
+                    break
+            self._pending.pop(0)
+            record = dict(step=pending['step'], step_time=pending['step_time'])
+            record.update({name: 0. for name in self.STAGES})
+            record['data_wait'] = pending['data_wait'] or 0.
+            for name, start, end in pending['intervals']:
+                record[name] = record.get(name, 0.) + self._elapsed(start, end)
+            record['other'] = max(record['step_time'] - sum(record[name] for name in record if name in self.STAGES), 0.)
+            self.records.append(record)
+            if self.chrome_trace and len(self.records) <= self.trace_steps:
+                self._add_trace(pending)
+
+    def _add_trace(self, pending):
+        # complete ("X") events in us; the host-timed stages on tid 0, the device-timed ones on tid 1
+        tid = 1 if self._cuda else 0
+        host_start = pending['host_start'] * 1e6
+        self.trace_events.append(dict(
+            name=f"step {pending['step']}", ph='X', pid=0, tid=0, ts=host_start - (pending['data_wait'] or 0) * 1000,
+            dur=pending['step_time'] * 1000,
+        ))
+        if pending['data_wait']:
+            self.trace_events.append(dict(
+                name='data_wait', ph='X', pid=0, tid=0, ts=host_start - pending['data_wait'] * 1000,
+                dur=pending['data_wait'] * 1000,
+            ))
+        for name, start, end in pending['intervals']:
+            self.trace_events.append(dict(
+                name=name, ph='X', pid=0, tid=tid, ts=self._to_host_time(start) * 1000,
+                dur=self._elapsed(start, end) * 1000,
+            ))
+
+    def summary(self):
+        if not self.records:
+            return dict()
+        names = ['step_time'] + self.STAGES + ['other']
+        mean_step = float(np.mean([r['step_time'] for r in self.records]))
+        summary = dict(num_steps=len(self.records), warmup_steps=self.warmup_steps, stages=dict())
+        for name in names:
+            values = np.array([r[name] for r in self.records])
+            summary['stages'][name] = dict(
+                mean_ms=float(values.mean()), p50_ms=float(np.percentile(values, 50)),
+                p90_ms=float(np.percentile(values, 90)), p99_ms=float(np.percentile(values, 99)),
+                max_ms=float(values.max()), share=float(values.mean() / mean_step) if mean_step > 0 else 0.,
+            )
+        return summary
+
+    def save(self, trainer):
+        if not trainer.is_global_zero or not self.records:
+            return
+        os.makedirs(self.save_dir, exist_ok=True)
+        with open(os.path.join(self.save_dir, 'summary.json'), 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+        columns = ['step', 'step_time'] + self.STAGES + ['other']
+        with open(os.path.join(self.save_dir, 'steps.csv'), 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=columns, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(self.records)
+        if self.chrome_trace and self.trace_events:
+            with open(os.path.join(self.save_dir, 'trace.json'), 'w') as f:
+                json.dump(dict(traceEvents=self.trace_events, displayTimeUnit='ms'), f)
+
+    def on_train_end(self, trainer, pl_module):
+        self._resolve(wait=True)
+        self.save(trainer)
+        pl_module.stage_profiler = None
+
+
+class CheckpointPolicyTuner(Callback):
+    """
+    Set the activation checkpointing of the model at the start of training, instead of the `use_checkpoint` of
+    the config, see ldm.modules.checkpoint_policy.
+
+    With `freeze=True`, the parameters not optimized (e.g., the locked UNet) stop requiring gradients, so that
+    no gradient is computed for them, and the blocks that get no gradient at all are neither checkpointed nor
+    recomputed. As they are frozen after DDP has wrapped the model, DDP must either find the unused parameters
+    (the default of the `ddp` strategy) or leave the non-optimized parameters out (TaskLoRADDPPlugin); any other
+    DDP setup is rejected in setup(), instead of failing at the second step.
+
+    With `policy=None`, the policy is tuned on the first batch: the fastest one whose training step fits in
+    `max_memory` (a fraction of the device memory if <= 1, else in bytes), leaving room for the optimizer states
+    that are not allocated yet. Each rank measures its own steps, and the policy chosen by rank 0 is used by all.
+    """
+    def __init__(self, policy=None, max_memory=0.9, mode='non_reentrant', freeze=True):
+        self.policy = policy
+        self.max_memory = max_memory
+        self.mode = mode
+        self.freeze = freeze
+        self._done = False
+
+    def setup(self, trainer, pl_module, stage=None):
+        plugin = trainer.training_type_plugin
+        ddp_kwargs = getattr(plugin, '_ddp_kwargs', None)
+        if (self.freeze and ddp_kwargs is not None and not ddp_kwargs.get('find_unused_parameters', True)
+                and not getattr(plugin, 'ignores_unoptimized_parameters', False)):
+            raise RuntimeError(
+                'CheckpointPolicyTuner(freeze=True) freezes parameters after DDP has wrapped the model, which needs '
+                'find_unused_parameters=True (or use freeze=False)'
+            )
+
+    def get_budget(self, trainer, pl_module):
+        budget = self.max_memory
+        if budget <= 1:
+            budget *= torch.cuda.get_device_properties(pl_module.device).total_memory
+        for opt in trainer.optimizers:
+            if not opt.state and isinstance(opt, (torch.optim.Adam, torch.optim.AdamW)):
+                # exp_avg and exp_avg_sq of every optimized parameter
+                budget -= sum(2 * p.numel() * p.element_size() for group in opt.param_groups for p in group['params'])
+        return int(budget)
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx, *args):
+        if self._done:
+            return
+        self._done = True
+        if self.freeze:
+            optimized = {id(p) for opt in trainer.optimizers for group in opt.param_groups for p in group['params']}
+            for p in pl_module.parameters():
+                if id(p) not in optimized:
+                    p.requires_grad_(False)
+        if self.policy is not None or pl_module.device.type != 'cuda':
+            policy = self.policy or CheckpointPolicy(mode=self.mode)
+        else:
+            def step_fn():
+                # the model is called directly, not through the DDP wrapper, so the gradients are not reduced
+                autocast = torch.autocast('cuda', dtype=torch.float16) if trainer.precision == 16 else nullcontext()
+                with autocast:
+                    loss, _ = pl_module.shared_step(batch)
+                loss.backward()
+                pl_module.zero_grad(set_to_none=True)
+
+            policy, _ = tune_policy(
+                pl_module, step_fn, self.get_budget(trainer, pl_module), mode=self.mode, verbose=trainer.is_global_zero,
+            )
+            policy = trainer.training_type_plugin.broadcast(policy)
+        checkpointed = policy.apply(pl_module)
+        if trainer.is_global_zero:
+            print(f'Activation checkpointing: {policy}, {len(checkpointed)} blocks selected')
@@ -0,0 +1,113 @@
+"""
+Cheap RGB previews of (scaled) SD latents, e.g., of the pred_x0 passed to the `img_callback` of DDIMSampler at
+every step, instead of a full AutoencoderKL.decode that costs as much as several UNet steps.
+
+The default previewer is a per-pixel linear projection 4 -> 3 (an RGB image at 1/8 resolution). A checkpoint
+made by `scripts/tool_fit_preview_decoder.py` holds a projection fitted to the SD VAE and, optionally, a tiny
+convolutional decoder at full resolution:
+
+    previewer = LatentPreviewer('ckpts/preview/sd15_preview.pt').cuda()
+    callback = make_preview_callback(previewer, lambda images, i: show(images))
+    samples, _ = ddim_sampler.sample(..., img_callback=callback)
+"""
+
+import queue
+import threading
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+# approximate projection of the scaled SD1.5 latents to RGB in [-1, 1], as commonly used for previews,
+# refit it to the VAE with scripts/tool_fit_preview_decoder.py
+SD15_LATENT_RGB_WEIGHT = [
+    [0.3512, 0.3250, -0.2829, -0.2120],
+    [0.2297, 0.4974, 0.1762, -0.2616],
+    [0.3227, 0.2350, 0.2721, -0.7177],
+]
+SD15_LATENT_RGB_BIAS = [0.0, 0.0, 0.0]
+
+
+class TinyDecoder(nn.Module):
+    """Latents to RGB at 8x the resolution, with 3 upsampling blocks of a few narrow convolutions."""
+    def __init__(self, in_channels=4, channels=64, out_channels=3):
+        super().__init__()
+        layers = [nn.Conv2d(in_channels, channels, 3, padding=1), nn.SiLU()]
+        for _ in range(3):
+            layers += [
+                nn.Upsample(scale_factor=2, mode='nearest'),
+                nn.Conv2d(channels, channels, 3, padding=1), nn.SiLU(),
+                nn.Conv2d(channels, channels, 3, padding=1), nn.SiLU(),
+            ]
+        layers.append(nn.Conv2d(channels, out_channels, 3, padding=1))
+        self.layers = nn.Sequential(*layers)
+
+    def forward(self, z):
+        return self.layers(z)
+
+
+class LatentPreviewer(nn.Module):
+    def __init__(self, ckpt=None, use_decoder=True):
+        super().__init__()
+        self.linear = nn.Conv2d(4, 3, 1)
+        self.decoder = None
+        state = torch.load(ckpt, map_location='cpu') if ckpt is not None else dict()
+        with torch.no_grad():
+            self.linear.weight.copy_(torch.tensor(state.get('linear_weight', SD15_LATENT_RGB_WEIGHT))[..., None, None])
+            self.linear.bias.copy_(torch.tensor(state.get('linear_bias', SD15_LATENT_RGB_BIAS)))
+        if use_decoder and state.get('decoder') is not None:
+            self.decoder = TinyDecoder(channels=state['decoder_channels'])
+            self.decoder.load_state_dict(state['decoder'])
+        self.requires_grad_(False)
+        self.eval()
+
+    def forward(self, z):
+        """Scaled latents (b, 4, h, w) to images in [-1, 1], (b, 3, 8h, 8w) with the decoder, else (b, 3, h, w)."""
+        z = z.to(self.linear.weight)
+        if self.decoder is not None:
+            return self.decoder(z)
+        return self.linear(z)
+
+    @torch.no_grad()
+    def to_images(self, z, size=None):
+        """Previews as a (b, H, W, 3) uint8 numpy array, upsampled to size = (H, W) if given."""
+        x = self(z)
+        if size is not None and tuple(x.shape[-2:]) != tuple(size):
+            x = F.interpolate(x, size=size, mode='bilinear', align_corners=False)
+        x = (x.permute(0, 2, 3, 1) * 127.5 + 127.5).clamp(0, 255).to(torch.uint8)
+        return x.cpu().numpy()
+
+
+def make_preview_callback(previewer, fn, every=1, size=None):
+    """An `img_callback(pred_x0, i)` for DDIMSampler.sample, calling fn(previews, i) every `every` steps."""
+    def img_callback(pred_x0, i):
+        if i % every == 0:
+            fn(previewer.to_images(pred_x0, size), i)
+    return img_callback
+
+
+def iterate_with_previews(sample_fn, previewer, every=1, size=None):
+    """
+    Run sample_fn(img_callback) in a thread and yield ('preview', previews, i) at every `every` steps, then
+    ('done', its result, None), e.g., to stream the progress of a generation from a gradio generator function.
+    """
+    events = queue.Queue()
+
+    def run():
+        try:
+            callback = make_preview_callback(previewer, lambda images, i: events.put(('preview', images, i)), every, size)
+            events.put(('done', sample_fn(callback), None))
+        except BaseException as e:
+            events.put(('error', e, None))
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    while True:
+        kind, value, i = events.get()
+        if kind == 'error':
+            raise value
+        yield kind, value, i
+        if kind == 'done':
+            break
+    thread.join()
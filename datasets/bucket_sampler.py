@@ -0,0 +1,122 @@
+"""
+Aspect-ratio bucketing, to train on images at (close to) their native size instead of resizing them to 512x512.
+
+Each image is assigned a bucket: its size, scaled down only if its area exceeds `max_area`, and floored to
+multiples of 64 (so that the latents are multiples of 8, as required by the UNet). The dataset then only crops
+at most 63 pixels from each side when the image already has the size of its bucket (see `fit_to_bucket`),
+and `BucketBatchSampler` builds batches of images of the same bucket, with a batch size per bucket given by a
+budget of latent tokens, so that small images are trained in large batches and large ones in small batches.
+"""
+
+import math
+from typing import Tuple
+
+import cv2
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+
+def get_bucket(height: int, width: int, max_area: int = 512 * 512, step: int = 64) -> Tuple[int, int]:
+    """The (height, width) bucket of an image of the given size."""
+    scale = min(1., math.sqrt(max_area / (height * width)))
+    return (max(step, int(height * scale) // step * step),
+            max(step, int(width * scale) // step * step))
+
+
+def fit_to_bucket(img: np.ndarray, bucket: Tuple[int, int], interpolation=cv2.INTER_LINEAR) -> np.ndarray:
+    """
+    Center crop `img` to `bucket`, resizing it first (preserving the aspect ratio) only if a side is smaller than
+    the bucket or larger by 64 pixels or more, i.e., images already at the size of their bucket are not resampled.
+    """
+    bh, bw = bucket
+    h, w = img.shape[:2]
+    if h < bh or w < bw or h - bh >= 64 or w - bw >= 64:
+        scale = max(bh / h, bw / w)
+        size = (max(bw, round(w * scale)), max(bh, round(h * scale)))
+        img = cv2.resize(img, size, interpolation=cv2.INTER_AREA if scale < 1 else interpolation)
+        h, w = img.shape[:2]
+    top, left = (h - bh) // 2, (w - bw) // 2
+    return img[top:top + bh, left:left + bw]
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Yield batches of indices of the same bucket, to be passed as `batch_sampler` of the DataLoader.
+
+    Args:
+        buckets: (N, 2) array, the (height, width) bucket of each item, e.g., `CustomDataset.buckets`
+        max_tokens: latent tokens ((H / 8) * (W / 8) per image) per batch, 4096 is one 512x512 image
+        max_batch_size: upper bound of the batch size, for the buckets of small images
+        distributed: shard the batches across the ranks of the default process group
+        shuffle: shuffle the items within the buckets, and the order of the batches
+        drop_last: drop the last incomplete batch of each bucket
+        seed: random seed, the same on all ranks
+
+    The batches of an epoch are built identically on all ranks, shuffled, padded to a multiple of the world size
+    by repeating some of them, and dealt to the ranks, so that every rank gets the same number of batches. The
+    ranks may train on different buckets at the same step, which does not matter to DDP. The epoch is advanced
+    at the end of each pass, so the shuffling changes every epoch without `set_epoch`.
+    """
+    def __init__(self, buckets: np.ndarray, max_tokens: int = 4096 * 8, max_batch_size: int = 64,
+                 distributed: bool = True, shuffle: bool = True, drop_last: bool = False, seed: int = 0):
+        self.buckets = np.asarray(buckets).reshape(-1, 2)
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.distributed = distributed
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+        keys, inverse = np.unique(self.buckets, axis=0, return_inverse=True)
+        self.bucket_sizes = [tuple(int(x) for x in key) for key in keys]
+        self.bucket_indices = [np.flatnonzero(inverse.reshape(-1) == i) for i in range(len(keys))]
+        self.batch_sizes = [self.get_batch_size(*key) for key in self.bucket_sizes]
+
+    def get_batch_size(self, height: int, width: int):
+        tokens = (height // 8) * (width // 8)
+        return max(1, min(self.max_batch_size, self.max_tokens // tokens))
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def _get_rank(self):
+        if self.distributed and dist.is_available() and dist.is_initialized():
+            return dist.get_rank(), dist.get_world_size()
+        return 0, 1
+
+    def _num_batches(self):
+        n = 0
+        for indices, bs in zip(self.bucket_indices, self.batch_sizes):
+            n += len(indices) // bs if self.drop_last else math.ceil(len(indices) / bs)
+        return n
+
+    def __len__(self):
+        _, world_size = self._get_rank()
+        return math.ceil(self._num_batches() / world_size)
+
+    def __iter__(self):
+        rank, world_size = self._get_rank()
+        rng = np.random.default_rng([self.seed, self.epoch])
+        batches = []
+        for indices, bs in zip(self.bucket_indices, self.batch_sizes):
+            if self.shuffle:
+                indices = rng.permutation(indices)
+            n = len(indices) // bs * bs if self.drop_last else len(indices)
+            batches.extend(indices[i:i + bs] for i in range(0, n, bs))
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        # pad to a multiple of world_size by wrapping around, as DistributedSampler does
+        total = math.ceil(len(batches) / world_size) * world_size
+        batches = (batches * math.ceil(total / max(len(batches), 1)))[:total]
+        for batch in batches[rank::world_size]:
+            yield batch.tolist()
+        self.epoch += 1
+
+    def summary(self):
+        """Number of items and batch size of each bucket, for logging."""
+        return '\n'.join(
+            f'  {h}x{w}: {len(indices)} items, batch size {bs}'
+            for (h, w), indices, bs in zip(self.bucket_sizes, self.bucket_indices, self.batch_sizes)
+        )
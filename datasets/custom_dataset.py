@@ -2,9 +2,17 @@ import os
 import cv2
 import json
 import numpy as np
+from typing import Optional
+from multiprocessing.pool import ThreadPool
 
 from torch.utils.data import Dataset
 
+from datasets.latent_cache import LatentCache
+from datasets.prompt_cache import PromptCache
+from datasets.metadata_index import MetadataIndex
+from datasets.storage import get_storage_backend, imread, imsize
+from datasets.bucket_sampler import get_bucket, fit_to_bucket
+
 
 class CustomDataset(Dataset):
     """Custom dataset.
@@ -25,35 +33,106 @@ class CustomDataset(Dataset):
     Each line in `prompt.json` should be in the following format:
         {"source": "source/0000.jpg", "target": "target/0000.jpg", "prompt": "The quick brown fox jumps over the lazy dog."}
 
+    If `latent_cache` points to a cache made by `scripts/tool_cache_latents.py`, the images are not read at all
+    and the items carry `jpg_latent` / `hint_latent` instead of `jpg` / `hint`. A dataset generated by
+    `scripts/generate_latents.py` only has the latents of its targets (no `target` directory): the items carry
+    `jpg_latent` and the `hint` read from `source` as usual.
+    If `prompt_cache` points to a cache made by `scripts/tool_cache_prompts.py`, the items also carry `txt_idx`,
+    the row of the prompt embedding in that cache.
+    If `metadata_index` points to an index made by `scripts/tool_build_metadata_index.py`, the records are read
+    from its memory-mapped arrays instead of being parsed into a list of dicts at startup.
+    If `storage` points to a pack made by `scripts/tool_pack_dataset.py`, the images are read from the packed
+    shards (or LMDB) instead of loose files, and the records from the metadata index inside the pack.
+    If `uint8` is True, `jpg` and `hint` are returned as uint8 arrays and normalized on the device by the model,
+    which is 4x less data to send from the dataloader workers.
+    If `bucket_max_area` is set, the images are not resized to 512x512 but fitted to the bucket of their target
+    (their size floored to multiples of 64, scaled down to at most `bucket_max_area` pixels), see
+    `datasets/bucket_sampler.py`. The sizes are read from the image headers at startup, and `buckets` is meant
+    to be passed to a `BucketBatchSampler` so that the batches are made of images of the same bucket.
+
     """
-    def __init__(self, root: str, drop_rate: float = 0.0):
+    def __init__(self, root: str, drop_rate: float = 0.0, latent_cache: Optional[str] = None,
+                 prompt_cache: Optional[str] = None, metadata_index: Optional[str] = None,
+                 storage: Optional[str] = None, uint8: bool = False, bucket_max_area: Optional[int] = None,
+                 num_threads: int = 16):
         self.root = root
         self.drop_rate = drop_rate
+        self.uint8 = uint8
 
         root = os.path.expanduser(root)
-        if not os.path.isfile(os.path.join(root, 'prompt.jsonl')):
-            raise FileNotFoundError(f"{os.path.join(root, 'prompt.jsonl')} not found.")
-        if not os.path.isdir(os.path.join(root, 'source')):
-            raise FileNotFoundError(f"{os.path.join(root, 'source')} not found.")
-        if not os.path.isdir(os.path.join(root, 'target')):
-            raise FileNotFoundError(f"{os.path.join(root, 'target')} not found.")
-
-        self.data = []
+        self.storage = get_storage_backend(root, storage)
+        if metadata_index is None and storage is not None:
+            if os.path.isfile(os.path.join(os.path.expanduser(storage), 'metadata', 'meta.json')):
+                metadata_index = os.path.join(os.path.expanduser(storage), 'metadata')
+
+        # the loose files are not needed when both the records and the images are packed
+        if metadata_index is None or storage is None:
+            if not os.path.isfile(os.path.join(root, 'prompt.jsonl')):
+                raise FileNotFoundError(f"{os.path.join(root, 'prompt.jsonl')} not found.")
+            if not os.path.isdir(os.path.join(root, 'source')):
+                raise FileNotFoundError(f"{os.path.join(root, 'source')} not found.")
+            if latent_cache is None and not os.path.isdir(os.path.join(root, 'target')):
+                raise FileNotFoundError(f"{os.path.join(root, 'target')} not found.")
+
+        if metadata_index is not None:
+            # records were filtered once by scripts/tool_build_metadata_index.py
+            self.data = MetadataIndex(metadata_index)
+        else:
+            self.data = list(self.load_records(root))
+
+        self.latent_cache = None
+        if latent_cache is not None:
+            self.latent_cache = LatentCache(latent_cache)
+            if len(self.latent_cache) != len(self.data):
+                raise ValueError(f"Latent cache {latent_cache} has {len(self.latent_cache)} records, "
+                                 f"but the dataset has {len(self.data)}.")
+        self.prompt_cache = PromptCache(prompt_cache) if prompt_cache is not None else None
+
+        self.buckets = None
+        if bucket_max_area is not None:
+            if self.latent_cache is not None:
+                raise ValueError("Latents are cached at 512x512, they cannot be used with buckets.")
+            self.buckets = self.get_buckets(bucket_max_area, num_threads)
+
+    def get_buckets(self, max_area: int, num_threads: int = 16):
+        """(N, 2) array of the (height, width) bucket of each item, from the size of its target image."""
+        def get_size(idx):
+            return imsize(self.storage, self.data[idx]['target']) or (512, 512)
+
+        with ThreadPool(num_threads) as pool:
+            sizes = pool.map(get_size, range(len(self.data)), chunksize=256)
+        return np.array([get_bucket(h, w, max_area) for h, w in sizes], dtype=np.int32).reshape(-1, 2)
+
+    @staticmethod
+    def load_records(root: str):
+        """Yield the records of `prompt.jsonl` whose source and target images exist (the target is not checked
+        if there is no `target` directory, i.e., the targets are only stored as latents)."""
+        root = os.path.expanduser(root)
         source_files = set(os.listdir(os.path.join(root, 'source')))
-        target_files = set(os.listdir(os.path.join(root, 'target')))
+        target_files = None
+        if os.path.isdir(os.path.join(root, 'target')):
+            target_files = set(os.listdir(os.path.join(root, 'target')))
         with open(os.path.join(root, 'prompt.jsonl'), 'rt') as f:
             for line in f:
                 data = json.loads(line)
                 if data['source'].removeprefix('source/') not in source_files:
                     continue
-                if data['target'].removeprefix('target/') not in target_files:
+                if target_files is not None and data['target'].removeprefix('target/') not in target_files:
                     continue
-                self.data.append(data)
-        del source_files, target_files
+                yield data
 
     def __len__(self):
         return len(self.data)
 
+    def read_source(self, source_filename: str):
+        """The hint of a generated dataset, resized to the 512x512 of its latents and normalized as usual."""
+        source = imread(self.storage, source_filename, cv2.IMREAD_COLOR)
+        source = cv2.cvtColor(source, cv2.COLOR_BGR2RGB)
+        source = cv2.resize(source, (512, 512), interpolation=cv2.INTER_LINEAR)
+        if self.uint8:
+            return source
+        return source.astype(np.float32) / 255.0
+
     def __getitem__(self, idx):
         item: dict = self.data[idx]
 
@@ -64,14 +143,25 @@ class CustomDataset(Dataset):
         if np.random.rand() < self.drop_rate:
             prompt = ''
 
+        extra = dict()
+        if self.prompt_cache is not None:
+            extra['txt_idx'] = self.prompt_cache.index(prompt)
+
+        if self.latent_cache is not None:
+            jpg_latent = self.latent_cache.get('jpg', idx)
+            if 'hint' not in self.latent_cache.keys:
+                return dict(jpg_latent=jpg_latent, txt=prompt, hint=self.read_source(source_filename), **extra)
+            hint_latent = self.latent_cache.get('hint', idx)
+            return dict(jpg_latent=jpg_latent, txt=prompt, hint_latent=hint_latent, **extra)
+
         # source = cv2.imread(os.path.join(self.root, source_filename))
         # target = cv2.imread(os.path.join(self.root, target_filename))
 
         # # Do not forget that OpenCV read images in BGR order.
         # source = cv2.cvtColor(source, cv2.COLOR_BGR2RGB)
         # target = cv2.cvtColor(target, cv2.COLOR_BGR2RGB)
-        source = cv2.imread(os.path.join(self.root, source_filename), cv2.IMREAD_UNCHANGED)  # BGR or BGRA
-        target = cv2.imread(os.path.join(self.root, target_filename), cv2.IMREAD_UNCHANGED)  # BGR or BGRA
+        source = imread(self.storage, source_filename, cv2.IMREAD_UNCHANGED)  # BGR or BGRA
+        target = imread(self.storage, target_filename, cv2.IMREAD_UNCHANGED)  # BGR or BGRA
 
         # 如果 source 是 RGBA（4通道），去掉 alpha 通道
         if source.ndim == 3 and source.shape[2] == 4:
@@ -86,18 +176,27 @@ class CustomDataset(Dataset):
         target = cv2.cvtColor(target, cv2.COLOR_BGR2RGB)
 
         # 调整大小
-        source = cv2.resize(source, (512, 512), interpolation=cv2.INTER_LINEAR)
-        target = cv2.resize(target, (512, 512), interpolation=cv2.INTER_LINEAR)
+        if self.buckets is not None:
+            bucket = tuple(self.buckets[idx])
+            source = fit_to_bucket(source, bucket)
+            target = fit_to_bucket(target, bucket)
+        else:
+            source = cv2.resize(source, (512, 512), interpolation=cv2.INTER_LINEAR)
+            target = cv2.resize(target, (512, 512), interpolation=cv2.INTER_LINEAR)
 
         # print("custom dataset after source:{} target:{}".format(source.shape,target.shape))
 
+        if self.uint8:
+            # normalized to [0, 1] / [-1, 1] on the device, see ldm.util.images_to_float
+            return dict(jpg=target, txt=prompt, hint=source, **extra)
+
         # Normalize source images to [0, 1].
         source = source.astype(np.float32) / 255.0
 
         # Normalize target images to [-1, 1].
         target = (target.astype(np.float32) / 127.5) - 1.0
 
-        return dict(jpg=target, txt=prompt, hint=source)
+        return dict(jpg=target, txt=prompt, hint=source, **extra)
 
 
 def _test():
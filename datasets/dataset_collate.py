@@ -8,83 +8,69 @@ The License of UniControl is as follows:
  * For full license text, see LICENSE.txt file in the repo root or http://www.apache.org/licenses/
  * By Can Qin
  * Modified from: https://github.com/hughperkins/pytorch-pytorch/blob/master/torch/utils/data/dataloader.py
-"""
 
-import sys
+Modified to not depend on `torch._six` (removed in recent PyTorch), to stack into shared memory when called
+in a dataloader worker, and to keep the dtype of the arrays, so that uint8 images (see `uint8=True` of the
+datasets) cross the worker queues at a quarter of the size and are normalized on the device by the model.
+"""
 
-sys.path.append('./')
-import torch
 import re
 import collections.abc as container_abcs
-from torch._six import string_classes
-import pdb
 
-int_classes = int
+import numpy as np
+import torch
+from torch.utils.data import get_worker_info
 
-_use_shared_memory = False
-r"""Whether to use shared memory in default_collate"""
 
 np_str_obj_array_pattern = re.compile(r'[SaUO]')
 
 error_msg_fmt = "batch must contain tensors, numbers, dicts or lists; found {}"
 
-numpy_type_map = {
-    'float64': torch.DoubleTensor,
-    'float32': torch.FloatTensor,
-    'float16': torch.HalfTensor,
-    'int64': torch.LongTensor,
-    'int32': torch.IntTensor,
-    'int16': torch.ShortTensor,
-    'int8': torch.CharTensor,
-    'uint8': torch.ByteTensor,
-}
+# items whose image is None (unreadable) are dropped from the batch
+IMAGE_KEYS = ('jpg', 'hint', 'jpg_latent', 'hint_latent')
+
+
+def stack(tensors):
+    out = None
+    if get_worker_info() is not None:
+        # In a background process, stack directly into a shared memory tensor to avoid an extra copy
+        # when the batch is sent to the main process
+        elem = tensors[0]
+        numel = sum(x.numel() for x in tensors)
+        storage = elem.storage()._new_shared(numel)
+        out = elem.new(storage).resize_(len(tensors), *elem.shape)
+    return torch.stack(tensors, 0, out=out)
+
 
 def collate_fn(batch):
-    '''
-     collate_fn (callable, optional): merges a list of samples to form a mini-batch.
-    :param batch:
-    :return:
-    '''
     r"""Puts each data field into a tensor with outer dimension batch size"""
-    if isinstance(batch, list) and isinstance(batch[0], dict):
-        batch = [dic for dic in batch if dic["jpg"] is not None and dic["hint"] is not None]
-    if batch==[]:
+    if isinstance(batch, list) and len(batch) > 0 and isinstance(batch[0], container_abcs.Mapping):
+        batch = [dic for dic in batch if all(dic[k] is not None for k in IMAGE_KEYS if k in dic)]
+    if len(batch) == 0:
         return None
 
-    elem_type = type(batch[0])
-    if isinstance(batch[0], torch.Tensor):
-        out = None
-        if _use_shared_memory:
-            # If we're in a background process, concatenate directly into a
-            # shared memory tensor to avoid an extra copy
-            numel = sum([x.numel() for x in batch])
-            storage = batch[0].storage()._new_shared(numel)
-            out = batch[0].new(storage)
-        return torch.stack(batch, 0, out=out)
-    elif elem_type.__module__ == 'numpy' and elem_type.__name__ != 'str_' \
-            and elem_type.__name__ != 'string_':
-        elem = batch[0]
-        if elem_type.__name__ == 'ndarray':
-            # array of string classes and object
-            if np_str_obj_array_pattern.search(elem.dtype.str) is not None:
-                raise TypeError(error_msg_fmt.format(elem.dtype))
-
-            return collate_fn([torch.from_numpy(b) for b in batch])
-        if elem.shape == ():  # scalars
-            py_type = float if elem.dtype.name.startswith('float') else int
-            return numpy_type_map[elem.dtype.name](list(map(py_type, batch)))
-    elif isinstance(batch[0], float):
+    elem = batch[0]
+    if isinstance(elem, torch.Tensor):
+        return stack(batch)
+    elif isinstance(elem, np.ndarray):
+        # array of string classes and object
+        if np_str_obj_array_pattern.search(elem.dtype.str) is not None:
+            raise TypeError(error_msg_fmt.format(elem.dtype))
+        return stack([torch.from_numpy(b) for b in batch])
+    elif isinstance(elem, np.generic) and not isinstance(elem, (np.str_, np.bytes_)):  # numpy scalars
+        return torch.from_numpy(np.array(batch))
+    elif isinstance(elem, float):
         return torch.tensor(batch, dtype=torch.float64)
-    elif isinstance(batch[0], int_classes):
+    elif isinstance(elem, int):
         return torch.tensor(batch)
-    elif isinstance(batch[0], string_classes):
+    elif isinstance(elem, (str, bytes)):
         return batch
-    elif isinstance(batch[0], container_abcs.Mapping):
-        return {key: collate_fn([d[key] for d in batch]) for key in batch[0]}
-    elif isinstance(batch[0], tuple) and hasattr(batch[0], '_fields'):  # namedtuple
-        return type(batch[0])(*(collate_fn(samples) for samples in zip(*batch)))
-    elif isinstance(batch[0], container_abcs.Sequence):
-        transposed = zip(*batch)#ok
+    elif isinstance(elem, container_abcs.Mapping):
+        return {key: collate_fn([d[key] for d in batch]) for key in elem}
+    elif isinstance(elem, tuple) and hasattr(elem, '_fields'):  # namedtuple
+        return type(elem)(*(collate_fn(samples) for samples in zip(*batch)))
+    elif isinstance(elem, container_abcs.Sequence):
+        transposed = zip(*batch)
         return [collate_fn(samples) for samples in transposed]
 
-    raise TypeError((error_msg_fmt.format(type(batch[0]))))
+    raise TypeError((error_msg_fmt.format(type(elem))))
@@ -0,0 +1,162 @@
+"""
+Precomputed first stage (VAE) latents for the training datasets.
+
+The first stage model is frozen, so the posterior of every target (`jpg`) and hint image only needs
+to be computed once. `scripts/tool_cache_latents.py` writes them with `LatentCacheWriter`, and
+`CustomDataset` / `MultiGen20M` read them back with `LatentCache` when constructed with `latent_cache=...`.
+
+A cache directory looks like:
+
+    cache_dir
+    ├── meta.json
+    ├── jpg_00000.npy
+    ├── jpg_00001.npy
+    ├── ...
+    ├── hint_00000.npy
+    └── ...
+
+Each shard is a float16 `.npy` array of shape (shard_size, C, h, w), where record i of the dataset
+lives at row i % shard_size of shard i // shard_size. With `mode='moments'`, C = 2 * z_channels and
+the rows hold the posterior parameters (mean, logvar) so that a fresh z can be sampled at every step,
+exactly as `DiagonalGaussianDistribution` would. With `mode='sample'`, C = z_channels and the rows hold
+a single sampled z. In both cases `scale_factor` is NOT applied.
+
+`scripts/generate_latents.py` writes the generated samples in the same format (key `jpg` only, `mode='sample'`),
+so that a synthetic dataset can be finetuned on without decoding it, and `LazyDecodedDataset` decodes the
+latents back into RGB in batches when the images are needed.
+"""
+
+import os
+import json
+import numpy as np
+import torch
+
+
+META_FILE = 'meta.json'
+
+
+class LatentCacheWriter:
+    def __init__(self, root: str, length: int, latent_shape, keys=('jpg', 'hint'), mode: str = 'moments', shard_size: int = 4096,
+                 extra: dict = None):
+        assert mode in ['moments', 'sample'], f'Unknown latent cache mode: {mode}'
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.meta = dict(
+            length=int(length), keys=list(keys), latent_shape=[int(s) for s in latent_shape],
+            mode=mode, shard_size=int(shard_size), dtype='float16',
+        )
+        # e.g., how the latents were made, kept in meta.json for reference
+        self.meta.update(extra or dict())
+        self.shards = {}
+
+    def _get_shard(self, key: str, shard_idx: int):
+        if (key, shard_idx) not in self.shards:
+            # shards are filled sequentially, flush the ones we are done with
+            for k, i in list(self.shards.keys()):
+                if k == key and i < shard_idx:
+                    self.shards.pop((k, i)).flush()
+            shard_size, length = self.meta['shard_size'], self.meta['length']
+            n = min(shard_size, length - shard_idx * shard_size)
+            path = os.path.join(self.root, f'{key}_{shard_idx:05d}.npy')
+            self.shards[(key, shard_idx)] = np.lib.format.open_memmap(
+                path, mode='w+', dtype=np.float16, shape=(n, *self.meta['latent_shape']),
+            )
+        return self.shards[(key, shard_idx)]
+
+    def write(self, key: str, start: int, latents: np.ndarray):
+        """Write a batch of latents of shape (B, C, h, w) to records [start, start + B)."""
+        assert key in self.meta['keys'], f'Unknown key: {key}'
+        assert start + len(latents) <= self.meta['length']
+        for i, latent in enumerate(latents):
+            shard_idx, offset = divmod(start + i, self.meta['shard_size'])
+            self._get_shard(key, shard_idx)[offset] = latent
+
+    def close(self):
+        for shard in self.shards.values():
+            shard.flush()
+        self.shards.clear()
+        # meta.json is written last, so an interrupted run does not leave a cache that looks complete
+        with open(os.path.join(self.root, META_FILE), 'w') as f:
+            json.dump(self.meta, f, indent=2)
+
+
+class LatentCache:
+    def __init__(self, root: str):
+        root = os.path.expanduser(root)
+        if not os.path.isfile(os.path.join(root, META_FILE)):
+            raise FileNotFoundError(f"{os.path.join(root, META_FILE)} not found.")
+        with open(os.path.join(root, META_FILE), 'rt') as f:
+            self.meta = json.load(f)
+        self.root = root
+        self.keys = self.meta['keys']
+        self.mode = self.meta['mode']
+        self.shard_size = self.meta['shard_size']
+        # shards are memory-mapped lazily, so that each dataloader worker maps its own views
+        self.shards = {}
+
+    def __len__(self):
+        return self.meta['length']
+
+    def get(self, key: str, idx: int) -> np.ndarray:
+        shard_idx, offset = divmod(idx, self.shard_size)
+        shard = self.shards.get((key, shard_idx))
+        if shard is None:
+            path = os.path.join(self.root, f'{key}_{shard_idx:05d}.npy')
+            shard = self.shards[(key, shard_idx)] = np.load(path, mmap_mode='r')
+        return np.array(shard[offset])
+
+
+class LazyDecodedDataset:
+    """
+    RGB images of the latents of a cache, decoded by the first stage model only when they are accessed.
+
+    Indexing decodes the whole aligned batch around the index and keeps it, so that sequential access (a loop,
+    or a non-shuffled DataLoader with num_workers=0) runs one decode per `batch_size` images. `decode(indices)`
+    decodes arbitrary records in batches. The images are h x w x 3 uint8 RGB numpy arrays.
+
+    `first_stage_model` is the AutoencoderKL of the model the latents were made with, e.g.,
+    `model.first_stage_model`; it runs on its own device, in `dtype` (float16 by default on GPU).
+    """
+    def __init__(self, latent_cache, first_stage_model, key: str = 'jpg', batch_size: int = 16, dtype=None):
+        self.cache = latent_cache if isinstance(latent_cache, LatentCache) else LatentCache(latent_cache)
+        assert key in self.cache.keys, f'Unknown key: {key}'
+        self.first_stage_model = first_stage_model
+        self.key = key
+        self.batch_size = batch_size
+        self.device = next(first_stage_model.parameters()).device
+        self.dtype = dtype or (torch.float16 if self.device.type == 'cuda' else torch.float32)
+        self._batch_start, self._batch = None, None
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __getitem__(self, idx: int) -> np.ndarray:
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        start = idx - idx % self.batch_size
+        if self._batch_start != start:
+            self._batch = self.decode(range(start, min(start + self.batch_size, len(self))))
+            self._batch_start = start
+        return self._batch[idx - start]
+
+    def __iter__(self):
+        for start in range(0, len(self), self.batch_size):
+            yield from self.decode(range(start, min(start + self.batch_size, len(self))))
+
+    @torch.no_grad()
+    def decode(self, indices) -> np.ndarray:
+        """Decode the records `indices`, returns an array of shape (len(indices), h, w, 3)."""
+        indices = list(indices)
+        images = []
+        for i in range(0, len(indices), self.batch_size):
+            z = np.stack([self.cache.get(self.key, idx) for idx in indices[i:i + self.batch_size]])
+            z = torch.from_numpy(z).to(self.device)
+            if self.cache.mode == 'moments':
+                z = torch.chunk(z, 2, dim=1)[0]  # the posterior mean
+            with torch.autocast(self.device.type, dtype=self.dtype, enabled=self.dtype != torch.float32):
+                x = self.first_stage_model.decode(z.float())
+            x = (x.float().permute(0, 2, 3, 1) * 127.5 + 127.5).clamp(0, 255).to(torch.uint8)
+            images.append(x.cpu().numpy())
+        return np.concatenate(images) if images else np.empty((0, 0, 0, 3), dtype=np.uint8)
@@ -10,71 +10,137 @@ The License of UniControl is as follows:
 """
 
 import math
-import numpy as np
+from collections import deque
+from typing import Optional, Sequence
 
-from torch.utils.data import Sampler, RandomSampler, SequentialSampler, DistributedSampler
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import Sampler
 
 
 class BatchSchedulerSampler(Sampler):
     """
     iterate over tasks and provide a random batch per task in each mini-batch
+
+    Indices are generated lazily: each task keeps a permutation of its own indices (sharded across ranks) and a
+    position in it, and the task of each batch is derived from (seed, epoch, batch index). Therefore the sampler
+    can be saved with `state_dict()` and resumed mid-epoch with `load_state_dict()`, see `SamplerStateCallback`.
+
+    By default every task contributes one batch per round (in random order), so smaller tasks are oversampled
+    to the size of the largest one, as in UniControl. With `weights`, the task of each batch is drawn with the
+    given probabilities instead.
     """
-    def __init__(self, dataset, batch_size, distributed: bool = True, shuffle: bool = True):
+    def __init__(self, dataset, batch_size, distributed: bool = True, shuffle: bool = True,
+                 weights: Optional[Sequence[float]] = None, seed: int = 0, history_size: int = 4096):
         self.dataset = dataset
         self.batch_size = batch_size
         self.distributed = distributed
         self.shuffle = shuffle
+        self.seed = seed
 
         self.number_of_datasets = len(dataset.datasets)
-        self.largest_dataset_size = max([len(cur_dataset) for cur_dataset in dataset.datasets])
+        self.dataset_sizes = [len(cur_dataset) for cur_dataset in dataset.datasets]
+        self.largest_dataset_size = max(self.dataset_sizes)
+        self.push_index_val = [0] + [int(size) for size in dataset.cumulative_sizes[:-1]]
+        self.batches_per_epoch = math.ceil(self.largest_dataset_size / self.batch_size) * self.number_of_datasets
+
+        self.weights = None
+        if weights is not None:
+            weights = np.asarray(weights, dtype=np.float64)
+            if len(weights) != self.number_of_datasets or (weights < 0).any() or weights.sum() <= 0:
+                raise ValueError(f'Expect {self.number_of_datasets} non-negative task weights, got {weights}')
+            self.weights = weights / weights.sum()
+
+        # resumable state: position in the epoch, and (permutation epoch, position) of each task
+        self.epoch = 0
+        self.batch_idx = 0
+        self.task_epochs = np.zeros(self.number_of_datasets, dtype=np.int64)
+        self.task_pos = np.zeros(self.number_of_datasets, dtype=np.int64)
+
+        # state before each yielded batch, to rewind the batches prefetched by the dataloader but not trained on
+        self._num_yielded = 0
+        self._history = deque(maxlen=history_size)
+        self._perms = dict()
 
     def __len__(self):
-        return self.batch_size * math.ceil(self.largest_dataset_size / self.batch_size) * len(self.dataset.datasets)
+        return self.batch_size * self.batches_per_epoch
 
-    def __iter__(self):
-        samplers_list = []
-        sampler_iterators = []
-        for dataset_idx in range(self.number_of_datasets):
-            cur_dataset = self.dataset.datasets[dataset_idx]
-            if not self.distributed:
-                if self.shuffle:
-                    sampler = RandomSampler(cur_dataset)
-                else:
-                    sampler = SequentialSampler(cur_dataset)
-            else:
-                sampler = DistributedSampler(cur_dataset, shuffle=self.shuffle)
-            samplers_list.append(sampler)
-            cur_sampler_iterator = sampler.__iter__()
-            sampler_iterators.append(cur_sampler_iterator)
-
-        push_index_val = [0] + self.dataset.cumulative_sizes[:-1]
-        step = self.batch_size * self.number_of_datasets
-        samples_to_grab = self.batch_size
-        # for this case we want to get all samples in dataset, this force us to resample from the smaller datasets
-        epoch_samples = self.largest_dataset_size * self.number_of_datasets
-
-        final_samples_list = []  # this is a list of indexes from the combined dataset
-        for _ in range(0, epoch_samples, step):
+    def _get_rank(self):
+        if self.distributed and dist.is_available() and dist.is_initialized():
+            return dist.get_rank(), dist.get_world_size()
+        return 0, 1
+
+    def _get_perm(self, task: int, task_epoch: int, rank: int, world_size: int):
+        """The indices of `task` for this rank in the given pass over the task."""
+        key = (task, task_epoch)
+        if key not in self._perms:
+            n = self.dataset_sizes[task]
             if self.shuffle:
-                perm = np.random.permutation(self.number_of_datasets)
+                perm = np.random.default_rng([self.seed, task, task_epoch]).permutation(n)
             else:
-                perm = np.arange(self.number_of_datasets)
-            for i in perm:
-                cur_batch_sampler = sampler_iterators[i]
-                cur_samples = []
-                for _ in range(samples_to_grab):  # batch with one task/dataset
-                    try:
-                        cur_sample_org = cur_batch_sampler.__next__()
-                        cur_sample = cur_sample_org + push_index_val[i]
-                        cur_samples.append(cur_sample)
-                    except StopIteration:
-                        # got to the end of iterator - restart the iterator and continue to get samples
-                        # until reaching "epoch_samples"
-                        sampler_iterators[i] = samplers_list[i].__iter__()
-                        cur_batch_sampler = sampler_iterators[i]
-                        cur_sample_org = cur_batch_sampler.__next__()
-                        cur_sample = cur_sample_org + push_index_val[i]
-                        cur_samples.append(cur_sample)
-                final_samples_list.extend(cur_samples)
-
-        return iter(final_samples_list)
+                perm = np.arange(n)
+            # pad to a multiple of world_size by wrapping around, as DistributedSampler does
+            perm = np.resize(perm, math.ceil(n / world_size) * world_size)[rank::world_size]
+            self._perms = {k: v for k, v in self._perms.items() if k[0] != task}
+            self._perms[key] = perm.astype(np.int32 if n < 2 ** 31 else np.int64)
+        return self._perms[key]
+
+    def _get_task(self, epoch: int, batch_idx: int):
+        if self.weights is not None:
+            rng = np.random.default_rng([self.seed, epoch, batch_idx])
+            return int(rng.choice(self.number_of_datasets, p=self.weights))
+        rnd, i = divmod(batch_idx, self.number_of_datasets)
+        if self.shuffle:
+            perm = np.random.default_rng([self.seed, epoch, rnd]).permutation(self.number_of_datasets)
+        else:
+            perm = np.arange(self.number_of_datasets)
+        return int(perm[i])
+
+    def __iter__(self):
+        rank, world_size = self._get_rank()
+        while self.batch_idx < self.batches_per_epoch:
+            task = self._get_task(self.epoch, self.batch_idx)
+            self._history.append((self.epoch, self.batch_idx, task, int(self.task_epochs[task]), int(self.task_pos[task])))
+            self._num_yielded += 1
+            self.batch_idx += 1
+            for _ in range(self.batch_size):  # batch with one task/dataset
+                perm = self._get_perm(task, int(self.task_epochs[task]), rank, world_size)
+                if self.task_pos[task] >= len(perm):
+                    # got to the end of the task - continue with a new permutation of it
+                    self.task_epochs[task] += 1
+                    self.task_pos[task] = 0
+                    perm = self._get_perm(task, int(self.task_epochs[task]), rank, world_size)
+                yield int(perm[self.task_pos[task]]) + self.push_index_val[task]
+                self.task_pos[task] += 1
+        self.epoch += 1
+        self.batch_idx = 0
+
+    def state_dict(self, num_consumed: Optional[int] = None):
+        """
+        The state of the sampler. `num_consumed` is the number of batches actually trained on since the sampler
+        was constructed or loaded, the batches yielded beyond it (prefetched by the dataloader) are rewound.
+        """
+        epoch, batch_idx = self.epoch, self.batch_idx
+        task_epochs, task_pos = self.task_epochs.copy(), self.task_pos.copy()
+        rewind = 0 if num_consumed is None else self._num_yielded - num_consumed
+        if rewind < 0 or rewind > len(self._history):
+            raise ValueError(f'Cannot rewind {rewind} batches with a history of {len(self._history)}')
+        for i in range(rewind):
+            epoch, batch_idx, task, task_epoch, pos = self._history[-1 - i]
+            task_epochs[task], task_pos[task] = task_epoch, pos
+        return dict(
+            epoch=epoch, batch_idx=batch_idx, task_epochs=task_epochs.tolist(), task_pos=task_pos.tolist(),
+            seed=self.seed, batch_size=self.batch_size, dataset_sizes=self.dataset_sizes,
+        )
+
+    def load_state_dict(self, state_dict):
+        if state_dict['dataset_sizes'] != self.dataset_sizes or state_dict['batch_size'] != self.batch_size:
+            raise ValueError('The sampler state was saved with a different dataset or batch size')
+        self.epoch = state_dict['epoch']
+        self.batch_idx = state_dict['batch_idx']
+        self.seed = state_dict['seed']
+        self.task_epochs = np.asarray(state_dict['task_epochs'], dtype=np.int64)
+        self.task_pos = np.asarray(state_dict['task_pos'], dtype=np.int64)
+        self._num_yielded = 0
+        self._history.clear()
+        self._perms = dict()
@@ -9,6 +9,7 @@ The License of UniControl is as follows:
  * By Can Qin
 """
 
+import os
 import json
 import cv2
 import numpy as np
@@ -16,13 +17,28 @@ import numpy as np
 from torch.utils.data import Dataset
 import random
 
+from datasets.latent_cache import LatentCache
+from datasets.prompt_cache import PromptCache
+from datasets.metadata_index import MetadataIndex
+from datasets.storage import get_storage_backend, imread
+
 
 class MultiGen20M(Dataset):
-    def __init__(self, path_json, path_meta, task, drop_rate=0.3, random_cropping=True):
-        self.data = []
-        with open(path_json, 'rt') as f:
-            for line in f:
-                self.data.append(json.loads(line))
+    def __init__(self, path_json, path_meta, task, drop_rate=0.3, random_cropping=True, latent_cache=None,
+                 prompt_cache=None, metadata_index=None, storage=None, uint8=False):
+        # images are read from a pack made by scripts/tool_pack_dataset.py if given, otherwise from path_meta
+        self.storage = get_storage_backend(path_meta, storage)
+        if metadata_index is None and storage is not None:
+            if os.path.isfile(os.path.join(os.path.expanduser(storage), 'metadata', 'meta.json')):
+                metadata_index = os.path.join(os.path.expanduser(storage), 'metadata')
+        if metadata_index is not None:
+            # compact replacement of the list of dicts, see scripts/tool_build_metadata_index.py
+            self.data = MetadataIndex(metadata_index)
+        else:
+            self.data = []
+            with open(path_json, 'rt') as f:
+                for line in f:
+                    self.data.append(json.loads(line))
         self.path_meta = path_meta
         if task == 'hed':
             self.key_prompt = 'control_hed'
@@ -50,11 +66,24 @@ class MultiGen20M(Dataset):
             self.key_prompt = 'control_grayscale'
         else:
             print('TASK NOT MATCH')
+        if isinstance(self.data, MetadataIndex) and self.key_prompt not in self.data.fields:
+            raise ValueError(f"Field {self.key_prompt} not found in metadata index {metadata_index}.")
 
         self.resolution = 512
         self.none_loop = 0
         self.drop_rate = drop_rate
         self.random_cropping = random_cropping
+        # return uint8 images, normalized on the device by the model, see ldm.util.images_to_float
+        self.uint8 = uint8
+
+        # latents are cached with center cropping, see scripts/tool_cache_latents.py
+        self.latent_cache = None
+        if latent_cache is not None:
+            self.latent_cache = LatentCache(latent_cache)
+            if len(self.latent_cache) != len(self.data):
+                raise ValueError(f"Latent cache {latent_cache} has {len(self.latent_cache)} records, "
+                                 f"but the dataset has {len(self.data)}.")
+        self.prompt_cache = PromptCache(prompt_cache) if prompt_cache is not None else None
 
     def resize_image_control(self, control_image, resolution):
         H, W, C = control_image.shape
@@ -98,13 +127,23 @@ class MultiGen20M(Dataset):
         return len(self.data)
 
     def __getitem__(self, idx):
+        if self.latent_cache is not None:
+            prompt = self.data[idx]['prompt'] or ''
+            prompt = prompt if random.uniform(0, 1) > self.drop_rate else ''  # dropout prompt
+            jpg_latent = self.latent_cache.get('jpg', idx)
+            hint_latent = self.latent_cache.get('hint', idx)
+            item = dict(jpg_latent=jpg_latent, txt=prompt, hint_latent=hint_latent, task=self.key_prompt)
+            if self.prompt_cache is not None:
+                item['txt_idx'] = self.prompt_cache.index(prompt)
+            return item
+
         item = self.data[idx]
         source_filename = item[self.key_prompt]
-        source_img = cv2.imread(self.path_meta + "/conditions/" + source_filename)
+        source_img = imread(self.storage, "conditions/" + source_filename)
         target_filename = item['source']
         if "./" == target_filename[0:2]:
             target_filename = target_filename[2:]
-        target_img = cv2.imread(self.path_meta + "/images/" + target_filename)
+        target_img = imread(self.storage, "images/" + target_filename)
         prompt = item['prompt']
 
         while source_img is None or target_img is None or prompt is None:
@@ -115,11 +154,11 @@ class MultiGen20M(Dataset):
                 idx = 0
             item = self.data[idx]
             source_filename = item[self.key_prompt]
-            source_img = cv2.imread(self.path_meta + "/conditions/" + source_filename)
+            source_img = imread(self.storage, "conditions/" + source_filename)
             target_filename = item['source']
             if "./" == target_filename[0:2]:
                 target_filename = target_filename[2:]
-            target_img = cv2.imread(self.path_meta + "/images/" + target_filename)
+            target_img = imread(self.storage, "images/" + target_filename)
             prompt = item['prompt']
             self.none_loop += 1
             if self.none_loop > 10000:
@@ -132,11 +171,15 @@ class MultiGen20M(Dataset):
         source_img = cv2.cvtColor(source_img, cv2.COLOR_BGR2RGB)
         target_img = cv2.cvtColor(target_img, cv2.COLOR_BGR2RGB)
 
-        # Normalize source images to [0, 1].
-        source_img = source_img.astype(np.float32) / 255.0
+        if not self.uint8:
+            # Normalize source images to [0, 1].
+            source_img = source_img.astype(np.float32) / 255.0
 
-        # Normalize target images to [-1, 1].
-        target_img = (target_img.astype(np.float32) / 127.5) - 1.0
+            # Normalize target images to [-1, 1].
+            target_img = (target_img.astype(np.float32) / 127.5) - 1.0
 
         prompt = prompt if random.uniform(0, 1) > self.drop_rate else ''  # dropout prompt
-        return dict(jpg=target_img, txt=prompt, hint=source_img, task=self.key_prompt)
+        item = dict(jpg=target_img, txt=prompt, hint=source_img, task=self.key_prompt)
+        if self.prompt_cache is not None:
+            item['txt_idx'] = self.prompt_cache.index(prompt)
+        return item
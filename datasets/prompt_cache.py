@@ -0,0 +1,110 @@
+"""
+Precomputed text embeddings of the training prompts.
+
+The text encoder (CLIP) is frozen and the captions of a dataset come from a finite set, so each unique
+caption only needs to be encoded once. `scripts/tool_cache_prompts.py` writes the embeddings with
+`PromptCacheWriter`. `CustomDataset` / `MultiGen20M` constructed with `prompt_cache=...` add a `txt_idx`
+field to each item, and `LatentDiffusion.get_input` gathers the embeddings from a `PromptCache` assigned
+to `model.prompt_cache` instead of running the text encoder.
+
+A cache directory looks like:
+
+    cache_dir
+    ├── meta.json
+    ├── index.json          {sha1(prompt): row}
+    └── embeddings.npy      float16, (n_prompts, 77, 768)
+
+Prompts are deduplicated by the sha1 of their utf-8 encoding. Row 0 always holds the empty prompt,
+which is what the prompt dropout for classifier-free guidance produces.
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+
+
+META_FILE = 'meta.json'
+INDEX_FILE = 'index.json'
+EMBEDDINGS_FILE = 'embeddings.npy'
+EMPTY_PROMPT_IDX = 0
+
+
+def hash_prompt(prompt: str) -> str:
+    return hashlib.sha1(prompt.encode('utf-8')).hexdigest()
+
+
+def unique_prompts(prompts):
+    """Deduplicate prompts by hash, the empty prompt always comes first."""
+    seen = {hash_prompt('')}
+    unique = ['']
+    for prompt in prompts:
+        prompt = prompt or ''
+        h = hash_prompt(prompt)
+        if h not in seen:
+            seen.add(h)
+            unique.append(prompt)
+    return unique
+
+
+class PromptCacheWriter:
+    def __init__(self, root: str, prompts, embedding_shape=(77, 768)):
+        assert prompts[0] == '', 'The empty prompt must come first, use unique_prompts()'
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.prompts = prompts
+        self.meta = dict(length=len(prompts), embedding_shape=[int(s) for s in embedding_shape], dtype='float16')
+        self.embeddings = np.lib.format.open_memmap(
+            os.path.join(root, EMBEDDINGS_FILE), mode='w+', dtype=np.float16, shape=(len(prompts), *embedding_shape),
+        )
+
+    def write(self, start: int, embeddings: np.ndarray):
+        """Write the embeddings of prompts [start, start + B)."""
+        self.embeddings[start:start+len(embeddings)] = embeddings
+
+    def close(self):
+        self.embeddings.flush()
+        with open(os.path.join(self.root, INDEX_FILE), 'w') as f:
+            json.dump({hash_prompt(p): i for i, p in enumerate(self.prompts)}, f)
+        # meta.json is written last, so an interrupted run does not leave a cache that looks complete
+        with open(os.path.join(self.root, META_FILE), 'w') as f:
+            json.dump(self.meta, f, indent=2)
+
+
+class PromptCache:
+    def __init__(self, root: str):
+        root = os.path.expanduser(root)
+        if not os.path.isfile(os.path.join(root, META_FILE)):
+            raise FileNotFoundError(f"{os.path.join(root, META_FILE)} not found.")
+        with open(os.path.join(root, META_FILE), 'rt') as f:
+            self.meta = json.load(f)
+        with open(os.path.join(root, INDEX_FILE), 'rt') as f:
+            self.hash2idx = json.load(f)
+        self.root = root
+        # memory-mapped lazily, so that each dataloader worker maps its own view
+        self._embeddings = None
+
+    def __len__(self):
+        return self.meta['length']
+
+    @property
+    def embeddings(self):
+        if self._embeddings is None:
+            self._embeddings = np.load(os.path.join(self.root, EMBEDDINGS_FILE), mmap_mode='r')
+        return self._embeddings
+
+    def index(self, prompt: str) -> int:
+        if not prompt:
+            return EMPTY_PROMPT_IDX
+        h = hash_prompt(prompt)
+        if h not in self.hash2idx:
+            raise KeyError(f'Prompt not found in {self.root}, please rebuild the cache: {prompt!r}')
+        return self.hash2idx[h]
+
+    def gather(self, indices) -> np.ndarray:
+        """Embeddings of the given rows, of shape (len(indices), 77, 768)."""
+        return np.stack([self.embeddings[int(i)] for i in indices])
+
+    def empty(self, n: int) -> np.ndarray:
+        """Embeddings of n empty prompts."""
+        return np.repeat(self.embeddings[EMPTY_PROMPT_IDX:EMPTY_PROMPT_IDX+1], n, axis=0)
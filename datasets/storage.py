@@ -0,0 +1,254 @@
+"""
+Random-access storage backends for the training images.
+
+Reading two small loose files per sample is dominated by metadata operations on shared filesystems.
+`scripts/tool_pack_dataset.py` packs the images of a dataset (as their original encoded bytes) into a few
+large files, and the datasets read them through the same `get(key) -> bytes` interface as loose files.
+Keys are paths relative to the dataset root, e.g. `source/0000.jpg` or `images/aesthetics_6_plus_0/xxx.jpg`.
+
+The interface mirrors the storage backends of mmcv (`annotator/uniformer/mmcv/fileio/file_client.py`), which
+are not imported directly because importing them pulls in the whole uniformer segmentor.
+
+Two packed formats are supported:
+
+- `shards` (no extra dependency):
+
+      pack_dir
+      ├── meta.json
+      ├── shard_00000.bin     concatenated utf-8 keys and file contents, at most `shard_size` bytes each
+      ├── ...
+      ├── index_hash.npy      uint64, sorted 64-bit hashes of the keys
+      ├── index_shard.npy     int32, shard of each key
+      ├── index_offset.npy    int64, byte offset of the contents of each key in its shard
+      ├── index_length.npy    int64, byte length of the contents of each key
+      └── index_key_length.npy  int32, byte length of each key, stored right before its contents
+
+  A key is located by binary search over the memory-mapped hashes, so no per-key Python object is created,
+  and checked against the key stored in the shard, so that a hash collision never returns another file.
+
+- `lmdb`: one LMDB environment in `pack_dir/data.lmdb`, keys are the utf-8 encoded relative paths.
+
+Both formats may carry a `metadata` sub-directory with a `MetadataIndex` of the records.
+"""
+
+import io
+import os
+import json
+import hashlib
+from array import array
+from typing import Optional
+
+import cv2
+import numpy as np
+from PIL import Image
+
+
+META_FILE = 'meta.json'
+
+
+def hash_key(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class DiskBackend:
+    """Loose files under `root`."""
+    def __init__(self, root: str):
+        self.root = root
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            with open(os.path.join(self.root, key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+
+class PackedShardBackend:
+    def __init__(self, root: str):
+        with open(os.path.join(root, META_FILE), 'rt') as f:
+            self.meta = json.load(f)
+        assert self.meta['format'] == 'shards'
+        self.root = root
+        # memory-mapped lazily, so that each dataloader worker maps its own views
+        self._index = None
+        self._shards = dict()
+
+    def _load_index(self):
+        return tuple(
+            np.load(os.path.join(self.root, f'index_{name}.npy'), mmap_mode='r')
+            for name in ['hash', 'shard', 'offset', 'length', 'key_length']
+        )
+
+    def _get_shard(self, shard_idx: int):
+        if shard_idx not in self._shards:
+            path = os.path.join(self.root, f'shard_{shard_idx:05d}.bin')
+            self._shards[shard_idx] = np.memmap(path, dtype=np.uint8, mode='r')
+        return self._shards[shard_idx]
+
+    def get(self, key: str) -> Optional[bytes]:
+        if self._index is None:
+            self._index = self._load_index()
+        hashes, shards, offsets, lengths, key_lengths = self._index
+        key_bytes = key.encode('utf-8')
+        h = np.uint64(hash_key(key))
+        i = int(np.searchsorted(hashes, h))
+        # distinct keys sharing a hash are adjacent in the index
+        while i < len(hashes) and hashes[i] == h:
+            shard, offset = self._get_shard(int(shards[i])), int(offsets[i])
+            if int(key_lengths[i]) == len(key_bytes) and bytes(shard[offset-len(key_bytes):offset]) == key_bytes:
+                return bytes(shard[offset:offset+int(lengths[i])])
+            i += 1
+        return None
+
+
+class LmdbBackend:
+    def __init__(self, root: str):
+        self.root = root
+        # opened lazily, an lmdb environment must not be shared across forked workers
+        self._env = None
+
+    def get(self, key: str) -> Optional[bytes]:
+        if self._env is None:
+            try:
+                import lmdb
+            except ImportError:
+                raise ImportError('Please install lmdb to read packed datasets in lmdb format.')
+            self._env = lmdb.open(os.path.join(self.root, 'data.lmdb'), readonly=True, lock=False, readahead=False)
+        with self._env.begin(write=False) as txn:
+            value = txn.get(key.encode('utf-8'))
+        return bytes(value) if value is not None else None
+
+
+def get_storage_backend(root: str, pack: Optional[str] = None):
+    """A backend reading from the pack directory `pack` if given, otherwise from loose files under `root`."""
+    if pack is None:
+        return DiskBackend(root)
+    pack = os.path.expanduser(pack)
+    if not os.path.isfile(os.path.join(pack, META_FILE)):
+        raise FileNotFoundError(f"{os.path.join(pack, META_FILE)} not found.")
+    with open(os.path.join(pack, META_FILE), 'rt') as f:
+        fmt = json.load(f)['format']
+    if fmt == 'shards':
+        return PackedShardBackend(pack)
+    elif fmt == 'lmdb':
+        return LmdbBackend(pack)
+    raise ValueError(f'Unknown pack format: {fmt}')
+
+
+def imread(backend, key: str, flags=cv2.IMREAD_COLOR):
+    """Same as `cv2.imread(os.path.join(root, key), flags)`, returns None if the key is missing or not decodable."""
+    buf = backend.get(key)
+    if buf is None:
+        return None
+    return cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), flags)
+
+
+def imsize(backend, key: str):
+    """(height, width) of an image read from its header without decoding it, None if the key is missing."""
+    if isinstance(backend, DiskBackend):
+        fp = os.path.join(backend.root, key)  # PIL only reads the beginning of the file
+        if not os.path.isfile(fp):
+            return None
+    else:
+        buf = backend.get(key)
+        if buf is None:
+            return None
+        fp = io.BytesIO(buf)
+    try:
+        with Image.open(fp) as img:
+            width, height = img.size
+    except OSError:
+        return None
+    return height, width
+
+
+class PackedShardWriter:
+    def __init__(self, root: str, shard_size: int = 1 << 30):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.shard_size = shard_size
+        self.shard_idx = 0
+        self.shard_file = open(os.path.join(root, f'shard_{self.shard_idx:05d}.bin'), 'wb')
+        self.shard_pos = 0
+        # flat arrays instead of a dict, the index of MultiGen-20M has tens of millions of keys
+        self.hashes = array('Q')
+        self.shards = array('i')
+        self.offsets = array('q')
+        self.lengths = array('q')
+        self.key_lengths = array('i')
+
+    def add(self, key: str, data: bytes):
+        key_bytes = key.encode('utf-8')
+        size = len(key_bytes) + len(data)
+        if self.shard_pos > 0 and self.shard_pos + size > self.shard_size:
+            self.shard_file.close()
+            self.shard_idx += 1
+            self.shard_file = open(os.path.join(self.root, f'shard_{self.shard_idx:05d}.bin'), 'wb')
+            self.shard_pos = 0
+        self.shard_file.write(key_bytes)
+        self.shard_file.write(data)
+        self.hashes.append(hash_key(key))
+        self.shards.append(self.shard_idx)
+        self.offsets.append(self.shard_pos + len(key_bytes))
+        self.lengths.append(len(data))
+        self.key_lengths.append(len(key_bytes))
+        self.shard_pos += size
+
+    def _read_key(self, idx: int) -> bytes:
+        with open(os.path.join(self.root, f'shard_{self.shards[idx]:05d}.bin'), 'rb') as f:
+            f.seek(self.offsets[idx] - self.key_lengths[idx])
+            return f.read(self.key_lengths[idx])
+
+    def close(self):
+        self.shard_file.close()
+        hashes = np.frombuffer(self.hashes, dtype=np.uint64)
+        # stable sort, so that the first occurrence of a duplicated key is kept
+        order = np.argsort(hashes, kind='stable')
+        hashes = hashes[order]
+        keep = np.ones(len(hashes), dtype=bool)
+        # equal hashes are almost always the same key added twice, the stored keys tell them from collisions
+        seen = dict()  # hash -> keys kept so far among the entries with this hash
+        for j in np.flatnonzero(hashes[1:] == hashes[:-1]) + 1:
+            h = int(hashes[j])
+            if h not in seen:
+                seen[h] = {self._read_key(int(order[j - 1]))}
+            key_bytes = self._read_key(int(order[j]))
+            if key_bytes in seen[h]:
+                keep[j] = False
+            else:
+                seen[h].add(key_bytes)
+        if not keep.all():
+            print(f'Warning: {(~keep).sum()} duplicated keys are ignored')
+        order = order[keep]
+        np.save(os.path.join(self.root, 'index_hash.npy'), hashes[keep])
+        np.save(os.path.join(self.root, 'index_shard.npy'), np.frombuffer(self.shards, dtype=np.int32)[order])
+        np.save(os.path.join(self.root, 'index_offset.npy'), np.frombuffer(self.offsets, dtype=np.int64)[order])
+        np.save(os.path.join(self.root, 'index_length.npy'), np.frombuffer(self.lengths, dtype=np.int64)[order])
+        np.save(os.path.join(self.root, 'index_key_length.npy'), np.frombuffer(self.key_lengths, dtype=np.int32)[order])
+        with open(os.path.join(self.root, META_FILE), 'w') as f:
+            json.dump(dict(format='shards', length=int(keep.sum()), n_shards=self.shard_idx + 1), f, indent=2)
+
+
+class LmdbWriter:
+    def __init__(self, root: str, map_size: int = 1 << 40, commit_every: int = 1000):
+        import lmdb
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.env = lmdb.open(os.path.join(root, 'data.lmdb'), map_size=map_size)
+        self.txn = self.env.begin(write=True)
+        self.commit_every = commit_every
+        self.length = 0
+
+    def add(self, key: str, data: bytes):
+        if not self.txn.put(key.encode('utf-8'), data, overwrite=False):
+            return  # duplicated key, keep the first occurrence
+        self.length += 1
+        if self.length % self.commit_every == 0:
+            self.txn.commit()
+            self.txn = self.env.begin(write=True)
+
+    def close(self):
+        self.txn.commit()
+        self.env.close()
+        with open(os.path.join(self.root, META_FILE), 'w') as f:
+            json.dump(dict(format='lmdb', length=self.length), f, indent=2)
@@ -3,10 +3,8 @@ from PIL import Image
 from api import CtrLoRA
 import tempfile
 import os
-import torch
-import pyiqa
-from utils import util_image
 import time
+from utils.iqa import IQAService
 
 # 初始化模型
 ctrlora = CtrLoRA(num_loras=1)
@@ -17,41 +15,7 @@ ctrlora.create_model(
 )
 
 # 初始化 IQA 模型
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-metric_dict = {
-    "CLIP-IQA": pyiqa.create_metric('clipiqa').to(device),
-    "MUSIQ": pyiqa.create_metric('musiq').to(device),
-    "NIQE": pyiqa.create_metric('niqe').to(device),
-    "BRISQUE": pyiqa.create_metric('brisque').to(device),
-    "NRQM": pyiqa.create_metric('nrqm').to(device),
-}
-metric_paired_dict = {
-    "PSNR": pyiqa.create_metric('psnr', test_y_channel=True, color_space='ycbcr').to(device),
-    "SSIM": pyiqa.create_metric('ssim', test_y_channel=True, color_space='ycbcr').to(device),
-    "LPIPS": pyiqa.create_metric('lpips').to(device),
-    "ST-LPIPS": pyiqa.create_metric('stlpips').to(device),
-}
-
-def evaluate_image(gen_img_path, gt_img_path=None):
-    results = {}
-    try:
-        im_in = util_image.imread(gen_img_path, chn='rgb', dtype='float32')
-        im_in_tensor = util_image.img2tensor(im_in).to(device)
-
-        for key, metric in metric_dict.items():
-            with torch.cuda.amp.autocast():
-                results[key] = metric(im_in_tensor).item()
-
-        if gt_img_path:
-            im_ref = util_image.imread(gt_img_path, chn='rgb', dtype='float32')
-            im_ref_tensor = util_image.img2tensor(im_ref).to(device)
-            for key, metric in metric_paired_dict.items():
-                with torch.cuda.amp.autocast():
-                    results[key] = metric(im_in_tensor, im_ref_tensor).item()
-    except Exception as e:
-        results["Error"] = str(e)
-
-    return results
+iqa = IQAService(cache_file='/home/xxu/cvpr/wacv/ctrlora/demo_output/iqa_cache.json')
 
 def generate_and_evaluate(cond_image: Image.Image, prompt: str, gt_image: Image.Image = None):
     # 创建输出目录
@@ -72,19 +36,21 @@ def generate_and_evaluate(cond_image: Image.Image, prompt: str, gt_image: Image.
         num_samples=1,
     )
     gen_img = samples[0].convert("RGB")
-    gen_img_path = os.path.join(output_dir, f"{timestamp}_gen.png")
-    gen_img.save(gen_img_path)
-
-    # 保存 GT 图像（如果提供）
-    gt_img_path = None
     if gt_image:
         gt_image = gt_image.convert("RGB")
-        gt_img_path = os.path.join(output_dir, f"{timestamp}_gt.png")
-        gt_image.save(gt_img_path)
 
-    # 计算评估指标
-    results = evaluate_image(gen_img_path, gt_img_path)
-    results_str = "\n".join(f"{k}: {v:.4f}" for k, v in results.items())
+    # 计算评估指标（在后台进行，同时保存图像）
+    future = iqa.submit([gen_img], [gt_image])
+    gen_img.save(os.path.join(output_dir, f"{timestamp}_gen.png"))
+    if gt_image:
+        gt_image.save(os.path.join(output_dir, f"{timestamp}_gt.png"))
+
+    try:
+        results = future.result()[0]
+    except Exception as e:
+        results = {"Error": str(e)}
+    iqa.save_cache()
+    results_str = "\n".join(f"{k}: {v:.4f}" if not isinstance(v, str) else f"{k}: {v}" for k, v in results.items())
 
     return gen_img, results_str
 
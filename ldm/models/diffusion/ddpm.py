@@ -20,7 +20,7 @@ from torchvision.utils import make_grid
 from pytorch_lightning.utilities.distributed import rank_zero_only
 from omegaconf import ListConfig
 
-from ldm.util import log_txt_as_img, exists, default, ismap, isimage, mean_flat, count_params, instantiate_from_config
+from ldm.util import log_txt_as_img, exists, default, ismap, isimage, mean_flat, count_params, instantiate_from_config, images_to_float
 from ldm.modules.ema import LitEma
 from ldm.modules.distributions.distributions import normal_kl, DiagonalGaussianDistribution
 from ldm.models.autoencoder import IdentityFirstStage, AutoencoderKL
@@ -77,6 +77,7 @@ class DDPM(pl.LightningModule):
                  ucg_training=None,
                  reset_ema=False,
                  reset_num_ema_updates=False,
+                 ema_config=None,
                  ):
         super().__init__()
         assert parameterization in ["eps", "x0", "v"], 'currently only supporting "eps" and "x0" and "v"'
@@ -92,8 +93,11 @@ class DDPM(pl.LightningModule):
         self.model = DiffusionWrapper(unet_config, conditioning_key)
         count_params(self.model, verbose=True)
         self.use_ema = use_ema
+        self.ema_config = ema_config or {}  # extra LitEma arguments, e.g. offload / update_every
+        # times the stages of the training step when set, see `profile_stage` and cldm.logger.StageProfiler
+        self.stage_profiler = None
         if self.use_ema:
-            self.model_ema = LitEma(self.model)
+            self.model_ema = LitEma(self.model, **self.ema_config)
             print(f"Keeping EMAs of {len(list(self.model_ema.buffers()))}.")
 
         self.use_scheduler = scheduler_config is not None
@@ -113,7 +117,7 @@ class DDPM(pl.LightningModule):
             if reset_ema:
                 assert self.use_ema
                 print(f"Resetting ema to pure model weights. This is useful when restoring from an ema-only checkpoint.")
-                self.model_ema = LitEma(self.model)
+                self.model_ema = LitEma(self.model, **self.ema_config)
         if reset_num_ema_updates:
             print(" +++++++++++ WARNING: RESETTING NUM_EMA UPDATES TO ZERO +++++++++++ ")
             assert self.use_ema
@@ -420,12 +424,16 @@ class DDPM(pl.LightningModule):
         x = batch[k]
         if len(x.shape) == 3:
             x = x[..., None]
+        if x.dtype == torch.uint8:
+            # images in [-1, 1] are sent as uint8 by the dataloader and normalized on the device
+            return images_to_float(x, self.device, value_range=(-1., 1.))
         x = rearrange(x, 'b h w c -> b c h w')
         x = x.to(memory_format=torch.contiguous_format).float()
         return x
 
     def shared_step(self, batch):
-        x = self.get_input(batch, self.first_stage_key)
+        with self.profile_stage('get_input'):
+            x = self.get_input(batch, self.first_stage_key)
         loss, loss_dict = self(x)
         return loss, loss_dict
 
@@ -464,7 +472,14 @@ class DDPM(pl.LightningModule):
 
     def on_train_batch_end(self, *args, **kwargs):
         if self.use_ema:
-            self.model_ema(self.model)
+            with self.profile_stage('ema'):
+                self.model_ema(self.model)
+
+    def profile_stage(self, name):
+        """A context timing the named stage of the training step, if a stage profiler is attached."""
+        if self.stage_profiler is None or not self.training:
+            return nullcontext()
+        return self.stage_profiler.stage(name)
 
     def _get_rows_from_list(self, samples):
         n_imgs_per_row = len(samples)
@@ -566,6 +581,8 @@ class LatentDiffusion(DDPM):
         self.cond_stage_forward = cond_stage_forward
         self.clip_denoised = False
         self.bbox_tokenizer = None
+        # precomputed text embeddings, see datasets/prompt_cache.py
+        self.prompt_cache = None
 
         self.restarted_from_ckpt = False
         if ckpt_path is not None:
@@ -575,7 +592,7 @@ class LatentDiffusion(DDPM):
                 assert self.use_ema
                 print(
                     f"Resetting ema to pure model weights. This is useful when restoring from an ema-only checkpoint.")
-                self.model_ema = LitEma(self.model)
+                self.model_ema = LitEma(self.model, **self.ema_config)
         if reset_num_ema_updates:
             print(" +++++++++++ WARNING: RESETTING NUM_EMA UPDATES TO ZERO +++++++++++ ")
             assert self.use_ema
@@ -674,6 +691,14 @@ class LatentDiffusion(DDPM):
             c = getattr(self.cond_stage_model, self.cond_stage_forward)(c)
         return c
 
+    @torch.no_grad()
+    def get_cached_conditioning(self, indices):
+        """Gather precomputed embeddings of the prompts at the given rows of `self.prompt_cache`."""
+        if isinstance(indices, torch.Tensor):
+            indices = indices.tolist()
+        c = torch.from_numpy(self.prompt_cache.gather(indices))
+        return c.to(self.device).float()
+
     def meshgrid(self, h, w):
         y = torch.arange(0, h).view(h, 1, 1).repeat(1, w, 1)
         x = torch.arange(0, w).view(1, w, 1).repeat(h, 1, 1)
@@ -766,12 +791,17 @@ class LatentDiffusion(DDPM):
     @torch.no_grad()
     def get_input(self, batch, k, return_first_stage_outputs=False, force_c_encode=False,
                   cond_key=None, return_original_cond=False, bs=None, return_x=False):
-        x = super().get_input(batch, k)
-        if bs is not None:
-            x = x[:bs]
-        x = x.to(self.device)
-        encoder_posterior = self.encode_first_stage(x)
-        z = self.get_first_stage_encoding(encoder_posterior).detach()
+        if f'{k}_latent' in batch:
+            # the first stage encoding was precomputed, see datasets/latent_cache.py
+            x = None
+            z = self.get_cached_first_stage_encoding(batch[f'{k}_latent'], bs=bs)
+        else:
+            x = super().get_input(batch, k)
+            if bs is not None:
+                x = x[:bs]
+            x = x.to(self.device)
+            encoder_posterior = self.encode_first_stage(x)
+            z = self.get_first_stage_encoding(encoder_posterior).detach()
 
         if self.model.conditioning_key is not None and not self.force_null_conditioning:
             if cond_key is None:
@@ -785,7 +815,9 @@ class LatentDiffusion(DDPM):
                     xc = super().get_input(batch, cond_key).to(self.device)
             else:
                 xc = x
-            if not self.cond_stage_trainable or force_c_encode:
+            if self.prompt_cache is not None and f'{cond_key}_idx' in batch and not self.cond_stage_trainable:
+                c = self.get_cached_conditioning(batch[f'{cond_key}_idx'])
+            elif not self.cond_stage_trainable or force_c_encode:
                 if isinstance(xc, dict) or isinstance(xc, list):
                     c = self.get_learned_conditioning(xc)
                 else:
@@ -816,6 +848,19 @@ class LatentDiffusion(DDPM):
             out.append(xc)
         return out
 
+    @torch.no_grad()
+    def get_cached_first_stage_encoding(self, latent, bs=None):
+        """
+        Turn a precomputed, unscaled first stage latent of shape (b, c, h, w) into a scaled encoding.
+        `latent` holds either the posterior parameters (mean, logvar) or an already sampled z.
+        """
+        if bs is not None:
+            latent = latent[:bs]
+        latent = latent.to(self.device).to(memory_format=torch.contiguous_format).float()
+        if latent.shape[1] == 2 * self.channels:
+            latent = DiagonalGaussianDistribution(latent)
+        return self.get_first_stage_encoding(latent).detach()
+
     @torch.no_grad()
     def decode_first_stage(self, z, predict_cids=False, force_not_quantize=False):
         if predict_cids:
@@ -832,7 +877,8 @@ class LatentDiffusion(DDPM):
         return self.first_stage_model.encode(x)
 
     def shared_step(self, batch, **kwargs):
-        x, c = self.get_input(batch, self.first_stage_key)
+        with self.profile_stage('get_input'):
+            x, c = self.get_input(batch, self.first_stage_key)
         loss = self(x, c)
         return loss
 
@@ -0,0 +1,163 @@
+import time
+from collections import namedtuple
+from typing import Dict, Iterable, Optional
+
+import torch
+from torch import nn
+
+from ldm.modules.attention import BasicTransformerBlock
+from ldm.modules.diffusionmodules.openaimodel import ResBlock, Downsample, Upsample
+
+
+Block = namedtuple('Block', ['name', 'module', 'kind', 'level'])
+
+# the attribute holding the checkpoint flag of each kind of block
+FLAG_ATTRS = {'resblock': 'use_checkpoint', 'transformer': 'checkpoint'}
+
+
+def find_blocks(model: nn.Module):
+    """
+    The checkpointable blocks of the UNets / ControlNets in `model`, with their kind ("resblock" or "transformer")
+    and level (the number of downsamplings before the block, i.e., 0 for the blocks at full resolution).
+    """
+    blocks = []
+    for name, module in model.named_modules():
+        if not hasattr(module, 'input_blocks') or not hasattr(module, 'middle_block'):
+            continue
+        level = 0
+        stages = [(f'{name}.input_blocks.{i}', b, 1) for i, b in enumerate(module.input_blocks)]
+        stages.append((f'{name}.middle_block', module.middle_block, 0))
+        stages += [(f'{name}.output_blocks.{i}', b, -1) for i, b in enumerate(getattr(module, 'output_blocks', []))]
+        for stage_name, stage, direction in stages:
+            resample = False
+            for sub_name, sub in stage.named_modules():
+                if isinstance(sub, (Downsample, Upsample)) or (isinstance(sub, ResBlock) and sub.updown):
+                    resample = True
+                if isinstance(sub, ResBlock):
+                    kind = 'resblock'
+                elif isinstance(sub, BasicTransformerBlock):
+                    kind = 'transformer'
+                else:
+                    continue
+                blocks.append(Block(f'{stage_name}.{sub_name}'.strip('.'), sub, kind, level))
+            if resample:
+                level += direction
+    return blocks
+
+
+class CheckpointPolicy:
+    """
+    Which blocks of the UNets / ControlNets are checkpointed, replacing the `use_checkpoint` of the configs.
+    Whatever the policy, a block is not checkpointed when no gradient flows through it, i.e., when neither its
+    inputs nor its parameters require gradients (e.g., the encoder of a locked UNet whose parameters are frozen).
+
+    Args:
+        levels: for each kind of block ("resblock" / "transformer"), the levels where it is checkpointed (0 is full
+            resolution, where the activations are the largest), or None for all levels; kinds not in the dict
+            are not checkpointed
+        mode: "non_reentrant" for `torch.utils.checkpoint(use_reentrant=False)`, "reentrant" for the original
+            `CheckpointFunction` of ldm.modules.diffusionmodules.util, or "none" to disable checkpointing
+    """
+    MODES = {'non_reentrant': 'non_reentrant', 'reentrant': True, 'none': False}
+
+    def __init__(self, levels: Optional[Dict[str, Optional[Iterable[int]]]] = None, mode: str = 'non_reentrant'):
+        if mode not in self.MODES:
+            raise ValueError(f'Unknown checkpoint mode {mode}, expect one of {list(self.MODES)}')
+        if levels is None:
+            levels = {kind: None for kind in FLAG_ATTRS}
+        if any(kind not in FLAG_ATTRS for kind in levels):
+            raise ValueError(f'Unknown block kinds in {list(levels)}, expect some of {list(FLAG_ATTRS)}')
+        self.levels = {kind: None if lv is None else tuple(lv) for kind, lv in levels.items()}
+        self.mode = mode
+
+    def __repr__(self):
+        return f'CheckpointPolicy(levels={self.levels}, mode={self.mode!r})'
+
+    def selects(self, block: Block):
+        if self.mode == 'none' or block.kind not in self.levels:
+            return False
+        levels = self.levels[block.kind]
+        return levels is None or block.level in levels
+
+    def apply(self, model: nn.Module):
+        """Set the checkpoint flag of every block of `model`, returns the names of the selected blocks."""
+        checkpointed = []
+        for block in find_blocks(model):
+            selected = self.selects(block)
+            setattr(block.module, FLAG_ATTRS[block.kind], self.MODES[self.mode] if selected else False)
+            if selected:
+                checkpointed.append(block.name)
+        return checkpointed
+
+
+def candidate_policies(blocks, mode: str = 'non_reentrant'):
+    """
+    Policies checkpointing more and more of `blocks`, i.e., from the fastest to the most memory-efficient: first
+    the transformer blocks (whose attention maps are the largest activations) from the highest resolution down,
+    then the resblocks in the same order.
+    """
+    policies = [CheckpointPolicy(mode='none')]
+    done = dict()
+    for kind in ['transformer', 'resblock']:
+        levels = sorted({block.level for block in blocks if block.kind == kind})
+        for k in range(1, len(levels) + 1):
+            policies.append(CheckpointPolicy({**done, kind: levels[:k]}, mode))
+        done[kind] = None
+    return policies
+
+
+def measure_step(step_fn, n_steps: int = 1):
+    """Peak memory (bytes) and mean time (s) of `step_fn()`, or (None, None) if it runs out of memory."""
+    out_of_memory = False
+    try:
+        step_fn()  # warm up, e.g., cudnn autotuning
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        t0 = time.perf_counter()
+        for _ in range(n_steps):
+            step_fn()
+        torch.cuda.synchronize()
+        seconds = (time.perf_counter() - t0) / n_steps
+    except RuntimeError as e:
+        if 'out of memory' not in str(e):
+            raise
+        out_of_memory = True
+    if out_of_memory:
+        # outside of the except clause, so that the tensors referenced by the traceback are freed
+        torch.cuda.empty_cache()
+        return None, None
+    return torch.cuda.max_memory_allocated(), seconds
+
+
+def tune_policy(model: nn.Module, step_fn, budget: int, mode: str = 'non_reentrant', n_steps: int = 1,
+                verbose: bool = True):
+    """
+    Find the fastest policy whose training step fits in `budget` bytes of device memory, and apply it.
+
+    The candidates of `candidate_policies` use less and less memory at the cost of more recomputation, so the
+    first one that fits is searched by bisection, running `step_fn()` (a forward and backward on a real batch,
+    which must free the gradients) under each tried policy. If none fits, every block is checkpointed.
+    Returns the policy and the measured (peak memory, step time) of the tried candidates.
+    """
+    policies = candidate_policies(find_blocks(model), mode)
+    results = dict()
+
+    def fits(i):
+        policies[i].apply(model)
+        memory, seconds = measure_step(step_fn, n_steps)
+        results[policies[i]] = (memory, seconds)
+        if verbose:
+            status = 'out of memory' if memory is None else f'{memory / 2 ** 30:.2f}GB, {seconds * 1000:.1f}ms/step'
+            print(f'{policies[i]}: {status}')
+        return memory is not None and memory <= budget
+
+    lo, hi = 0, len(policies) - 1
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if fits(mid):
+            hi = mid
+        else:
+            lo = mid + 1
+    policy = policies[lo]
+    policy.apply(model)
+    return policy, results
@@ -12,6 +12,7 @@ import os
 import math
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
 import numpy as np
 from einops import repeat
 
@@ -107,13 +108,21 @@ def checkpoint(func, inputs, params, flag):
     :param inputs: the argument sequence to pass to `func`.
     :param params: a sequence of parameters `func` depends on but does not
                    explicitly take as arguments.
-    :param flag: if False, disable gradient checkpointing.
+    :param flag: if False, disable gradient checkpointing. If "non_reentrant", use the non-reentrant
+                 `torch.utils.checkpoint`, which does not need `params` and frees the recomputed activations
+                 as soon as their gradients are computed. See ldm.modules.checkpoint_policy.
     """
-    if flag:
-        args = tuple(inputs) + tuple(params)
-        return CheckpointFunction.apply(func, len(inputs), *args)
-    else:
+    if not flag or not torch.is_grad_enabled():
+        return func(*inputs)
+    params = tuple(params)
+    if not any(isinstance(x, torch.Tensor) and x.requires_grad for x in inputs) and \
+            not any(p.requires_grad for p in params):
+        # no gradient flows through func (e.g., a frozen block before any trained one): no activations to save
         return func(*inputs)
+    if flag == "non_reentrant":
+        return torch.utils.checkpoint.checkpoint(func, *inputs, use_reentrant=False)
+    args = tuple(inputs) + params
+    return CheckpointFunction.apply(func, len(inputs), *args)
 
 
 class CheckpointFunction(torch.autograd.Function):
@@ -264,7 +273,35 @@ class HybridConditioner(nn.Module):
         return {'c_concat': [c_concat], 'c_crossattn': [c_crossattn]}
 
 
-def noise_like(shape, device, repeat=False):
+def make_generators(seeds, device="cpu"):
+    """
+    One torch.Generator per sample, from a list of seeds (ints) or generators (returned as is), see randn_per_sample.
+    """
+    generators = []
+    for seed in seeds:
+        if isinstance(seed, torch.Generator):
+            generators.append(seed)
+        else:
+            generators.append(torch.Generator(device=device).manual_seed(int(seed)))
+    return generators
+
+
+def randn_per_sample(shape, generators, device, dtype=torch.float32):
+    """
+    Gaussian noise of `shape`, whose i-th row is drawn from generators[i] only, on the device of the generator
+    (CPU by default, so that a seed gives the same noise on every device). Therefore the noise of a sample does not
+    depend on the batch size or its position in the batch.
+    """
+    assert len(generators) == shape[0], f"Expect {shape[0]} generators, got {len(generators)}"
+    noise = [torch.randn(shape[1:], generator=g, device=g.device, dtype=dtype) for g in generators]
+    return torch.stack(noise).to(device)
+
+
+def noise_like(shape, device, repeat=False, generators=None):
+    if generators is not None:
+        if repeat:
+            return randn_per_sample((1, *shape[1:]), generators[:1], device).repeat(shape[0], *((1,) * (len(shape) - 1)))
+        return randn_per_sample(shape, generators, device)
     repeat_noise = lambda: torch.randn((1, *shape[1:]), device=device).repeat(shape[0], *((1,) * (len(shape) - 1)))
     noise = lambda: torch.randn(shape, device=device)
     return repeat_noise() if repeat else noise()
\ No newline at end of file
@@ -1,9 +1,20 @@
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 from torch import nn
 
 
 class LitEma(nn.Module):
-    def __init__(self, model, decay=0.9999, use_num_upates=True):
+    """
+    Exponential moving average of the trainable parameters of a model, kept in buffers (one per parameter).
+
+    The shadows and parameters are gathered once into flat lists and updated with multi-tensor (foreach) ops.
+    With `update_every=N`, the average is updated every N steps with the decays of these steps compounded.
+    With `offload=True`, the shadows are kept in fp32 on the CPU (whatever the model is moved or cast to):
+    the parameters are copied to pinned memory and averaged in a background thread, overlapping with training.
+    """
+    def __init__(self, model, decay=0.9999, use_num_upates=True, offload=False, update_every=1):
         super().__init__()
         if decay < 0.0 or decay > 1.0:
             raise ValueError('Decay must be between 0 and 1')
@@ -18,43 +29,134 @@ class LitEma(nn.Module):
                 # remove as '.'-character is not allowed in buffers
                 s_name = name.replace('.', '')
                 self.m_name2s_name.update({name: s_name})
-                self.register_buffer(s_name, p.clone().detach().data)
+                shadow = p.clone().detach().data
+                self.register_buffer(s_name, shadow.float().cpu() if offload else shadow)
 
         self.collected_params = []
 
+        self.offload = offload
+        self.update_every = update_every
+        # host copies of decay / num_updates, to not synchronize with the device on every step
+        self._decay = None
+        self._num_updates = None
+        self._decay_prod = 1.0
+        self._steps = 0
+        self._model_params = None
+        # offloading state
+        self._staging = None
+        self._executor = None
+        self._pending = None
+
     def reset_num_updates(self):
         del self.num_updates
         self.register_buffer('num_updates', torch.tensor(0, dtype=torch.int))
+        self._num_updates = None
+
+    def _apply(self, fn):
+        if self.offload:
+            # offloaded shadows stay in fp32 on the CPU
+            return self
+        return super()._apply(fn)
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        self.wait()
+        super()._save_to_state_dict(destination, prefix, keep_vars)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.wait()
+        super()._load_from_state_dict(*args, **kwargs)
+        # refresh the host copies from the loaded buffers, so that the decay warm-up resumes where it stopped
+        self._decay = self.decay.item()
+        self._num_updates = int(self.num_updates.item())
+        self._decay_prod = 1.0
+        self._steps = 0
+
+    def _get_model_params(self, model):
+        """The trainable parameters of `model` and the names of their shadows, gathered once."""
+        if self._model_params is None or self._model_params[0]() is not model:
+            s_names, params = [], []
+            for name, p in model.named_parameters():
+                if p.requires_grad:
+                    s_names.append(self.m_name2s_name[name])
+                    params.append(p)
+                # parameters frozen after the EMA was created (see CheckpointPolicyTuner) keep their shadows
+            self._model_params = (weakref.ref(model), s_names, params)
+        return self._model_params[1], self._model_params[2]
+
+    @staticmethod
+    def _lerp_(shadows, params, weight):
+        """shadow <- shadow + weight * (param - shadow) for all tensors."""
+        if hasattr(torch, '_foreach_lerp_') and all(s.dtype == p.dtype for s, p in zip(shadows, params)):
+            torch._foreach_lerp_(shadows, params, weight)
+        else:
+            torch._foreach_mul_(shadows, 1.0 - weight)
+            torch._foreach_add_(shadows, params, alpha=weight)
 
     def forward(self, model):
-        decay = self.decay
+        if self._num_updates is None:
+            self._decay = self.decay.item()
+            self._num_updates = int(self.num_updates.item())
+        decay = self._decay
 
-        if self.num_updates >= 0:
+        if self._num_updates >= 0:
+            self._num_updates += 1
             self.num_updates += 1
-            decay = min(self.decay, (1 + self.num_updates) / (10 + self.num_updates))
+            decay = min(self._decay, (1 + self._num_updates) / (10 + self._num_updates))
 
-        one_minus_decay = 1.0 - decay
+        self._decay_prod *= decay
+        self._steps += 1
+        if self._steps % self.update_every != 0:
+            return
+        one_minus_decay = 1.0 - self._decay_prod
+        self._decay_prod = 1.0
 
         with torch.no_grad():
-            m_param = dict(model.named_parameters())
-            shadow_params = dict(self.named_buffers())
+            s_names, params = self._get_model_params(model)
+            params = [p.detach() for p in params]
+            if self.offload:
+                self._update_offloaded(s_names, params, one_minus_decay)
+            else:
+                shadows = [self._buffers[s_name] for s_name in s_names]
+                self._lerp_(shadows, params, one_minus_decay)
+
+    def _update_offloaded(self, s_names, params, weight):
+        # the previous update must be done before its staging buffers are overwritten
+        self.wait()
+        if self._staging is None:
+            pin_memory = torch.cuda.is_available()
+            self._staging = [torch.empty(p.shape, dtype=p.dtype, pin_memory=pin_memory) for p in params]
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        # copies are queued on the current stream, so the following optimizer step cannot modify the
+        # parameters before they are copied, but the host does not wait for them
+        for buf, p in zip(self._staging, params):
+            buf.copy_(p, non_blocking=True)
+        event = None
+        if params[0].is_cuda:
+            event = torch.cuda.Event()
+            event.record(torch.cuda.current_stream(params[0].device))
+        shadows = [self._buffers[s_name] for s_name in s_names]
+        self._pending = self._executor.submit(self._finish_offloaded, shadows, self._staging, event, weight)
+
+    def _finish_offloaded(self, shadows, staging, event, weight):
+        if event is not None:
+            event.synchronize()
+        self._lerp_(shadows, staging, weight)
 
-            for key in m_param:
-                if m_param[key].requires_grad:
-                    sname = self.m_name2s_name[key]
-                    shadow_params[sname] = shadow_params[sname].type_as(m_param[key])
-                    shadow_params[sname].sub_(one_minus_decay * (shadow_params[sname] - m_param[key]))
-                else:
-                    assert not key in self.m_name2s_name
+    def wait(self):
+        """Wait for the pending offloaded update, if any."""
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
 
     def copy_to(self, model):
+        self.wait()
         m_param = dict(model.named_parameters())
         shadow_params = dict(self.named_buffers())
         for key in m_param:
-            if m_param[key].requires_grad:
+            if key in self.m_name2s_name:
                 m_param[key].data.copy_(shadow_params[self.m_name2s_name[key]].data)
             else:
-                assert not key in self.m_name2s_name
+                assert not m_param[key].requires_grad
 
     def store(self, parameters):
         """
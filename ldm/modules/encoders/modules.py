@@ -22,6 +22,27 @@ class IdentityEncoder(AbstractEncoder):
         return x
 
 
+class FrozenByteEmbedder(AbstractEncoder):
+    """Embeds the UTF-8 bytes of the text with a frozen random table, a stand-in for the CLIP text encoder
+    without weights to download, e.g., to benchmark the serving code with a tiny model on CPU"""
+    def __init__(self, embed_dim=768, max_length=77):
+        super().__init__()
+        self.max_length = max_length
+        self.embedding = nn.Embedding(257, embed_dim)  # 256 byte values and the padding
+        for param in self.parameters():
+            param.requires_grad = False
+
+    def forward(self, text):
+        tokens = torch.full((len(text), self.max_length), 256, dtype=torch.long)
+        for i, t in enumerate(text):
+            b = list(t.encode('utf-8'))[:self.max_length]
+            tokens[i, :len(b)] = torch.tensor(b, dtype=torch.long)
+        return self.embedding(tokens.to(self.embedding.weight.device))
+
+    def encode(self, text):
+        return self(text)
+
+
 class ClassEmbedder(nn.Module):
     def __init__(self, embed_dim, n_classes=1000, key='class', ucg_rate=0.1):
         super().__init__()
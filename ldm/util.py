@@ -32,6 +32,21 @@ def log_txt_as_img(wh, xc, size=10):
     return txts
 
 
+def images_to_float(x, device=None, value_range=(0., 1.)):
+    """
+    Turn a (b, h, w, c) batch of images into a contiguous float (b, c, h, w) tensor on `device`.
+    uint8 images (see datasets/dataset_collate.py) are moved as they are and mapped from [0, 255]
+    to `value_range` on the device; float images are assumed to be normalized already.
+    """
+    if device is not None:
+        x = x.to(device, non_blocking=True)
+    if x.dtype == torch.uint8:
+        lo, hi = value_range
+        x = x.float().mul_((hi - lo) / 255.).add_(lo)
+    x = x.permute(0, 3, 1, 2)
+    return x.to(memory_format=torch.contiguous_format).float()
+
+
 def ismap(x):
     if not isinstance(x, torch.Tensor):
         return False
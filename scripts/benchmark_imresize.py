@@ -0,0 +1,98 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import math
+import time
+import argparse
+
+import numpy as np
+import torch
+
+from utils import util_image
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_images", type=int, default=32, help='number of images')
+    parser.add_argument("--size", type=int, default=512, help='image size')
+    parser.add_argument("--scales", type=float, nargs='+', default=[0.25, 0.5, 2.0], help='resize scales')
+    parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help='device')
+    return parser
+
+
+def imresize_np_by_loops(img, scale, antialiasing=True):
+    """The previous implementation of imresize_np, for reference."""
+    img = torch.from_numpy(img)
+    need_squeeze = True if img.dim() == 2 else False
+    if need_squeeze:
+        img.unsqueeze_(2)
+
+    in_H, in_W, in_C = img.size()
+    out_C, out_H, out_W = in_C, math.ceil(in_H * scale), math.ceil(in_W * scale)
+    weights_H, indices_H, sym_len_Hs, sym_len_He = util_image.calculate_weights_indices(
+        in_H, out_H, scale, 'cubic', 4, antialiasing)
+    weights_W, indices_W, sym_len_Ws, sym_len_We = util_image.calculate_weights_indices(
+        in_W, out_W, scale, 'cubic', 4, antialiasing)
+
+    img_aug = torch.FloatTensor(in_H + sym_len_Hs + sym_len_He, in_W, in_C)
+    img_aug.narrow(0, sym_len_Hs, in_H).copy_(img)
+    img_aug.narrow(0, 0, sym_len_Hs).copy_(img[:sym_len_Hs].flip(0))
+    img_aug.narrow(0, sym_len_Hs + in_H, sym_len_He).copy_(img[-sym_len_He:].flip(0))
+    out_1 = torch.FloatTensor(out_H, in_W, in_C)
+    kernel_width = weights_H.size(1)
+    for i in range(out_H):
+        idx = int(indices_H[i][0])
+        for j in range(out_C):
+            out_1[i, :, j] = img_aug[idx:idx + kernel_width, :, j].transpose(0, 1).mv(weights_H[i])
+
+    out_1_aug = torch.FloatTensor(out_H, in_W + sym_len_Ws + sym_len_We, in_C)
+    out_1_aug.narrow(1, sym_len_Ws, in_W).copy_(out_1)
+    out_1_aug.narrow(1, 0, sym_len_Ws).copy_(out_1[:, :sym_len_Ws].flip(1))
+    out_1_aug.narrow(1, sym_len_Ws + in_W, sym_len_We).copy_(out_1[:, -sym_len_We:].flip(1))
+    out_2 = torch.FloatTensor(out_H, out_W, in_C)
+    kernel_width = weights_W.size(1)
+    for i in range(out_W):
+        idx = int(indices_W[i][0])
+        for j in range(out_C):
+            out_2[:, i, j] = out_1_aug[:, idx:idx + kernel_width, j].mv(weights_W[i])
+    if need_squeeze:
+        out_2.squeeze_()
+    return out_2.numpy()
+
+
+def main():
+    args = get_parser().parse_args()
+    images = np.random.rand(args.n_images, args.size, args.size, 3).astype(np.float32)
+
+    for scale in args.scales:
+        t0 = time.time()
+        outs_loop = np.stack([imresize_np_by_loops(im, scale) for im in images])
+        t_loop = time.time() - t0
+
+        t0 = time.time()
+        outs_np = np.stack([util_image.imresize_np(im, scale) for im in images])
+        t_np = time.time() - t0
+
+        batch = torch.from_numpy(images).permute(0, 3, 1, 2).to(args.device)
+        util_image.imresize_th(batch, scale)  # warm up, and build the cached weights
+        if args.device.startswith('cuda'):
+            torch.cuda.synchronize()
+        t0 = time.time()
+        outs_th = util_image.imresize_th(batch, scale)
+        if args.device.startswith('cuda'):
+            torch.cuda.synchronize()
+        t_th = time.time() - t0
+        outs_th = outs_th.permute(0, 2, 3, 1).cpu().numpy()
+
+        print(f'[scale={scale}] loops: {t_loop * 1000 / args.n_images:.2f}ms/image, '
+              f'imresize_np: {t_np * 1000 / args.n_images:.2f}ms/image ({t_loop / t_np:.1f}x), '
+              f'imresize_th on {args.device}: {t_th * 1000 / args.n_images:.3f}ms/image ({t_loop / t_th:.1f}x)')
+        print(f'[scale={scale}] max abs difference to the loops: imresize_np {np.abs(outs_np - outs_loop).max():.2e}, '
+              f'imresize_th {np.abs(outs_th - outs_loop).max():.2e}')
+
+    print('Done.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import time
+import argparse
+import numpy as np
+
+from torch.utils.data import DataLoader
+
+from datasets.multigen20m import MultiGen20M
+from datasets.custom_dataset import CustomDataset
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataroot", type=str, required=True, help='path to dataset')
+    parser.add_argument("--multigen20m", action='store_true', default=False, help='use multigen20m dataset')
+    parser.add_argument("--task", type=str, choices=[
+        'hed', 'canny', 'seg', 'depth', 'normal', 'openpose', 'hedsketch',
+        'bbox', 'outpainting', 'inpainting', 'blur', 'grayscale',
+    ], help='task name')
+    parser.add_argument("--storage", type=str, default=None, help='path to packed images made by tool_pack_dataset.py')
+    parser.add_argument("--n_items", type=int, default=500, help='number of random items to read')
+    parser.add_argument("--n_batches", type=int, default=100, help='number of batches to load')
+    parser.add_argument("--bs", type=int, default=8, help='batch size')
+    parser.add_argument("--num_workers", type=int, default=8, help='number of dataloader workers')
+    parser.add_argument("--seed", type=int, default=0, help='random seed')
+    return parser
+
+
+def build_dataset(args, storage):
+    if args.multigen20m:
+        return MultiGen20M(
+            path_json=os.path.join(args.dataroot, 'json_files', f'aesthetics_plus_all_group_{args.task}_all.json'),
+            path_meta=args.dataroot, task=args.task, drop_rate=0.0, random_cropping=False, storage=storage,
+        )
+    return CustomDataset(args.dataroot, storage=storage)
+
+
+def benchmark(args, storage):
+    name = storage or 'loose files'
+    t0 = time.time()
+    dataset = build_dataset(args, storage)
+    print(f'[{name}] startup: {time.time() - t0:.2f}s, {len(dataset)} items')
+
+    # Random access, as seen by a shuffling sampler
+    indices = np.random.RandomState(args.seed).randint(0, len(dataset), size=args.n_items)
+    t0 = time.time()
+    for idx in indices:
+        dataset[int(idx)]
+    elapsed = time.time() - t0
+    print(f'[{name}] __getitem__: {elapsed / args.n_items * 1000:.2f}ms/item')
+
+    # DataLoader throughput, the first batch (worker startup) is excluded
+    dataloader = DataLoader(dataset, batch_size=args.bs, num_workers=args.num_workers, shuffle=True)
+    it = iter(dataloader)
+    next(it)
+    t0 = time.time()
+    n = 0
+    for _ in range(args.n_batches):
+        try:
+            next(it)
+        except StopIteration:
+            break
+        n += 1
+    elapsed = time.time() - t0
+    print(f'[{name}] DataLoader: {n * args.bs / elapsed:.1f} items/s')
+
+
+def main():
+    args = get_parser().parse_args()
+    # Drop the page cache before running for cold-cache numbers, e.g. `echo 3 > /proc/sys/vm/drop_caches`
+    benchmark(args, None)
+    if args.storage is not None:
+        benchmark(args, args.storage)
+    print('Done.')
+
+
+if __name__ == '__main__':
+    main()
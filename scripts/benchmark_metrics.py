@@ -0,0 +1,81 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import time
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+from utils import util_image
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_images", type=int, default=256, help='number of image pairs')
+    parser.add_argument("--bs", type=int, default=64, help='batch size')
+    parser.add_argument("--size", type=int, default=256, help='image size')
+    parser.add_argument("--border", type=int, default=4, help='border cropped before computing the metrics')
+    parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help='device')
+    return parser
+
+
+def make_images(args):
+    # smooth images with mild noise, so that SSIM is far from 0 and 1
+    imclean = F.interpolate(torch.rand(args.n_images, 3, args.size // 8, args.size // 8), size=args.size,
+                            mode='bicubic', align_corners=False).clamp(0, 1)
+    img = (imclean + 0.05 * torch.randn_like(imclean)).clamp(0, 1)
+    return img, imclean
+
+
+def synchronize(device):
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+def main():
+    args = get_parser().parse_args()
+    img, imclean = make_images(args)
+
+    for ycbcr in [False, True]:
+        # current implementation: numpy, per image and per channel
+        t0 = time.time()
+        psnr_np = ssim_np = 0
+        for i in range(0, args.n_images, args.bs):
+            psnr_np += util_image.batch_PSNR(img[i:i + args.bs], imclean[i:i + args.bs], args.border, ycbcr)
+            ssim_np += util_image.batch_SSIM(img[i:i + args.bs], imclean[i:i + args.bs], args.border, ycbcr)
+        t_np = time.time() - t0
+
+        # torch implementation, on the device, images already there as in an evaluation loop
+        img_d, imclean_d = img.to(args.device), imclean.to(args.device)
+        meter = util_image.MetricMeter(args.border, ycbcr)
+        meter.update(img_d[:args.bs], imclean_d[:args.bs])  # warm up
+        meter.reset()
+        synchronize(args.device)
+        t0 = time.time()
+        for i in range(0, args.n_images, args.bs):
+            meter.update(img_d[i:i + args.bs], imclean_d[i:i + args.bs])
+        psnr_th, ssim_th = meter.compute()
+        t_th = time.time() - t0
+
+        print(f'[ycbcr={ycbcr}] numpy: PSNR {psnr_np / args.n_images:.6f}, SSIM {ssim_np / args.n_images:.6f}, '
+              f'{t_np * 1000 / args.n_images:.3f}ms/image')
+        print(f'[ycbcr={ycbcr}] torch: PSNR {psnr_th:.6f}, SSIM {ssim_th:.6f}, '
+              f'{t_th * 1000 / args.n_images:.3f}ms/image ({t_np / t_th:.1f}x)')
+
+        # per-image agreement
+        psnr_diff = ssim_diff = 0
+        for i in range(args.n_images):
+            a, b = img[i:i + 1], imclean[i:i + 1]
+            psnr_diff = max(psnr_diff, abs(util_image.batch_PSNR(a, b, args.border, ycbcr) -
+                                           util_image.batch_PSNR_th(a, b, args.border, ycbcr).item()))
+            ssim_diff = max(ssim_diff, abs(util_image.batch_SSIM(a, b, args.border, ycbcr) -
+                                           util_image.batch_SSIM_th(a, b, args.border, ycbcr).item()))
+        print(f'[ycbcr={ycbcr}] max abs difference per image: PSNR {psnr_diff:.2e}, SSIM {ssim_diff:.2e}')
+
+    print('Done.')
+
+
+if __name__ == '__main__':
+    main()
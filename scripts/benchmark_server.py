@@ -0,0 +1,126 @@
+"""
+Load generator for app/server.py, reporting the latency percentiles and the throughput.
+
+Requirements: httpx (installed with gradio)
+
+For example, on CPU with the tiny model:
+    python app/server.py --tiny --device cpu --max_batch_size 8 --max_wait_ms 50
+    python scripts/benchmark_server.py --n_requests 64 --concurrency 16 --sizes 64 128 --ddim_steps 4
+"""
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import time
+import base64
+import random
+import asyncio
+import argparse
+
+import cv2
+import httpx
+import numpy as np
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", type=str, default='http://127.0.0.1:8000', help='url of the server')
+    parser.add_argument("--n_requests", type=int, default=64, help='number of requests')
+    parser.add_argument("--concurrency", type=int, default=16, help='maximum number of requests in flight')
+    parser.add_argument("--rate", type=float, default=0, help='mean arrival rate (requests/s, Poisson), 0 to send '
+                                                              'the requests as fast as the concurrency allows')
+    parser.add_argument("--sizes", type=int, nargs='+', default=[64], help='sizes of the square condition images, '
+                                                                           'drawn at random for each request')
+    parser.add_argument("--ddim_steps", type=int, default=4, help='DDIM steps')
+    parser.add_argument("--num_samples", type=int, default=1, help='samples per request')
+    parser.add_argument("--num_loras", type=int, default=1, help='number of condition images per request')
+    parser.add_argument("--seed", type=int, default=0, help='random seed')
+    return parser
+
+
+def make_cond_image(size, rng):
+    image = (rng.random((size // 8, size // 8, 3)) * 255).astype(np.uint8)
+    image = cv2.resize(image, (size, size), interpolation=cv2.INTER_NEAREST)
+    return base64.b64encode(cv2.imencode('.png', image)[1].tobytes()).decode()
+
+
+async def send_request(client, url, payload, semaphore):
+    async with semaphore:
+        start = time.perf_counter()
+        first_image, result = None, dict()
+        async with client.stream('POST', f'{url}/generate', json=payload) as response:
+            if response.status_code != 200:
+                await response.aread()
+                return dict(error=f'HTTP {response.status_code}: {response.text}')
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                event = json.loads(line)
+                if event['event'] == 'image' and first_image is None:
+                    first_image = time.perf_counter() - start
+                elif event['event'] == 'started':
+                    result['batch_size'] = event['batch_size']
+                elif event['event'] == 'error':
+                    return dict(error=event['detail'])
+        result.update(latency=time.perf_counter() - start, first_image=first_image)
+        return result
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else float('nan')
+
+
+async def run(args):
+    rng = np.random.default_rng(args.seed)
+    images = {size: [make_cond_image(size, rng) for _ in range(args.num_loras)] for size in args.sizes}
+    payloads = []
+    for i in range(args.n_requests):
+        size = args.sizes[rng.integers(len(args.sizes))]
+        payloads.append(dict(
+            cond_images=images[size], prompt=f'a photo, request {i}', num_samples=args.num_samples,
+            ddim_steps=args.ddim_steps, seed=i,
+        ))
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    async with httpx.AsyncClient(timeout=None) as client:
+        stats_before = (await client.get(f'{args.url}/stats')).json()
+        start = time.perf_counter()
+        tasks = []
+        for payload in payloads:
+            tasks.append(asyncio.ensure_future(send_request(client, args.url, payload, semaphore)))
+            if args.rate > 0:
+                await asyncio.sleep(random.expovariate(args.rate))
+        results = await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+        stats_after = (await client.get(f'{args.url}/stats')).json()
+
+    errors = [r['error'] for r in results if 'error' in r]
+    ok = [r for r in results if 'error' not in r]
+    latencies = [r['latency'] for r in ok]
+    first_images = [r['first_image'] for r in ok if r['first_image'] is not None]
+    n_batches = stats_after['batches'] - stats_before['batches']
+    n_images = stats_after['images'] - stats_before['images']
+
+    print(f'Requests: {len(ok)} ok, {len(errors)} failed, in {elapsed:.2f}s')
+    for error in sorted(set(errors))[:5]:
+        print(f'  error: {error}')
+    print(f'Latency: p50 {percentile(latencies, 50) * 1000:.1f}ms, p99 {percentile(latencies, 99) * 1000:.1f}ms, '
+          f'max {max(latencies, default=float("nan")) * 1000:.1f}ms')
+    print(f'First image: p50 {percentile(first_images, 50) * 1000:.1f}ms, '
+          f'p99 {percentile(first_images, 99) * 1000:.1f}ms')
+    print(f'Throughput: {len(ok) / elapsed:.2f} requests/s, {len(ok) * args.num_samples / elapsed:.2f} images/s')
+    if n_batches > 0:
+        print(f'Server: {n_batches} batches, {n_images / n_batches:.2f} images/batch on average')
+
+
+def main():
+    args = get_parser().parse_args()
+    random.seed(args.seed)
+    asyncio.run(run(args))
+    print('Done.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import time
+import argparse
+
+import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+from torch.nn.parallel import DistributedDataParallel
+
+from cldm.lora import LoRACompatibleLinear
+from cldm.cldm_ctrlora_pretrain import ControlNetPretrain
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_steps", type=int, default=50, help='number of timed steps')
+    parser.add_argument("--bs", type=int, default=2, help='batch size')
+    parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help='device')
+    parser.add_argument("--ddp", action='store_true', default=False,
+                        help='also time the steps under (single-process) DDP, with and without the LoRAs in DDP')
+    return parser
+
+
+def switch_lora_by_traversal(model: ControlNetPretrain, task: str):
+    """The previous implementation of switch_lora, for reference."""
+    lora = model.loras_dict[task]
+    idx = 0
+    for n, m in model.named_modules():
+        if isinstance(m, LoRACompatibleLinear):
+            m.set_lora_layer(lora[idx])
+            idx += 1
+
+
+def build_tiny_model():
+    # a tiny version of configs/ctrlora_pretrain_sd15_9tasks_rank128.yaml
+    return ControlNetPretrain(
+        image_size=32, in_channels=4, hint_channels=3, model_channels=32, attention_resolutions=[2, 1],
+        num_res_blocks=1, channel_mult=[1, 2], num_heads=4, use_spatial_transformer=True, transformer_depth=1,
+        context_dim=64, use_checkpoint=False, legacy=False, lora_rank=8,
+        tasks=['hed', 'canny', 'seg', 'depth', 'normal', 'openpose', 'hedsketch', 'bbox', 'outpainting'],
+    )
+
+
+def time_steps(model, switch, tasks, args):
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=1e-5)
+    hint = torch.randn(args.bs, 4, 16, 16, device=args.device)
+    context = torch.randn(args.bs, 77, 64, device=args.device)
+    timesteps = torch.randint(0, 1000, (args.bs,), device=args.device)
+
+    def step(task):
+        switch(model, task)
+        outs = model(hint=hint, timesteps=timesteps, context=context)
+        loss = sum(o.float().mean() for o in outs)
+        optimizer.zero_grad(set_to_none=True)
+        loss.backward()
+        optimizer.step()
+
+    step(tasks[0])  # warm up
+    if args.device.startswith('cuda'):
+        torch.cuda.synchronize()
+    t0 = time.time()
+    for i in range(args.n_steps):
+        step(tasks[i % len(tasks)])
+    if args.device.startswith('cuda'):
+        torch.cuda.synchronize()
+    return (time.time() - t0) / args.n_steps * 1000
+
+
+def time_ddp_steps(model, ignore_loras, args):
+    """
+    Step time under DDP cycling the tasks, either with every parameter in DDP and find_unused_parameters=True
+    (the default of strategy='ddp'), or as TaskLoRADDPPlugin: the LoRAs out of DDP, find_unused_parameters=False,
+    and the gradients of the active task's LoRAs reduced after backward.
+    """
+    ignored = [n for n, _ in model.named_parameters() if n.startswith('loras_dict.')] if ignore_loras else []
+    DistributedDataParallel._set_params_and_buffers_to_ignore_for_model(model, ignored)
+    device_ids = [torch.device(args.device).index or 0] if args.device.startswith('cuda') else None
+    ddp = DistributedDataParallel(model, device_ids=device_ids, find_unused_parameters=not ignore_loras)
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=1e-5)
+    hint = torch.randn(args.bs, 4, 16, 16, device=args.device)
+    context = torch.randn(args.bs, 77, 64, device=args.device)
+    timesteps = torch.randint(0, 1000, (args.bs,), device=args.device)
+
+    def step(task):
+        model.switch_lora(task)
+        outs = ddp(hint=hint, timesteps=timesteps, context=context)
+        loss = sum(o.float().mean() for o in outs)
+        optimizer.zero_grad(set_to_none=True)
+        loss.backward()
+        if ignore_loras:
+            grads = [p.grad for p in model.loras_dict[task].parameters() if p.grad is not None]
+            flat = _flatten_dense_tensors(grads)
+            dist.all_reduce(flat)
+            for g, synced in zip(grads, _unflatten_dense_tensors(flat / dist.get_world_size(), grads)):
+                g.copy_(synced)
+        optimizer.step()
+
+    step(model.tasks[0])  # warm up
+    if args.device.startswith('cuda'):
+        torch.cuda.synchronize()
+    t0 = time.time()
+    for i in range(args.n_steps):
+        step(model.tasks[i % model.n_tasks])
+    if args.device.startswith('cuda'):
+        torch.cuda.synchronize()
+    del ddp
+    DistributedDataParallel._set_params_and_buffers_to_ignore_for_model(model, [])
+    return (time.time() - t0) / args.n_steps * 1000
+
+
+def main():
+    args = get_parser().parse_args()
+    model = build_tiny_model().to(args.device)
+    print(f'LoRACompatibleLinear layers: {sum(isinstance(m, LoRACompatibleLinear) for m in model.modules())}')
+
+    # switch_lora alone
+    for name, switch in [('traversal', switch_lora_by_traversal), ('bindings', ControlNetPretrain.switch_lora)]:
+        t0 = time.time()
+        for i in range(1000):
+            switch(model, model.tasks[i % model.n_tasks])
+        print(f'[{name}] switch_lora to another task: {(time.time() - t0):.3f}ms/call')
+        t0 = time.time()
+        for i in range(1000):
+            switch(model, model.tasks[0])
+        print(f'[{name}] switch_lora to the same task: {(time.time() - t0):.3f}ms/call')
+
+    # full training steps, with a task-homogeneous batch per step as in pretraining
+    for name, switch in [('traversal', switch_lora_by_traversal), ('bindings', ControlNetPretrain.switch_lora)]:
+        model.invalidate_lora_bindings()
+        ms_same = time_steps(model, switch, model.tasks[:1], args)
+        ms_cycle = time_steps(model, switch, model.tasks, args)
+        print(f'[{name}] step time: {ms_same:.2f}ms (same task), {ms_cycle:.2f}ms (cycling tasks)')
+
+    # DDP, in a single process: the reductions are trivial, but the unused parameter scans are timed
+    if args.ddp:
+        os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+        os.environ.setdefault('MASTER_PORT', '29512')
+        dist.init_process_group('nccl' if args.device.startswith('cuda') else 'gloo', rank=0, world_size=1)
+        n_lora = sum(p.numel() for p in model.loras_dict.parameters())
+        n_task = sum(p.numel() for p in model.loras_dict[model.tasks[0]].parameters())
+        for name, ignore_loras in [('all params in DDP, find_unused_parameters=True', False),
+                                   ('LoRAs out of DDP, find_unused_parameters=False', True)]:
+            model.invalidate_lora_bindings()
+            ms = time_ddp_steps(model, ignore_loras, args)
+            reduced = sum(p.numel() for p in model.parameters() if p.requires_grad)
+            reduced = reduced - n_lora + n_task if ignore_loras else reduced
+            print(f'[DDP, {name}] step time: {ms:.2f}ms (cycling tasks), {reduced / 1e6:.2f}M gradients reduced per step')
+        dist.destroy_process_group()
+
+    print('Done.')
+
+
+if __name__ == '__main__':
+    main()
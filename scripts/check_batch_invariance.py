@@ -0,0 +1,75 @@
+"""
+Check that a sample drawn with a given seed does not depend on the batch it is drawn in: run DDIM with per-sample
+seeds (the `generators` of DDIMSampler.sample) for one sample alone, then at every position of a larger batch, and
+compare the initial noise and the final latents.
+
+The noise is bit-identical by construction. The latents are bit-identical as long as the kernels of the model are
+batch-invariant, which depends on the device and the libraries (e.g., cuBLAS may pick different algorithms for
+different batch sizes), so their largest difference is reported rather than asserted.
+"""
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from share import *
+
+import argparse
+
+import torch
+
+from cldm.model import create_model
+from cldm.ddim_hacked import DDIMSampler
+from ldm.modules.diffusionmodules.util import make_generators, randn_per_sample
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default='configs/inference/ctrlora_tiny_1lora.yaml', help='model config')
+    parser.add_argument("--ckpt", type=str, default=None, help='checkpoint, random weights if not given')
+    parser.add_argument("--bs", type=int, default=16, help='size of the larger batch')
+    parser.add_argument("--size", type=int, default=64, help='image size')
+    parser.add_argument("--ddim_steps", type=int, default=4, help='DDIM steps')
+    parser.add_argument("--eta", type=float, default=1.0, help='DDIM eta, > 0 to also draw noise at each step')
+    parser.add_argument("--seed", type=int, default=1234, help='seed of the checked sample')
+    parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help='device')
+    return parser
+
+
+@torch.no_grad()
+def sample(model, seeds, hint, args):
+    n = len(seeds)
+    cond = {"c_concat": [hint.repeat(n, 1, 1, 1)], "c_crossattn": [model.get_learned_conditioning(['a photo'] * n)]}
+    shape = (model.channels, args.size // 8, args.size // 8)
+    samples, _ = DDIMSampler(model).sample(args.ddim_steps, n, shape, cond, verbose=False, eta=args.eta,
+                                           generators=seeds)
+    return samples
+
+
+def main():
+    args = get_parser().parse_args()
+    torch.manual_seed(0)
+    model = create_model(args.config)
+    if args.ckpt is not None:
+        model.load_state_dict(torch.load(args.ckpt, map_location='cpu')['state_dict'], strict=False)
+    model = model.to(args.device).eval()
+    hint = torch.rand(1, 3, args.size, args.size, device=args.device)
+
+    alone = sample(model, [args.seed], hint, args)
+    shape = (1, model.channels, args.size // 8, args.size // 8)
+    noise_alone = randn_per_sample(shape, make_generators([args.seed]), args.device)
+    for position in [0, args.bs // 2, args.bs - 1]:
+        seeds = list(range(args.bs))
+        seeds[position] = args.seed
+        batch = sample(model, seeds, hint, args)
+        noise_batch = randn_per_sample((args.bs, *shape[1:]), make_generators(seeds), args.device)
+        print(f'position {position} in a batch of {args.bs}: '
+              f'noise identical: {torch.equal(noise_alone[0], noise_batch[position])}, '
+              f'latents identical: {torch.equal(alone[0], batch[position])}, '
+              f'max abs difference: {(alone[0] - batch[position]).abs().max().item():.2e}')
+
+    print('Done.')
+
+
+if __name__ == '__main__':
+    main()
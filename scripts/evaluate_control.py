@@ -16,7 +16,7 @@ from torchmetrics.image import PeakSignalNoiseRatio
 from torchmetrics.image import StructuralSimilarityIndexMeasure
 from torchmetrics.multimodal import CLIPScore
 
-from annotator.util import HWC3, resize_image
+from annotator.util import HWC3, resize_image, TensorDetector
 
 
 def get_parser():
@@ -26,9 +26,15 @@ def get_parser():
         'canny', 'hed', 'seg', 'depth', 'normal', 'openpose', 'hedsketch', 'bbox',
         'lineart', 'lineart_anime', 'mlsd', 'palette', 'densepose',
     ], help='detector type')
+    parser.add_argument("--half", action='store_true', default=False, help='run the neural detectors in half precision')
     return parser
 
 
+def quantize(x):
+    """Round [0, 1] images to uint8 levels, as the numpy detectors do, to keep the metrics comparable."""
+    return torch.floor((x.float() * 255.0).clamp(0, 255)) / 255.0
+
+
 class SampleDataset(Dataset):
     def __init__(self, sample_dir: str):
         self.sample_dir = sample_dir
@@ -107,21 +113,40 @@ def main():
     else:
         raise NotImplementedError
 
+    # neural detectors process the whole batch on the GPU
+    batched = isinstance(getattr(detector, 'func', detector), TensorDetector)
+    if batched and args.half:
+        getattr(detector, 'func', detector).half()
+
     with torch.no_grad():
         for sample, gt_control, prompt in tqdm.tqdm(dataloader):
 
-            control = []
-            for s in sample:
-                c = detector(((s * 255).to(torch.uint8).permute(1, 2, 0).numpy()))
+            if batched:
+                # the same uint8 input as the numpy detectors, which read (s * 255).to(torch.uint8)
+                sample = quantize(sample.cuda(non_blocking=True))
+                control = detector(sample)
                 if args.detector == 'depth':
-                    c = c[0]
+                    control = control[0]
                 elif args.detector == 'normal':
-                    c = c[1]
-                c = resize_image(HWC3(c), 512)  # np.uint8, [0, 255]
-                c = torch.from_numpy(c).float() / 255.0
-                c = einops.rearrange(c, 'h w c -> c h w')  # torch.float32, [0, 1]
-                control.append(c)
-            control = torch.stack(control, dim=0)
+                    control = control[1]
+                control = quantize(control).expand(-1, 3, -1, -1)  # HWC3
+                if control.shape[2:] != gt_control.shape[2:]:  # resize_image
+                    control = quantize(torch.nn.functional.interpolate(
+                        control, size=gt_control.shape[2:], mode='bicubic', align_corners=False,
+                    ).clamp(0, 1))
+            else:
+                control = []
+                for s in sample:
+                    c = detector(((s * 255).to(torch.uint8).permute(1, 2, 0).numpy()))
+                    if args.detector == 'depth':
+                        c = c[0]
+                    elif args.detector == 'normal':
+                        c = c[1]
+                    c = resize_image(HWC3(c), 512)  # np.uint8, [0, 255]
+                    c = torch.from_numpy(c).float() / 255.0
+                    c = einops.rearrange(c, 'h w c -> c h w')  # torch.float32, [0, 1]
+                    control.append(c)
+                control = torch.stack(control, dim=0)
 
             sample, control, gt_control = sample.cuda(), control.cuda(), gt_control.cuda()
 
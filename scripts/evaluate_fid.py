@@ -0,0 +1,63 @@
+"""
+Requirements: `pip install torchmetrics[image]`
+"""
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import argparse
+
+from utils.fid import InceptionFeatures, extract_features, fid_with_ci, kid_with_ci
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="args")
+    parser.add_argument("--ref_dir", type=str, required=True, help='path to the directory of the reference images')
+    parser.add_argument("--gen_dirs", type=str, nargs='+', required=True,
+                        help='paths to the directories of the generated images, e.g., one per checkpoint')
+    parser.add_argument("--cache_dir", type=str, default='./tmp/fid_cache', help='cache of the features')
+    parser.add_argument("--batch_size", type=int, default=64, help='batch size of the feature extraction')
+    parser.add_argument("--num_workers", type=int, default=8, help='number of workers reading the images')
+    parser.add_argument("--n_bootstrap", type=int, default=100, help='bootstrap resamplings for the FID interval')
+    parser.add_argument("--kid_subsets", type=int, default=100, help='number of subsets for KID')
+    parser.add_argument("--kid_subset_size", type=int, default=1000, help='size of the subsets for KID')
+    parser.add_argument("--confidence", type=float, default=0.95, help='confidence level of the intervals')
+    parser.add_argument("--seed", type=int, default=0, help='random seed of the resamplings')
+    parser.add_argument("--output", type=str, default=None, help='json file to append the results to')
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+
+    extractor = InceptionFeatures()
+    kwargs = dict(cache_dir=args.cache_dir, batch_size=args.batch_size, num_workers=args.num_workers)
+    # extracted once and cached, later runs only extract the generated sets
+    feats_ref, mean_ref, cov_ref = extract_features(extractor, args.ref_dir, **kwargs)
+    print(f'Reference set: {len(feats_ref)} images')
+    print()
+
+    for gen_dir in args.gen_dirs:
+        feats_gen, _, _ = extract_features(extractor, gen_dir, **kwargs)
+        fid, fid_ci = fid_with_ci(feats_gen, mean_ref, cov_ref, args.n_bootstrap, args.confidence, args.seed)
+        kid, kid_std, kid_ci = kid_with_ci(feats_gen, feats_ref, args.kid_subsets, args.kid_subset_size,
+                                           args.confidence, args.seed)
+        print(f'{gen_dir} ({len(feats_gen)} images)')
+        print(f'FID: {fid:.4f} [{fid_ci[0]:.4f}, {fid_ci[1]:.4f}]')
+        print(f'KID: {kid:.6f} ± {kid_std:.6f} [{kid_ci[0]:.6f}, {kid_ci[1]:.6f}]')
+        print()
+
+        if args.output is not None:
+            with open(args.output, 'a') as f:
+                f.write(json.dumps(dict(
+                    gen_dir=gen_dir, ref_dir=args.ref_dir, n_gen=len(feats_gen), n_ref=len(feats_ref),
+                    fid=fid, fid_ci=fid_ci, kid=kid, kid_std=kid_std, kid_ci=kid_ci, confidence=args.confidence,
+                )) + '\n')
+
+    print('Done.')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import csv
+import math
+import argparse
+
+import cv2
+import tqdm
+from torch.utils.data import Dataset, DataLoader
+
+from utils.iqa import IQAService, METRICS
+
+
+IMG_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.webp')
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sample_dir", type=str, required=True, help='path to the directory of the images to evaluate')
+    parser.add_argument("--gt_dir", type=str, default=None, help='path to the directory of the ground-truth images, '
+                                                                  'matched by file name, for the full-reference metrics')
+    parser.add_argument("--metrics", type=str, nargs='+', default=list(METRICS), choices=list(METRICS), help='metrics')
+    parser.add_argument("--batch_size", type=int, default=16, help='batch size of the metrics')
+    parser.add_argument("--num_workers", type=int, default=8, help='number of workers reading the images')
+    parser.add_argument("--cache_file", type=str, default=None, help='cache of the scores by image content, '
+                                                                     'default: SAMPLE_DIR/iqa_cache.json')
+    parser.add_argument("--output", type=str, default=None, help='per-image scores, default: SAMPLE_DIR/iqa.csv')
+    return parser
+
+
+class ImagePairDataset(Dataset):
+    def __init__(self, sample_dir: str, gt_dir: str = None):
+        self.sample_dir = sample_dir
+        self.gt_dir = gt_dir
+        self.files = sorted(f for f in os.listdir(sample_dir) if f.lower().endswith(IMG_EXTENSIONS))
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, item):
+        file = self.files[item]
+        image = cv2.imread(os.path.join(self.sample_dir, file))[..., ::-1].copy()  # np.uint8, [0, 255], RGB
+        gt = None
+        if self.gt_dir is not None and os.path.exists(os.path.join(self.gt_dir, file)):
+            gt = cv2.imread(os.path.join(self.gt_dir, file))[..., ::-1].copy()
+        return file, image, gt
+
+
+def collate(batch):
+    # images may have different sizes, they are batched by size in IQAService
+    return [list(x) for x in zip(*batch)]
+
+
+def main():
+    args = get_parser().parse_args()
+    cache_file = args.cache_file or os.path.join(args.sample_dir, 'iqa_cache.json')
+    output = args.output or os.path.join(args.sample_dir, 'iqa.csv')
+
+    dataset = ImagePairDataset(args.sample_dir, args.gt_dir)
+    # several metric batches per loader batch, so that images of the same size can be grouped
+    dataloader = DataLoader(
+        dataset, batch_size=args.batch_size * 4, shuffle=False, collate_fn=collate,
+        num_workers=args.num_workers, prefetch_factor=4 if args.num_workers > 0 else 2,
+    )
+    print('Dataset size:', len(dataset))
+    print()
+
+    iqa = IQAService(metrics=args.metrics, batch_size=args.batch_size, cache_file=cache_file)
+    rows = []
+    for i, (files, images, gts) in enumerate(tqdm.tqdm(dataloader)):
+        results = iqa.evaluate(images, gts)
+        rows.extend(dict(file=file, **result) for file, result in zip(files, results))
+        if (i + 1) % 20 == 0:
+            iqa.save_cache()
+    iqa.save_cache()
+
+    with open(output, 'w', newline='') as f:
+        # the images of a metric group that failed get an `Error` entry instead of its scores, see IQAService
+        writer = csv.DictWriter(f, fieldnames=['file'] + args.metrics + ['Error'])
+        writer.writeheader()
+        writer.writerows(rows)
+
+    for name in args.metrics:
+        scores = [row[name] for row in rows if isinstance(row.get(name), (int, float)) and math.isfinite(row[name])]
+        if scores:
+            print(f'{name}: {sum(scores) / len(scores):.4f} ({len(scores)} images)')
+    n_errors = sum('Error' in row for row in rows)
+    if n_errors:
+        print(f'{n_errors} images with failed metrics, see the Error column')
+    print(f'Per-image scores saved to {output}')
+    print('Done.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""
+Generate a synthetic dataset with CtrLoRA, storing the final latents instead of decoded PNGs.
+
+The latents (unscaled, float16, 4 x 64 x 64 per image) are written to memory-mapped shards in the format of
+`datasets/latent_cache.py`, and the save directory can be used for finetuning as it is:
+
+    save_dir
+    ├── prompt.jsonl       # {"source": "source/0000000.png", "target": "target/0000000.png", "prompt": ..., "seed": ...}
+    ├── source             # the condition images, copied
+    └── latents            # meta.json, jpg_00000.npy, ...
+
+    python scripts/train_ctrlora_finetune.py --dataroot save_dir --latent_cache save_dir/latents ...
+
+The images are only decoded when needed, by `datasets.latent_cache.LazyDecodedDataset`, or written to
+save_dir/target by `scripts/tool_decode_latents.py`. Sample i is drawn from seed + i, so any of them can be
+regenerated alone.
+"""
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from share import *
+
+import json
+import shutil
+import argparse
+
+import cv2
+import tqdm
+import einops
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+from api import CtrLoRA
+from annotator.util import HWC3
+from cldm.ddim_hacked import DDIMSampler
+from datasets.latent_cache import LatentCacheWriter
+from utils.result_cache import files_fingerprint
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    # Records configs
+    parser.add_argument("--records", type=str, required=True,
+                        help='json list or jsonl file of the records, each with a condition image and a prompt')
+    parser.add_argument("--cond_root", type=str, default='', help='root of the condition image paths of the records')
+    parser.add_argument("--source_key", type=str, default='source', help='key of the condition image path in a record')
+    parser.add_argument("--prompt_key", type=str, default='prompt', help='key of the prompt in a record')
+    # Model configs
+    parser.add_argument("--sd_file", type=str, default='ckpts/sd15/v1-5-pruned.ckpt', help='path to the SD1.5 checkpoint')
+    parser.add_argument("--basecn_file", type=str, default='ckpts/ctrlora-basecn/ctrlora_sd15_basecn700k.ckpt',
+                        help='path to the base ControlNet checkpoint')
+    parser.add_argument("--lora_file", type=str, required=True, help='path to the LoRA checkpoint')
+    # Sampling configs
+    parser.add_argument("--save_dir", type=str, required=True, help='path to save the dataset')
+    parser.add_argument("--n_prompt", type=str, default='worst quality', help='negative prompt')
+    parser.add_argument("--ddim_steps", type=int, default=20, help='number of DDIM steps')
+    parser.add_argument("--ddim_eta", type=float, default=0.0, help='DDIM eta')
+    parser.add_argument("--cfg", type=float, default=7.5, help='unconditional guidance scale')
+    parser.add_argument("--seed", type=int, default=0, help='sample i is drawn from seed + i')
+    parser.add_argument("--shard_size", type=int, default=4096, help='number of latents per shard')
+    parser.add_argument("--bs", type=int, default=8, help='batch size')
+    parser.add_argument("--num_workers", type=int, default=4, help='number of workers reading the condition images')
+    return parser
+
+
+def load_records(path):
+    with open(path, 'r') as f:
+        if path.endswith('.jsonl'):
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
+
+
+class ConditionDataset(Dataset):
+    def __init__(self, files, save_dir):
+        self.files = files
+        self.save_dir = save_dir
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, idx):
+        file = self.files[idx]
+        # copy the condition image as it is, so that the dataset is self-contained
+        shutil.copyfile(file, os.path.join(self.save_dir, 'source', f'{idx:07d}{os.path.splitext(file)[1]}'))
+        image = HWC3(cv2.imread(file, cv2.IMREAD_COLOR)[..., ::-1])
+        # the same resizing as CustomDataset, which reads the hints back for finetuning
+        return cv2.resize(image, (512, 512), interpolation=cv2.INTER_LINEAR)
+
+
+@torch.no_grad()
+def main():
+    args = get_parser().parse_args()
+
+    records = load_records(args.records)
+    files = [os.path.join(args.cond_root, r[args.source_key]) for r in records]
+    prompts = [r[args.prompt_key] for r in records]
+    print('Number of records:', len(records))
+
+    ctrlora = CtrLoRA(num_loras=1)
+    ctrlora.create_model(sd_file=args.sd_file, basecn_file=args.basecn_file, lora_files=args.lora_file)
+    model = ctrlora.model.eval()
+    model.control_scales = [1] * 13
+    ddim_sampler = DDIMSampler(model)
+
+    os.makedirs(os.path.join(args.save_dir, 'source'), exist_ok=True)
+    writer = LatentCacheWriter(
+        os.path.join(args.save_dir, 'latents'), len(records), latent_shape=(model.channels, 64, 64),
+        keys=['jpg'], mode='sample', shard_size=args.shard_size, extra=dict(generation=dict(
+            sd_file=args.sd_file, basecn_file=args.basecn_file, lora_file=args.lora_file,
+            model=files_fingerprint(ctrlora.config_file, args.sd_file, args.basecn_file, args.lora_file),
+            n_prompt=args.n_prompt, ddim_steps=args.ddim_steps, ddim_eta=args.ddim_eta, cfg=args.cfg, seed=args.seed,
+        )),
+    )
+    dataloader = DataLoader(ConditionDataset(files, args.save_dir), batch_size=args.bs, shuffle=False,
+                            num_workers=args.num_workers, pin_memory=True)
+
+    idx = 0
+    for control in tqdm.tqdm(dataloader):
+        n = len(control)
+        control = control.to(model.device, non_blocking=True).float() / 255.0
+        control = einops.rearrange(control, 'b h w c -> b c h w')
+        cond = {"c_concat": [control], "c_crossattn": [model.get_learned_conditioning(prompts[idx:idx + n])]}
+        un_cond = {"c_concat": [control], "c_crossattn": [model.get_learned_conditioning([args.n_prompt] * n)]}
+        samples, _ = ddim_sampler.sample(
+            args.ddim_steps, n, (model.channels, 64, 64), cond, verbose=False, eta=args.ddim_eta,
+            generators=[args.seed + i for i in range(idx, idx + n)],
+            unconditional_guidance_scale=args.cfg, unconditional_conditioning=un_cond,
+        )
+        # unscaled, as the latent caches of the training datasets
+        writer.write('jpg', idx, (samples / model.scale_factor).half().cpu().numpy())
+        idx += n
+    writer.close()
+
+    # the manifest is written last, so an interrupted run does not leave a dataset that looks complete
+    with open(os.path.join(args.save_dir, 'prompt.jsonl'), 'w') as f:
+        for i, (file, prompt) in enumerate(zip(files, prompts)):
+            f.write(json.dumps(dict(
+                source=f'source/{i:07d}{os.path.splitext(file)[1]}', target=f'target/{i:07d}.png',
+                prompt=prompt, seed=args.seed + i, origin=file,
+            )) + '\n')
+
+    print(f'Latents of {len(records)} images saved to {args.save_dir}')
+    print('Done.')
+
+
+if __name__ == '__main__':
+    main()
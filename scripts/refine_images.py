@@ -0,0 +1,110 @@
+"""
+Refine or re-stain existing images with CtrLoRA (SDEdit / img2img, see `api.CtrLoRA.refine`): the images are
+noised to step strength * ddim_steps and only the remaining steps are run, with their condition images and a
+(new) prompt.
+
+The records are those of a CustomDataset (prompt.jsonl), the targets being refined with the sources as conditions:
+
+    python scripts/refine_images.py --records DATAROOT/prompt.jsonl --root DATAROOT --lora_file LORA_FILE --save_dir SAVE_DIR --strength 0.5
+
+For a dataset generated by scripts/generate_latents.py, add `--latent_cache DATAROOT/latents` to refine its latents
+directly, without decoding them first.
+"""
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from share import *
+
+import json
+import argparse
+from multiprocessing.pool import ThreadPool
+
+import tqdm
+
+from api import CtrLoRA
+from datasets.latent_cache import LatentCache
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    # Records configs
+    parser.add_argument("--records", type=str, required=True, help='json list or jsonl file of the records')
+    parser.add_argument("--root", type=str, default='', help='root of the image paths of the records')
+    parser.add_argument("--image_key", type=str, default='target', help='key of the path of the image to refine')
+    parser.add_argument("--source_key", type=str, default='source', help='key of the path of the condition image')
+    parser.add_argument("--prompt_key", type=str, default='prompt', help='key of the prompt')
+    parser.add_argument("--prompt", type=str, default=None, help='prompt for all the images, instead of the records')
+    parser.add_argument("--latent_cache", type=str, default=None,
+                        help='refine the latents of this cache (record i being latent i) instead of the images')
+    # Model configs
+    parser.add_argument("--sd_file", type=str, default='ckpts/sd15/v1-5-pruned.ckpt', help='path to the SD1.5 checkpoint')
+    parser.add_argument("--basecn_file", type=str, default='ckpts/ctrlora-basecn/ctrlora_sd15_basecn700k.ckpt',
+                        help='path to the base ControlNet checkpoint')
+    parser.add_argument("--lora_file", type=str, required=True, help='path to the LoRA checkpoint')
+    # Sampling configs
+    parser.add_argument("--save_dir", type=str, required=True, help='path to save the refined images')
+    parser.add_argument("--strength", type=float, default=0.5, help='fraction of the DDIM steps to run, in (0, 1]')
+    parser.add_argument("--n_prompt", type=str, default='worst quality', help='negative prompt')
+    parser.add_argument("--ddim_steps", type=int, default=20, help='number of DDIM steps of the full schedule')
+    parser.add_argument("--ddim_eta", type=float, default=0.0, help='DDIM eta')
+    parser.add_argument("--cfg", type=float, default=7.5, help='unconditional guidance scale')
+    parser.add_argument("--seed", type=int, default=0, help='record i is noised from seed + i')
+    parser.add_argument("--bs", type=int, default=8, help='batch size')
+    return parser
+
+
+def load_records(path):
+    with open(path, 'r') as f:
+        if path.endswith('.jsonl'):
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
+
+
+def main():
+    args = get_parser().parse_args()
+
+    records = load_records(args.records)
+    latent_cache = LatentCache(args.latent_cache) if args.latent_cache is not None else None
+    if latent_cache is not None:
+        assert len(latent_cache) == len(records), f'{len(records)} records but {len(latent_cache)} latents'
+        assert latent_cache.mode == 'sample', 'Expect a cache of sampled latents, e.g., from scripts/generate_latents.py'
+    print('Number of records:', len(records))
+
+    ctrlora = CtrLoRA(num_loras=1)
+    ctrlora.create_model(sd_file=args.sd_file, basecn_file=args.basecn_file, lora_files=args.lora_file)
+
+    def save_path(i):
+        name = os.path.splitext(os.path.basename(records[i].get(args.image_key) or f'{i:07d}'))[0]
+        return os.path.join(args.save_dir, f'{name}.png')
+
+    os.makedirs(args.save_dir, exist_ok=True)
+    # a few batches at a time, the PNGs being written by the threads meanwhile
+    chunk = args.bs * 4
+    with ThreadPool(4) as pool:
+        pending = None
+        for start in tqdm.tqdm(range(0, len(records), chunk)):
+            indices = range(start, min(start + chunk, len(records)))
+            if latent_cache is not None:
+                inits = [latent_cache.get('jpg', i) for i in indices]
+            else:
+                inits = [os.path.join(args.root, records[i][args.image_key]) for i in indices]
+            images = ctrlora.refine(
+                inits, [os.path.join(args.root, records[i][args.source_key]) for i in indices],
+                [args.prompt if args.prompt is not None else records[i][args.prompt_key] for i in indices],
+                n_prompt=args.n_prompt, strength=args.strength, ddim_steps=args.ddim_steps, scale=args.cfg,
+                seed=args.seed + start, eta=args.ddim_eta, batch_size=args.bs,
+            )
+            if pending is not None:
+                pending.get()
+            pending = pool.map_async(lambda item: item[1].save(save_path(item[0])), zip(indices, images))
+        if pending is not None:
+            pending.get()
+
+    print(f'{len(records)} images refined to {args.save_dir}')
+    print('Done.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import tqdm
+import argparse
+
+from datasets.custom_dataset import CustomDataset
+from datasets.metadata_index import build_metadata_index
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataroot", type=str, required=True, help='path to dataset')
+    parser.add_argument("--multigen20m", action='store_true', default=False, help='use multigen20m dataset')
+    parser.add_argument("--task", type=str, choices=[
+        'hed', 'canny', 'seg', 'depth', 'normal', 'openpose', 'hedsketch',
+        'bbox', 'outpainting', 'inpainting', 'blur', 'grayscale',
+    ], help='task name')
+    parser.add_argument("--save_dir", type=str, required=True, help='path to save the index')
+    return parser
+
+
+def read_jsonl(path):
+    with open(path, 'rt') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def main():
+    args = get_parser().parse_args()
+
+    if args.multigen20m:
+        path_json = os.path.join(args.dataroot, 'json_files', f'aesthetics_plus_all_group_{args.task}_all.json')
+        with open(path_json, 'rt') as f:
+            first = json.loads(f.readline())
+        # the image, the prompt and every condition path of the records
+        fields = ['source', 'prompt'] + [k for k in first if k.startswith('control_')]
+        records = read_jsonl(path_json)
+    else:
+        # the existence of source / target images is checked once here instead of at every startup
+        fields = ['source', 'target', 'prompt']
+        records = CustomDataset.load_records(args.dataroot)
+
+    length = build_metadata_index(tqdm.tqdm(records), fields, args.save_dir)
+    print(f'Indexed {length} records with fields {fields}')
+    print(f'Metadata index saved to {args.save_dir}')
+    print('Done.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tqdm
+import einops
+import argparse
+from omegaconf import OmegaConf
+
+import torch
+from torch.utils.data import DataLoader
+
+from cldm.model import load_state_dict
+from ldm.util import instantiate_from_config
+from datasets.multigen20m import MultiGen20M
+from datasets.custom_dataset import CustomDataset
+from datasets.latent_cache import LatentCacheWriter
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    # Dataset configs
+    parser.add_argument("--dataroot", type=str, required=True, help='path to dataset')
+    parser.add_argument("--multigen20m", action='store_true', default=False, help='use multigen20m dataset')
+    parser.add_argument("--task", type=str, choices=[
+        'hed', 'canny', 'seg', 'depth', 'normal', 'openpose', 'hedsketch',
+        'bbox', 'outpainting', 'inpainting', 'blur', 'grayscale',
+    ], help='task name')
+    # Model configs
+    parser.add_argument("--config", type=str, required=True, help='path to model config file')
+    parser.add_argument("--sd_ckpt", type=str, required=True, help='path to pretrained stable diffusion checkpoint')
+    # Cache configs
+    parser.add_argument("--save_dir", type=str, required=True, help='path to save the latent cache')
+    parser.add_argument("--mode", type=str, default='moments', choices=['moments', 'sample'],
+                        help='store the posterior (mean, logvar) or a single sampled z')
+    parser.add_argument("--shard_size", type=int, default=4096, help='number of records per shard')
+    parser.add_argument("--bs", type=int, default=16, help='batch size')
+    parser.add_argument("--num_workers", type=int, default=8, help='number of dataloader workers')
+    return parser
+
+
+@torch.no_grad()
+def main():
+    args = get_parser().parse_args()
+
+    # Construct Dataset, the order must match the one used for training
+    if args.multigen20m:
+        dataset = MultiGen20M(
+            path_json=os.path.join(args.dataroot, 'json_files', f'aesthetics_plus_all_group_{args.task}_all.json'),
+            path_meta=args.dataroot, task=args.task, drop_rate=0.0, random_cropping=False,
+        )
+    else:
+        dataset = CustomDataset(args.dataroot)
+    dataloader = DataLoader(dataset, batch_size=args.bs, num_workers=args.num_workers, shuffle=False)
+    print('Dataset size:', len(dataset))
+
+    # Construct the first stage model only, the rest of the LDM is not needed
+    conf = OmegaConf.load(args.config)
+    first_stage_model = instantiate_from_config(conf.model.params.first_stage_config)
+    sd_weights = load_state_dict(args.sd_ckpt, location='cpu')
+    first_stage_weights = {
+        k[len('first_stage_model.'):]: v for k, v in sd_weights.items() if k.startswith('first_stage_model.')
+    }
+    first_stage_model.load_state_dict(first_stage_weights, strict=True)
+    first_stage_model = first_stage_model.eval().cuda()
+    del sd_weights, first_stage_weights
+
+    # Encode
+    writer = None
+    idx = 0
+    for batch in tqdm.tqdm(dataloader):
+        latents = dict()
+        # the target is encoded from [-1, 1] by LatentDiffusion.get_input,
+        # the hint is encoded from [0, 1] by the CtrLoRA models, keep both as they are
+        for key in ['jpg', 'hint']:
+            x = einops.rearrange(batch[key], 'b h w c -> b c h w').float().cuda()
+            posterior = first_stage_model.encode(x)
+            latent = posterior.parameters if args.mode == 'moments' else posterior.sample()
+            latents[key] = latent.half().cpu().numpy()
+        if writer is None:
+            writer = LatentCacheWriter(
+                args.save_dir, len(dataset), latent_shape=latents['jpg'].shape[1:],
+                keys=['jpg', 'hint'], mode=args.mode, shard_size=args.shard_size,
+            )
+        for key, latent in latents.items():
+            writer.write(key, idx, latent)
+        idx += len(latents['jpg'])
+    assert writer is not None, 'Empty dataset'
+    writer.close()
+
+    print(f'Latent cache saved to {args.save_dir}')
+    print('Done.')
+
+
+if __name__ == '__main__':
+    main()
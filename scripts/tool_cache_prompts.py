@@ -0,0 +1,86 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tqdm
+import argparse
+from omegaconf import OmegaConf
+
+import torch
+
+from cldm.model import load_state_dict
+from ldm.util import instantiate_from_config
+from datasets.multigen20m import MultiGen20M
+from datasets.custom_dataset import CustomDataset
+from datasets.prompt_cache import PromptCacheWriter, unique_prompts
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    # Dataset configs
+    parser.add_argument("--dataroot", type=str, required=True, help='path to dataset')
+    parser.add_argument("--multigen20m", action='store_true', default=False, help='use multigen20m dataset')
+    parser.add_argument("--task", type=str, nargs='+', choices=[
+        'hed', 'canny', 'seg', 'depth', 'normal', 'openpose', 'hedsketch',
+        'bbox', 'outpainting', 'inpainting', 'blur', 'grayscale',
+    ], help='task name, or several tasks sharing one cache (default: the tasks of a pretraining config)')
+    # Model configs
+    parser.add_argument("--config", type=str, required=True, help='path to model config file')
+    parser.add_argument("--sd_ckpt", type=str, required=True, help='path to pretrained stable diffusion checkpoint')
+    # Cache configs
+    parser.add_argument("--save_dir", type=str, required=True, help='path to save the prompt cache')
+    parser.add_argument("--bs", type=int, default=64, help='batch size')
+    return parser
+
+
+@torch.no_grad()
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+    conf = OmegaConf.load(args.config)
+    if args.multigen20m and args.task is None:
+        # all the tasks of a pretraining config, as scripts/train_ctrlora_pretrain.py
+        args.task = OmegaConf.select(conf, 'model.params.control_stage_config.params.tasks')
+        if args.task is None:
+            parser.error('--task is required with --multigen20m, unless --config lists the tasks of pretraining')
+        args.task = list(args.task)
+
+    # Collect unique prompts, no image is read here
+    if args.multigen20m:
+        datasets = [MultiGen20M(
+            path_json=os.path.join(args.dataroot, 'json_files', f'aesthetics_plus_all_group_{task}_all.json'),
+            path_meta=args.dataroot, task=task, drop_rate=0.0, random_cropping=False,
+        ) for task in args.task]
+    else:
+        datasets = [CustomDataset(args.dataroot)]
+    prompts = unique_prompts(item['prompt'] for dataset in datasets for item in dataset.data)
+    print('Dataset size:', sum(len(dataset) for dataset in datasets))
+    print('Unique prompts (including the empty prompt):', len(prompts))
+
+    # Construct the text encoder only, the rest of the LDM is not needed
+    cond_stage_model = instantiate_from_config(conf.model.params.cond_stage_config)
+    sd_weights = load_state_dict(args.sd_ckpt, location='cpu')
+    cond_stage_weights = {
+        k[len('cond_stage_model.'):]: v for k, v in sd_weights.items() if k.startswith('cond_stage_model.')
+    }
+    cond_stage_model.load_state_dict(cond_stage_weights, strict=True)
+    cond_stage_model = cond_stage_model.eval().cuda()
+    del sd_weights, cond_stage_weights
+
+    # Encode
+    writer = None
+    for start in tqdm.tqdm(range(0, len(prompts), args.bs)):
+        c = cond_stage_model.encode(prompts[start:start+args.bs])
+        c = c.half().cpu().numpy()
+        if writer is None:
+            writer = PromptCacheWriter(args.save_dir, prompts, embedding_shape=c.shape[1:])
+        writer.write(start, c)
+    assert writer is not None
+    writer.close()
+
+    print(f'Prompt cache saved to {args.save_dir}')
+    print('Done.')
+
+
+if __name__ == '__main__':
+    main()
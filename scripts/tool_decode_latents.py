@@ -0,0 +1,103 @@
+"""
+Decode the latents of a cache into PNG images, e.g., those of a dataset generated by `scripts/generate_latents.py`
+when its images are needed (evaluation, visual checks), in batches on the GPU.
+
+With a generated dataset (`--dataroot`), the images are written to the `target` paths of its prompt.jsonl, which
+turns it into a regular CustomDataset; otherwise they are written to `--save_dir` as {index}.png.
+"""
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import argparse
+from multiprocessing.pool import ThreadPool
+
+import cv2
+import tqdm
+from omegaconf import OmegaConf
+
+import torch
+
+from cldm.model import load_state_dict
+from ldm.util import instantiate_from_config
+from datasets.latent_cache import LatentCache, LazyDecodedDataset
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataroot", type=str, default=None,
+                        help='path to a dataset generated by scripts/generate_latents.py')
+    parser.add_argument("--latent_cache", type=str, default=None, help='path to the latents, default: DATAROOT/latents')
+    parser.add_argument("--key", type=str, default='jpg', help='key of the latents to decode')
+    parser.add_argument("--save_dir", type=str, default=None, help='where to save the images, if not a generated dataset')
+    parser.add_argument("--indices", type=str, default=None, help='e.g., 0-99,150, default: all the latents')
+    parser.add_argument("--config", type=str, default='configs/inference/ctrlora_sd15_rank128_1lora.yaml',
+                        help='path to model config file')
+    parser.add_argument("--sd_ckpt", type=str, required=True, help='path to pretrained stable diffusion checkpoint')
+    parser.add_argument("--bs", type=int, default=16, help='batch size')
+    parser.add_argument("--num_threads", type=int, default=8, help='number of threads encoding the PNGs')
+    return parser
+
+
+def parse_indices(indices, length):
+    if indices is None:
+        return list(range(length))
+    result = []
+    for part in indices.split(','):
+        start, _, end = part.partition('-')
+        result.extend(range(int(start), int(end or start) + 1))
+    return result
+
+
+@torch.no_grad()
+def main():
+    args = get_parser().parse_args()
+    assert args.dataroot is not None or (args.latent_cache is not None and args.save_dir is not None), \
+        'Set --dataroot, or --latent_cache and --save_dir'
+    cache = LatentCache(args.latent_cache or os.path.join(args.dataroot, 'latents'))
+    if args.dataroot is not None:
+        with open(os.path.join(args.dataroot, 'prompt.jsonl'), 'r') as f:
+            paths = [os.path.join(args.dataroot, json.loads(line)['target']) for line in f]
+        assert len(paths) == len(cache), f'{len(paths)} records but {len(cache)} latents'
+    else:
+        paths = [os.path.join(args.save_dir, f'{i}.png') for i in range(len(cache))]
+
+    # Construct the first stage model only, the rest of the LDM is not needed
+    conf = OmegaConf.load(args.config)
+    first_stage_model = instantiate_from_config(conf.model.params.first_stage_config)
+    sd_weights = load_state_dict(args.sd_ckpt, location='cpu')
+    first_stage_weights = {
+        k[len('first_stage_model.'):]: v for k, v in sd_weights.items() if k.startswith('first_stage_model.')
+    }
+    first_stage_model.load_state_dict(first_stage_weights, strict=True)
+    first_stage_model = first_stage_model.eval().cuda()
+    del sd_weights, first_stage_weights
+
+    decoded = LazyDecodedDataset(cache, first_stage_model, key=args.key, batch_size=args.bs)
+    indices = parse_indices(args.indices, len(cache))
+    for path in {os.path.dirname(paths[i]) for i in indices}:
+        os.makedirs(path, exist_ok=True)
+
+    def save(item):
+        idx, image = item
+        cv2.imwrite(paths[idx], image[..., ::-1])
+
+    # the PNGs are encoded by the threads while the next batch is decoded
+    with ThreadPool(args.num_threads) as pool:
+        pending = []
+        for start in tqdm.tqdm(range(0, len(indices), args.bs)):
+            batch = indices[start:start + args.bs]
+            pending.append(pool.map_async(save, zip(batch, decoded.decode(batch))))
+            if len(pending) > 2:
+                pending.pop(0).get()
+        for p in pending:
+            p.get()
+
+    print(f'{len(indices)} images decoded')
+    print('Done.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""
+Fit the previewer of cldm/preview.py to the SD VAE: a linear projection 4 -> 3 from the scaled latents to the
+decoded images at 1/8 resolution (least squares), and optionally (`--train_decoder`) a tiny convolutional decoder
+at full resolution, both against the output of AutoencoderKL.decode on latents of the given images.
+
+    python scripts/tool_fit_preview_decoder.py --image_dir IMAGE_DIR --sd_ckpt SD_CKPT --save_path SAVE_PATH [--train_decoder]
+"""
+
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import time
+import random
+import argparse
+
+import cv2
+import tqdm
+import numpy as np
+from omegaconf import OmegaConf
+
+import torch
+import torch.nn.functional as F
+
+from cldm.model import load_state_dict
+from cldm.preview import LatentPreviewer, TinyDecoder
+from ldm.util import instantiate_from_config
+from utils.fid import list_images
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image_dir", type=str, required=True, help='path to the images to fit on')
+    parser.add_argument("--config", type=str, default='configs/inference/ctrlora_sd15_rank128_1lora.yaml',
+                        help='path to model config file')
+    parser.add_argument("--sd_ckpt", type=str, required=True, help='path to pretrained stable diffusion checkpoint')
+    parser.add_argument("--save_path", type=str, required=True, help='path to save the previewer')
+    parser.add_argument("--n_images", type=int, default=512, help='number of images to fit on')
+    parser.add_argument("--size", type=int, default=256, help='size of the random crops of the images')
+    parser.add_argument("--train_decoder", action='store_true', default=False, help='also train the tiny decoder')
+    parser.add_argument("--decoder_channels", type=int, default=64, help='channels of the tiny decoder')
+    parser.add_argument("--steps", type=int, default=5000, help='training steps of the tiny decoder')
+    parser.add_argument("--lr", type=float, default=1e-3, help='learning rate of the tiny decoder')
+    parser.add_argument("--bs", type=int, default=16, help='batch size')
+    parser.add_argument("--seed", type=int, default=0, help='random seed')
+    return parser
+
+
+def read_crop(file, size):
+    image = cv2.imread(file, cv2.IMREAD_COLOR)[..., ::-1]
+    h, w = image.shape[:2]
+    if min(h, w) < size:
+        image = cv2.resize(image, (max(size, w * size // min(h, w)), max(size, h * size // min(h, w))))
+        h, w = image.shape[:2]
+    y, x = random.randint(0, h - size), random.randint(0, w - size)
+    return image[y:y + size, x:x + size]
+
+
+def psnr(x, y):
+    # x, y in [-1, 1]
+    return (10 * torch.log10(4 / F.mse_loss(x, y))).item()
+
+
+def main():
+    args = get_parser().parse_args()
+    random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    # Construct the first stage model only, the rest of the LDM is not needed
+    conf = OmegaConf.load(args.config)
+    scale_factor = conf.model.params.scale_factor
+    first_stage_model = instantiate_from_config(conf.model.params.first_stage_config)
+    sd_weights = load_state_dict(args.sd_ckpt, location='cpu')
+    first_stage_weights = {
+        k[len('first_stage_model.'):]: v for k, v in sd_weights.items() if k.startswith('first_stage_model.')
+    }
+    first_stage_model.load_state_dict(first_stage_weights, strict=True)
+    first_stage_model = first_stage_model.eval().cuda()
+    del sd_weights, first_stage_weights
+
+    # Latents (scaled, as the pred_x0 of the sampler) and their decoding by the VAE
+    files = list_images(args.image_dir)
+    files = random.sample(files, min(args.n_images, len(files)))
+    latents, decoded = [], []
+    with torch.no_grad():
+        for i in tqdm.tqdm(range(0, len(files), args.bs), desc='Encoding'):
+            x = np.stack([read_crop(file, args.size) for file in files[i:i + args.bs]])
+            x = torch.from_numpy(x).cuda().permute(0, 3, 1, 2).float() / 127.5 - 1
+            z = first_stage_model.encode(x).mode() * scale_factor
+            latents.append(z.cpu())
+            decoded.append(first_stage_model.decode(z / scale_factor).clamp(-1, 1).half().cpu())
+    latents, decoded = torch.cat(latents), torch.cat(decoded)
+    n_val = max(len(latents) // 10, 1)
+    val_z, val_x = latents[:n_val].cuda(), decoded[:n_val].cuda().float()
+    train_z, train_x = latents[n_val:], decoded[n_val:]
+
+    # Linear projection, least squares with a bias on the pixels at 1/8 resolution
+    target = F.avg_pool2d(train_x.float(), 8)
+    A = torch.cat([train_z, torch.ones_like(train_z[:, :1])], dim=1).permute(0, 2, 3, 1).reshape(-1, 5).double()
+    B = target.permute(0, 2, 3, 1).reshape(-1, 3).double()
+    solution = torch.linalg.lstsq(A, B).solution.float()  # 5 x 3
+    state = dict(linear_weight=solution[:4].T.tolist(), linear_bias=solution[4].tolist(), decoder=None)
+
+    previewer = LatentPreviewer().cuda()
+    default_psnr = psnr(F.interpolate(previewer(val_z), scale_factor=8, mode='bilinear'), val_x)
+    with torch.no_grad():
+        previewer.linear.weight.copy_(solution[:4].T[..., None, None])
+        previewer.linear.bias.copy_(solution[4])
+    linear_psnr = psnr(F.interpolate(previewer(val_z), scale_factor=8, mode='bilinear'), val_x)
+    print(f'Validation PSNR against the VAE: default projection {default_psnr:.2f}dB, fitted {linear_psnr:.2f}dB')
+
+    # Tiny decoder, trained against the VAE at full resolution
+    if args.train_decoder:
+        decoder = TinyDecoder(channels=args.decoder_channels).cuda()
+        optimizer = torch.optim.Adam(decoder.parameters(), lr=args.lr)
+        scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, args.steps)
+        for _ in tqdm.tqdm(range(args.steps), desc='Training the decoder'):
+            idx = torch.randint(len(train_z), (args.bs, ))
+            z, x = train_z[idx].cuda(), train_x[idx].cuda().float()
+            loss = F.l1_loss(decoder(z), x)
+            optimizer.zero_grad(set_to_none=True)
+            loss.backward()
+            optimizer.step()
+            scheduler.step()
+        decoder.eval()
+        with torch.no_grad():
+            print(f'Validation PSNR against the VAE: tiny decoder {psnr(decoder(val_z).clamp(-1, 1), val_x):.2f}dB')
+        state.update(decoder=decoder.state_dict(), decoder_channels=args.decoder_channels)
+        previewer.decoder = decoder
+
+    # Cost of a preview against a full decode, on a 512x512 batch
+    z = torch.randn(args.bs, 4, 64, 64, device='cuda')
+    with torch.no_grad():
+        for name, fn in [('VAE decode', lambda: first_stage_model.decode(z / scale_factor)), ('preview', lambda: previewer(z))]:
+            fn()
+            torch.cuda.synchronize()
+            start = time.perf_counter()
+            for _ in range(5):
+                fn()
+            torch.cuda.synchronize()
+            print(f'{name}: {(time.perf_counter() - start) / 5 / args.bs * 1000:.2f}ms per 512x512 image')
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.save_path)), exist_ok=True)
+    torch.save(state, args.save_path)
+    print(f'Previewer saved to {args.save_path}')
+    print('Done.')
+
+
+if __name__ == '__main__':
+    main()
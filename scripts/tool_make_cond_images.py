@@ -2,18 +2,36 @@ import os
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+import io
 import cv2
+import json
 import tqdm
 import random
 import hashlib
 import argparse
+import threading
 import numpy as np
 from PIL import Image
 import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
 
 from annotator.util import HWC3, resize_image
 
 
+# detectors running a network on the GPU
+NEURAL_DETECTORS = [
+    'hed', 'seg', 'depth', 'normal', 'openpose', 'hedsketch', 'bbox',
+    'lineart', 'lineart_anime', 'lineart_anime_with_color_prompt', 'densepose',
+]
+# detectors whose output only depends on the image and the params, not on the random seed of the file
+DETERMINISTIC_DETECTORS = [
+    'hed', 'seg', 'depth', 'normal', 'openpose', 'bbox', 'lineart', 'lineart_anime', 'densepose',
+    'canny', 'grayscale', 'palette', 'illusion',
+]
+
+RESOLUTION = 512
+
+
 def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--input_dir", type=str, required=True)
@@ -25,7 +43,14 @@ def get_parser():
         'jpeg', 'palette', 'pixel', 'illusion', 'densepose',                    # proposed new conditions
         'lineart_anime_with_color_prompt', 'inpainting_brush',
     ], required=True)
-    parser.add_argument('--n_processes', type=int, default=1)
+    parser.add_argument('--n_processes', type=int, default=1, help='number of worker processes, each with its own detector')
+    parser.add_argument('--devices', type=str, default=None,
+                        help='comma separated GPUs of the workers of neural detectors, all visible GPUs by default')
+    parser.add_argument('--batch_size', type=int, default=16, help='number of images per detector call')
+    parser.add_argument('--num_io_threads', type=int, default=8, help='number of threads reading / writing images per worker')
+    parser.add_argument('--params', type=str, default=None, help='json of detector params overriding the defaults')
+    parser.add_argument('--cache_dir', type=str, default='./tmp/cond_cache', help='path to the cache of condition images')
+    parser.add_argument('--no_cache', action='store_true', default=False, help='do not read or write the cache')
     return parser
 
 
@@ -42,27 +67,23 @@ def set_seed_by_hash(obj_id):
     random.seed(seed)
 
 
-def func(file):
+def get_params(name, file, extra_params=None):
+    """The params of the detector for `file`, drawn from the random state seeded by the file name."""
     set_seed_by_hash(file)
-
-    img = Image.open(os.path.join(args.input_dir, file))
-    img = np.array(img)
-    img = resize_image(HWC3(img), 512)
-
     params = dict()
-    if args.detector == 'canny':
+    if name == 'canny':
         low_threshold = 100
         high_threshold = 200
         params = dict(low_threshold=low_threshold, high_threshold=high_threshold)
-    elif args.detector == 'outpainting':
+    elif name == 'outpainting':
         rand_h = np.random.randint(20, 80)
         rand_w = np.random.randint(20, 80)
         params = dict(rand_h=rand_h, rand_w=rand_w)
-    elif args.detector == 'blur':
+    elif name == 'blur':
         ksize = discrete_normal(5, 50)
         ksize = ksize * 2 + 1
         params = dict(ksize=ksize)
-    elif args.detector == 'inpainting':
+    elif name == 'inpainting':
         rand_h = discrete_normal(20, 80)
         rand_h_1 = discrete_normal(20, 80)
         rand_w = discrete_normal(20, 80)
@@ -72,132 +93,270 @@ def func(file):
         if rand_w > rand_w_1:
             rand_w, rand_w_1 = rand_w_1, rand_w
         params = dict(rand_h=rand_h, rand_h_1=rand_h_1, rand_w=rand_w, rand_w_1=rand_w_1)
-    elif args.detector == 'jpeg':
+    elif name == 'jpeg':
         jpeg_quality = discrete_normal(10, 30)
         params = dict(jpeg_quality=jpeg_quality)
-    elif args.detector == 'pixel':
+    elif name == 'pixel':
         n_colors = np.random.randint(8, 17)  # [8,16] -> 3-4 bits
         scale = np.random.randint(4, 9)  # [4,8]
         params = dict(n_colors=n_colors, scale=scale, down_interpolation=cv2.INTER_LANCZOS4)
-    elif args.detector == 'lineart':
+    elif name == 'lineart':
         coarse = np.random.rand() > 0.5
         params = dict(coarse=coarse)
-    elif args.detector == 'mlsd':
+    elif name == 'mlsd':
         thr_v = np.random.rand() * 1.9 + 0.1  # [0.1, 2.0]
         thr_d = np.random.rand() * 19.9 + 0.1  # [0.1, 20.0]
         params = dict(thr_v=thr_v, thr_d=thr_d)
-
-    img = detector(img, **params)
-    if args.detector == 'openpose' and img.sum() == 0:
-        return
-    if img is None:
-        return
-    if args.detector == 'depth':
-        img = img[0]
-    elif args.detector == 'normal':
-        img = img[1]
-    img = HWC3(img)
-    img = Image.fromarray(img)
-    img.save(os.path.join(args.output_dir, file), quality=95, icc_profile=None)
+    params.update(extra_params or {})
+    return params
 
 
-if __name__ == '__main__':
-    # Arguments
-    args = get_parser().parse_args()
-    args.n_processes = args.n_processes or mp.cpu_count()
-    print(f'Using {args.n_processes} processes')
-
-    # Build detector
-    if args.detector == 'canny':
+def build_detector(name):
+    if name == 'canny':
         from annotator.canny import CannyDetector
-        detector = CannyDetector()
-    elif args.detector == 'hed':
+        return CannyDetector()
+    elif name == 'hed':
         from annotator.hed import HEDdetector
-        detector = HEDdetector()
-    elif args.detector == 'seg':
+        return HEDdetector()
+    elif name == 'seg':
         from annotator.uniformer import UniformerDetector
-        detector = UniformerDetector()
-    elif args.detector in ['depth', 'normal']:
+        return UniformerDetector()
+    elif name in ['depth', 'normal']:
         from annotator.midas import MidasDetector
-        detector = MidasDetector()
-    elif args.detector == 'openpose':
+        return MidasDetector()
+    elif name == 'openpose':
         from annotator.openpose import OpenposeDetector
-        detector = OpenposeDetector()
-    elif args.detector == 'hedsketch':
+        return OpenposeDetector()
+    elif name == 'hedsketch':
         from annotator.hedsketch import HEDSketchDetector
-        detector = HEDSketchDetector()
-    elif args.detector == 'bbox':
+        return HEDSketchDetector()
+    elif name == 'bbox':
         from annotator.bbox import BBoxDetector
-        detector = BBoxDetector()
-    elif args.detector == 'outpainting':
+        return BBoxDetector()
+    elif name == 'outpainting':
         from annotator.outpainting import Outpainter
-        detector = Outpainter()
-    elif args.detector == 'blur':
+        return Outpainter()
+    elif name == 'blur':
         from annotator.blur import Blurrer
-        detector = Blurrer()
-    elif args.detector == 'grayscale':
+        return Blurrer()
+    elif name == 'grayscale':
         from annotator.grayscale import GrayscaleConverter
-        detector = GrayscaleConverter()
-    elif args.detector == 'inpainting':
+        return GrayscaleConverter()
+    elif name == 'inpainting':
         from annotator.inpainting import Inpainter
-        detector = Inpainter()
-    elif args.detector == 'lineart':
+        return Inpainter()
+    elif name == 'lineart':
         from annotator.lineart import LineartDetector
-        detector = LineartDetector()
-    elif args.detector == 'lineart_anime':
+        return LineartDetector()
+    elif name == 'lineart_anime':
         from annotator.lineart_anime import LineartAnimeDetector
-        detector = LineartAnimeDetector()
-    elif args.detector == 'shuffle':
+        return LineartAnimeDetector()
+    elif name == 'shuffle':
         from annotator.shuffle import ContentShuffleDetector
-        detector = ContentShuffleDetector()
-    elif args.detector == 'mlsd':
+        return ContentShuffleDetector()
+    elif name == 'mlsd':
         from annotator.mlsd import MLSDdetector
-        detector = MLSDdetector()
-    elif args.detector == 'jpeg':
+        return MLSDdetector()
+    elif name == 'jpeg':
         from annotator.jpeg import JpegCompressor
-        detector = JpegCompressor()
-    elif args.detector == 'palette':
+        return JpegCompressor()
+    elif name == 'palette':
         from annotator.palette import PaletteDetector
-        detector = PaletteDetector()
-    elif args.detector == 'pixel':
+        return PaletteDetector()
+    elif name == 'pixel':
         from annotator.pixel import Pixelater
-        detector = Pixelater()
-    elif args.detector == 'illusion':
+        return Pixelater()
+    elif name == 'illusion':
         from annotator.illusion import IllusionConverter
-        detector = IllusionConverter()
-    elif args.detector == 'densepose':
+        return IllusionConverter()
+    elif name == 'densepose':
         from annotator.densepose import DenseposeDetector
-        detector = DenseposeDetector()
-    elif args.detector == 'lineart_anime_with_color_prompt':
+        return DenseposeDetector()
+    elif name == 'lineart_anime_with_color_prompt':
         from annotator.lineart_anime_with_color_prompt import LineartAnimeWithColorPromptConverter
-        detector = LineartAnimeWithColorPromptConverter()
-    elif args.detector == 'inpainting_brush':
+        return LineartAnimeWithColorPromptConverter()
+    elif name == 'inpainting_brush':
         from annotator.inpainting_brush import BrushInpainter
-        detector = BrushInpainter()
-    else:
-        raise NotImplementedError
+        return BrushInpainter()
+    raise NotImplementedError
+
+
+def get_cache_key(image_hash, name, params, file, ext):
+    """Content address of a condition image: the hash of the input, the detector and everything else it depends on."""
+    key = dict(image=image_hash, detector=name, params=params, resolution=RESOLUTION, ext=ext.lower())
+    if name not in DETERMINISTIC_DETECTORS:
+        key['seed'] = file  # the detector draws from the random state seeded by the file name
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def postprocess(name, img):
+    """The condition image to save, None if there is none (e.g., no person detected by openpose)."""
+    if img is None:
+        return None
+    if name == 'openpose' and img.sum() == 0:
+        return None
+    if name == 'depth':
+        img = img[0]
+    elif name == 'normal':
+        img = img[1]
+    return HWC3(img)
+
+
+def encode(img, ext):
+    if img is None:
+        return b''  # empty cache entry: the detector gave no output for this image
+    buf = io.BytesIO()
+    Image.fromarray(img).save(buf, format=Image.registered_extensions()[ext.lower()], quality=95, icc_profile=None)
+    return buf.getvalue()
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # a tmp name of its own, as several workers can write the same output or cache entry at once
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+# state of the current worker process, see init_worker
+_worker = dict()
+
+
+def init_worker(args, devices, worker_ids):
+    """Build the detector of this worker, on its own GPU for neural detectors."""
+    worker_id = worker_ids.get()
+    if devices:
+        import torch
+        torch.cuda.set_device(devices[worker_id % len(devices)])
+    _worker.update(
+        args=args,
+        detector=build_detector(args.detector),
+        io_pool=ThreadPool(args.num_io_threads),
+        extra_params=json.loads(args.params) if args.params else None,
+    )
+
+
+def detect(files, images, params_list):
+    detector, name = _worker['detector'], _worker['args'].detector
+    # detectors with a batched implementation take a list of images sharing the same params, so the batch is
+    # split into groups of equal params (e.g., the two values of `coarse` drawn for lineart)
+    detect_batch = getattr(detector, 'detect_batch', None)
+    if detect_batch is not None:
+        groups = []
+        for i, params in enumerate(params_list):
+            for group_params, indices in groups:
+                if params == group_params:
+                    indices.append(i)
+                    break
+            else:
+                groups.append((params, [i]))
+        outputs = [None] * len(images)
+        for params, indices in groups:
+            for i, out in zip(indices, detect_batch([images[i] for i in indices], **params)):
+                outputs[i] = out
+        return outputs
+    outputs = []
+    for file, img in zip(files, images):
+        # same random state as when drawing the params, for the detectors drawing more random numbers
+        params = get_params(name, file, _worker['extra_params'])
+        outputs.append(detector(img, **params))
+    return outputs
+
+
+def process_batch(files):
+    """Make the condition images of `files`, reusing the cached ones. Returns the number of (cached, computed, empty)."""
+    args, io_pool = _worker['args'], _worker['io_pool']
+    name, use_cache = args.detector, not args.no_cache
+
+    def read(file):
+        with open(os.path.join(args.input_dir, file), 'rb') as f:
+            data = f.read()
+        return data, hashlib.sha256(data).hexdigest()
+
+    def cache_path(key, file):
+        return os.path.join(args.cache_dir, key[:2], key + os.path.splitext(file)[1])
+
+    def copy_cached(item):
+        file, key = item
+        with open(cache_path(key, file), 'rb') as f:
+            data = f.read()
+        if data:
+            write_file(os.path.join(args.output_dir, file), data)
+        return len(data) > 0
+
+    def decode(data):
+        img = np.array(Image.open(io.BytesIO(data)))
+        return resize_image(HWC3(img), RESOLUTION)
+
+    def save(item):
+        file, key, img = item
+        data = encode(postprocess(name, img), os.path.splitext(file)[1])
+        if use_cache:
+            write_file(cache_path(key, file), data)
+        if data:
+            write_file(os.path.join(args.output_dir, file), data)
+        return len(data) > 0
+
+    contents = io_pool.map(read, files)
+    params_list = [get_params(name, file, _worker['extra_params']) for file in files]
+    keys = [get_cache_key(image_hash, name, params, file, os.path.splitext(file)[1])
+            for file, (_, image_hash), params in zip(files, contents, params_list)]
+    cached = [use_cache and os.path.isfile(cache_path(key, file)) for file, key in zip(files, keys)]
+
+    n_empty = 0
+    hits = [(file, key) for file, key, hit in zip(files, keys, cached) if hit]
+    n_empty += sum(not ok for ok in io_pool.map(copy_cached, hits))
+
+    todo = [i for i, hit in enumerate(cached) if not hit]
+    if todo:
+        images = io_pool.map(decode, [contents[i][0] for i in todo])
+        outputs = detect([files[i] for i in todo], images, [params_list[i] for i in todo])
+        n_empty += sum(not ok for ok in io_pool.map(save, [(files[i], keys[i], out) for i, out in zip(todo, outputs)]))
+    return len(hits), len(todo), n_empty
+
+
+if __name__ == '__main__':
+    # Arguments
+    args = get_parser().parse_args()
+    args.n_processes = args.n_processes or mp.cpu_count()
+    print(f'Using {args.n_processes} processes')
+
+    devices = None
+    if args.detector in NEURAL_DETECTORS:
+        if args.devices is not None:
+            devices = [int(d) for d in args.devices.split(',')]
+        else:
+            import torch
+            devices = list(range(torch.cuda.device_count()))
+        print(f'Using GPUs {devices}')
 
     os.makedirs(args.output_dir, exist_ok=True)
+    files = sorted(os.listdir(args.input_dir))
+    batches = [files[i:i + args.batch_size] for i in range(0, len(files), args.batch_size)]
 
+    n_cached, n_computed, n_empty = 0, 0, 0
+    pbar = tqdm.tqdm(total=len(files))
     if args.n_processes == 1:
         # Single process
-        files = os.listdir(args.input_dir)
-        for f in tqdm.tqdm(files):
-            func(f)
-
+        worker_ids = mp.Queue()
+        worker_ids.put(0)
+        init_worker(args, devices, worker_ids)
+        results = map(process_batch, batches)
     else:
-        if args.detector in [
-            'hed', 'seg', 'depth', 'normal', 'openpose', 'hedsketch', 'bbox',
-            'lineart', 'lineart_anime', 'lineart_anime_with_color_prompt', 'densepose',
-        ]:
-            raise ValueError(f'{args.detector} detector is not compatible with multiprocessing, please pass --n_processes=1')
-        # Multiprocessing
-        mp.set_start_method('fork')
-        pool = mp.Pool(processes=args.n_processes)
-        files = os.listdir(args.input_dir)
-        for _ in tqdm.tqdm(pool.imap(func, files), total=len(files)):
-            pass
+        # Multiprocessing, each worker builds its own detector (on its own GPU), so CUDA is never forked
+        ctx = mp.get_context('spawn')
+        worker_ids = ctx.Queue()
+        for i in range(args.n_processes):
+            worker_ids.put(i)
+        pool = ctx.Pool(processes=args.n_processes, initializer=init_worker, initargs=(args, devices, worker_ids))
+        results = pool.imap_unordered(process_batch, batches)
+    for cached, computed, empty in results:
+        n_cached, n_computed, n_empty = n_cached + cached, n_computed + computed, n_empty + empty
+        pbar.update(cached + computed)
+    pbar.close()
+    if args.n_processes > 1:
         pool.close()
         pool.join()
-
+    print(f'{n_computed} computed, {n_cached} from the cache, {n_empty} without condition image')
     print('Done')
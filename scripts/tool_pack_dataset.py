@@ -0,0 +1,105 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import tqdm
+import argparse
+import itertools
+from multiprocessing.pool import ThreadPool
+
+from datasets.custom_dataset import CustomDataset
+from datasets.metadata_index import build_metadata_index
+from datasets.storage import PackedShardWriter, LmdbWriter
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataroot", type=str, required=True, help='path to dataset')
+    parser.add_argument("--multigen20m", action='store_true', default=False, help='use multigen20m dataset')
+    parser.add_argument("--task", type=str, choices=[
+        'hed', 'canny', 'seg', 'depth', 'normal', 'openpose', 'hedsketch',
+        'bbox', 'outpainting', 'inpainting', 'blur', 'grayscale',
+    ], help='task name')
+    parser.add_argument("--save_dir", type=str, required=True, help='path to save the packed dataset')
+    parser.add_argument("--format", type=str, default='shards', choices=['shards', 'lmdb'], help='pack format')
+    parser.add_argument("--shard_size", type=int, default=1024, help='max size of each shard in MB')
+    parser.add_argument("--num_threads", type=int, default=16, help='number of threads reading the files')
+    return parser
+
+
+def read_jsonl(path):
+    with open(path, 'rt') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def main():
+    args = get_parser().parse_args()
+
+    # Collect the records and the keys (paths relative to dataroot) of their images
+    if args.multigen20m:
+        path_json = os.path.join(args.dataroot, 'json_files', f'aesthetics_plus_all_group_{args.task}_all.json')
+        with open(path_json, 'rt') as f:
+            first = json.loads(f.readline())
+        fields = ['source', 'prompt'] + [k for k in first if k.startswith('control_')]
+        key_control = f'control_{args.task}'
+
+        def get_keys(record):
+            source = record['source'][2:] if record['source'].startswith('./') else record['source']
+            return ['images/' + source, 'conditions/' + record[key_control]]
+
+        def get_records():
+            return read_jsonl(path_json)
+    else:
+        fields = ['source', 'target', 'prompt']
+
+        def get_keys(record):
+            return [record['source'], record['target']]
+
+        def get_records():
+            return CustomDataset.load_records(args.dataroot)
+
+    # Pack the records into the metadata index, and their files into the storage
+    os.makedirs(args.save_dir, exist_ok=True)
+    if args.format == 'shards':
+        writer = PackedShardWriter(args.save_dir, shard_size=args.shard_size << 20)
+    else:
+        writer = LmdbWriter(args.save_dir)
+
+    def read_file(key):
+        try:
+            with open(os.path.join(args.dataroot, key), 'rb') as f:
+                return key, f.read()
+        except FileNotFoundError:
+            return key, None
+
+    keys = iter(key for record in get_records() for key in get_keys(record))
+    n_missing = 0
+    pbar = tqdm.tqdm()
+    with ThreadPool(args.num_threads) as pool:
+        # the keys are fed in bounded chunks, as imap consumes its whole input up front and the records of
+        # MultiGen-20M do not fit in memory; imap keeps the order, the files are written sequentially
+        while True:
+            chunk = list(itertools.islice(keys, args.num_threads * 1024))
+            if not chunk:
+                break
+            for key, data in pool.imap(read_file, chunk, chunksize=64):
+                pbar.update()
+                if data is None:
+                    n_missing += 1  # skipped, the dataset falls back to the next record as with loose files
+                    continue
+                writer.add(key, data)
+    pbar.close()
+    writer.close()
+    print(f'{n_missing} missing files skipped')
+
+    # a second pass over the records, instead of holding all of them in memory
+    length = build_metadata_index(get_records(), fields, os.path.join(args.save_dir, 'metadata'))
+    print(f'Indexed {length} records with fields {fields}')
+    print(f'Packed dataset saved to {args.save_dir}')
+    print('Done.')
+
+
+if __name__ == '__main__':
+    main()
@@ -14,8 +14,12 @@ from torch.utils.data import DataLoader, Subset
 
 from datasets.multigen20m import MultiGen20M
 from datasets.custom_dataset import CustomDataset
-from cldm.logger import ImageLogger, CheckpointEveryNSteps
+from datasets.prompt_cache import PromptCache
+from datasets.dataset_collate import collate_fn
+from datasets.bucket_sampler import BucketBatchSampler
+from cldm.logger import ImageLogger, CheckpointEveryNSteps, TrainableCheckpointEveryNSteps, StageProfiler, CheckpointPolicyTuner
 from cldm.model import create_model, load_state_dict
+from ldm.modules.checkpoint_policy import CheckpointPolicy
 from cldm.hack import enable_sliced_attention
 
 
@@ -30,6 +34,16 @@ if __name__ == "__main__":
         'bbox', 'outpainting', 'inpainting', 'blur', 'grayscale',
     ], help='task name')
     parser.add_argument("--subset", type=int, default=0, help='train on a subset of the dataset')
+    parser.add_argument("--latent_cache", type=str, default=None, help='path to latents made by tool_cache_latents.py')
+    parser.add_argument("--prompt_cache", type=str, default=None, help='path to text embeddings made by tool_cache_prompts.py')
+    parser.add_argument("--metadata_index", type=str, default=None, help='path to index made by tool_build_metadata_index.py')
+    parser.add_argument("--storage", type=str, default=None, help='path to packed images made by tool_pack_dataset.py')
+    parser.add_argument("--bucket_max_area", type=int, default=None,
+                        help='train at native resolution with aspect-ratio buckets of at most this many pixels')
+    parser.add_argument("--bucket_max_tokens", type=int, default=None,
+                        help='latent tokens per batch with buckets, bs 512x512 images by default')
+    parser.add_argument("--bucket_max_bs", type=int, default=None,
+                        help='max batch size of the buckets of small images, bs by default')
     # Model configs
     parser.add_argument("--config", type=str, required=True, help='path to model config file')
     parser.add_argument("--sd_ckpt", type=str, required=True, help='path to pretrained stable diffusion checkpoint')
@@ -43,8 +57,21 @@ if __name__ == "__main__":
     parser.add_argument("--precision", type=int, default=32, help='precision')
     parser.add_argument("--save_memory", action='store_true', default=False, help='save memory using sliced attention')
     parser.add_argument("--img_logger_freq", type=int, default=1000, help='img logger freq')
+    parser.add_argument("--img_logger_background", action='store_true', default=False,
+                        help='sample logged images in a background thread on a copy of the model')
     parser.add_argument("--ckpt_logger_freq", type=int, default=1000, help='ckpt logger freq')
+    parser.add_argument("--ckpt_trainable_only", action='store_true', default=False,
+                        help='save only the trained weights (and optimizer states) in the background')
+    parser.add_argument("--ckpt_keep_last", type=int, default=None, help='only keep the last N trainable-only checkpoints')
+    parser.add_argument("--profile", action='store_true', default=False, help='profile the stages of the training steps')
+    parser.add_argument("--profile_trace", action='store_true', default=False, help='also save a chrome trace of the profiled steps')
+    parser.add_argument("--act_ckpt", type=str, default='config', choices=['config', 'tune', 'all', 'none'],
+                        help='activation checkpointing policy, `config` keeps use_checkpoint of the config')
+    parser.add_argument("--act_ckpt_memory", type=float, default=0.9,
+                        help='memory budget of --act_ckpt tune, as a fraction of the device memory')
     args = parser.parse_args()
+    if args.multigen20m and args.bucket_max_area is not None:
+        parser.error('--bucket_max_area is only supported for custom datasets')
 
     # Save memory
     if args.save_memory:
@@ -54,24 +81,45 @@ if __name__ == "__main__":
     if args.multigen20m:
         dataset = MultiGen20M(
             path_json=os.path.join(args.dataroot, 'json_files', f'aesthetics_plus_all_group_{args.task}_all.json'),
-            path_meta=args.dataroot, task=args.task, drop_rate=args.drop_rate,
+            path_meta=args.dataroot, task=args.task, drop_rate=args.drop_rate, latent_cache=args.latent_cache,
+            prompt_cache=args.prompt_cache, metadata_index=args.metadata_index, storage=args.storage, uint8=True,
         )
     else:
-        dataset = CustomDataset(args.dataroot, drop_rate=args.drop_rate)
+        dataset = CustomDataset(
+            args.dataroot, drop_rate=args.drop_rate, latent_cache=args.latent_cache, prompt_cache=args.prompt_cache,
+            metadata_index=args.metadata_index, storage=args.storage, uint8=True, bucket_max_area=args.bucket_max_area,
+        )
+    buckets = dataset.buckets if args.bucket_max_area is not None else None
     if args.subset > 0:
         dataset = Subset(dataset, range(args.subset))
-    dataloader = DataLoader(dataset, num_workers=16, batch_size=args.bs, shuffle=True)
+        buckets = buckets[:args.subset] if buckets is not None else None
+    if buckets is not None:
+        # batches of images of the same bucket, sharded across the devices by the sampler itself
+        batch_sampler = BucketBatchSampler(
+            buckets, max_tokens=args.bucket_max_tokens or args.bs * 4096, max_batch_size=args.bucket_max_bs or args.bs,
+        )
+        dataloader = DataLoader(dataset, num_workers=16, batch_sampler=batch_sampler, collate_fn=collate_fn)
+    else:
+        dataloader = DataLoader(dataset, num_workers=16, batch_size=args.bs, shuffle=True, collate_fn=collate_fn)
     print('Dataset size:', len(dataset))
     print('Number of devices:', torch.cuda.device_count())
-    print('Batch size per device:', args.bs)
     print('Gradient accumulation:', args.gradacc)
-    print('Total batch size:', args.bs * torch.cuda.device_count() * args.gradacc)
+    if buckets is not None:
+        # the batch size depends on the bucket, the budget of the batches is in latent tokens
+        print('Buckets (batch size per device):\n' + batch_sampler.summary())
+        print('Latent tokens per device:', batch_sampler.max_tokens)
+        print('Total latent tokens:', batch_sampler.max_tokens * torch.cuda.device_count() * args.gradacc)
+    else:
+        print('Batch size per device:', args.bs)
+        print('Total batch size:', args.bs * torch.cuda.device_count() * args.gradacc)
 
     # Construct Model
     model = create_model(args.config).cpu()
     model.learning_rate = args.lr
     model.sd_locked = True
     model.only_mid_control = False
+    if args.prompt_cache is not None:
+        model.prompt_cache = PromptCache(args.prompt_cache)
 
     scratch_dict = model.state_dict()
 
@@ -115,13 +163,25 @@ if __name__ == "__main__":
     gc.collect()
 
     # Build Trainer
-    logger_img = ImageLogger(batch_frequency=args.img_logger_freq)
-    logger_checkpoint = CheckpointEveryNSteps(save_step_frequency=args.ckpt_logger_freq)
+    logger_img = ImageLogger(batch_frequency=args.img_logger_freq, background=args.img_logger_background)
+    if args.ckpt_trainable_only:
+        logger_checkpoint = TrainableCheckpointEveryNSteps(
+            save_step_frequency=args.ckpt_logger_freq, keep_last=args.ckpt_keep_last,
+        )
+    else:
+        logger_checkpoint = CheckpointEveryNSteps(save_step_frequency=args.ckpt_logger_freq)
+    callbacks = [logger_img, logger_checkpoint]
+    if args.act_ckpt != 'config':
+        policy = {'tune': None, 'all': CheckpointPolicy(), 'none': CheckpointPolicy(mode='none')}[args.act_ckpt]
+        callbacks.append(CheckpointPolicyTuner(policy=policy, max_memory=args.act_ckpt_memory))
+    if args.profile:
+        # first, so that the optimizer stage ends before the other callbacks run
+        callbacks.insert(0, StageProfiler(chrome_trace=args.profile_trace))
     if args.name is None:
         args.name = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
     trainer = pl.Trainer(
         strategy='ddp', accelerator='gpu', devices=-1, accumulate_grad_batches=args.gradacc,
-        max_steps=args.max_steps, precision=args.precision, callbacks=[logger_img, logger_checkpoint],
+        replace_sampler_ddp=buckets is None, max_steps=args.max_steps, precision=args.precision, callbacks=callbacks,
         default_root_dir=os.path.join('/data07/shared/xxu/cvpr/may07', args.name),
     )
 
@@ -16,8 +16,11 @@ from torch.utils.data import DataLoader, ConcatDataset
 from datasets.multigen20m import MultiGen20M
 from datasets.multi_task_scheduler import BatchSchedulerSampler
 from datasets.dataset_collate import collate_fn
-from cldm.logger import ImageLogger, CheckpointEveryNSteps
+from datasets.prompt_cache import PromptCache
+from cldm.cldm_ctrlora_pretrain import TaskLoRADDPPlugin
+from cldm.logger import ImageLogger, CheckpointEveryNSteps, SamplerStateCallback, StageProfiler, CheckpointPolicyTuner
 from cldm.model import create_model, load_state_dict
+from ldm.modules.checkpoint_policy import CheckpointPolicy
 from cldm.hack import enable_sliced_attention
 
 
@@ -25,6 +28,14 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="args")
     # Dataset configs
     parser.add_argument("--dataroot", type=str, required=True, help='path to dataset')
+    parser.add_argument("--metadata_index_root", type=str, default=None,
+                        help='directory with one tool_build_metadata_index.py index per task')
+    parser.add_argument("--storage_root", type=str, default=None,
+                        help='directory with one tool_pack_dataset.py pack per task')
+    parser.add_argument("--prompt_cache", type=str, default=None,
+                        help='path to text embeddings of all the tasks made by tool_cache_prompts.py')
+    parser.add_argument("--task_weights", type=float, nargs='+', default=None,
+                        help='sampling weight of each task, in the order of the config (default: one batch per task in turn)')
     # Model configs
     parser.add_argument("--config", type=str, required=True, help='path to model config file')
     parser.add_argument("--sd_ckpt", type=str, required=True, help='path to pretrained stable diffusion checkpoint')
@@ -38,7 +49,18 @@ if __name__ == "__main__":
     parser.add_argument("--precision", type=int, default=32, help='precision')
     parser.add_argument("--save_memory", action='store_true', default=False, help='save memory using sliced attention')
     parser.add_argument("--img_logger_freq", type=int, default=10000, help='img logger freq')
+    parser.add_argument("--img_logger_background", action='store_true', default=False,
+                        help='sample logged images in a background thread on a copy of the model')
     parser.add_argument("--ckpt_logger_freq", type=int, default=10000, help='ckpt logger freq')
+    parser.add_argument("--resume", type=str, default=None, help='path to a checkpoint to resume training from')
+    parser.add_argument("--find_unused_parameters", action='store_true', default=False,
+                        help='let DDP scan for unused parameters, only needed if parameters outside the LoRAs are unused')
+    parser.add_argument("--profile", action='store_true', default=False, help='profile the stages of the training steps')
+    parser.add_argument("--profile_trace", action='store_true', default=False, help='also save a chrome trace of the profiled steps')
+    parser.add_argument("--act_ckpt", type=str, default='config', choices=['config', 'tune', 'all', 'none'],
+                        help='activation checkpointing policy, `config` keeps use_checkpoint of the config')
+    parser.add_argument("--act_ckpt_memory", type=float, default=0.9,
+                        help='memory budget of --act_ckpt tune, as a fraction of the device memory')
     args = parser.parse_args()
 
     # Save memory
@@ -52,11 +74,17 @@ if __name__ == "__main__":
         MultiGen20M(
             path_json=os.path.join(args.dataroot, 'json_files', f'aesthetics_plus_all_group_{task}_all.json'),
             path_meta=args.dataroot, task=task, drop_rate=0.3,
+            metadata_index=os.path.join(args.metadata_index_root, task) if args.metadata_index_root else None,
+            storage=os.path.join(args.storage_root, task) if args.storage_root else None, uint8=True,
+            prompt_cache=args.prompt_cache,
         ) for task in tasks
     ])
+    sampler = BatchSchedulerSampler(
+        dataset=dataset, batch_size=args.bs, distributed=True, shuffle=True, weights=args.task_weights,
+    )
     dataloader = DataLoader(
         dataset=dataset, num_workers=16, batch_size=args.bs, persistent_workers=True, collate_fn=collate_fn,
-        sampler=BatchSchedulerSampler(dataset=dataset, batch_size=args.bs, distributed=True, shuffle=True),
+        sampler=sampler,
     )
     print('Dataset size:', len(dataset))
     print('Number of devices:', torch.cuda.device_count())
@@ -69,6 +97,8 @@ if __name__ == "__main__":
     model.learning_rate = args.lr
     model.sd_locked = True
     model.only_mid_control = False
+    if args.prompt_cache is not None:
+        model.prompt_cache = PromptCache(args.prompt_cache)
 
     scratch_dict = model.state_dict()
 
@@ -110,15 +140,23 @@ if __name__ == "__main__":
     gc.collect()
 
     # Build Trainer
-    logger_img = ImageLogger(batch_frequency=args.img_logger_freq)
+    logger_img = ImageLogger(batch_frequency=args.img_logger_freq, background=args.img_logger_background)
     logger_checkpoint = CheckpointEveryNSteps(save_step_frequency=args.ckpt_logger_freq)
+    sampler_state = SamplerStateCallback(sampler)
+    callbacks = [logger_img, logger_checkpoint, sampler_state]
+    if args.act_ckpt != 'config':
+        policy = {'tune': None, 'all': CheckpointPolicy(), 'none': CheckpointPolicy(mode='none')}[args.act_ckpt]
+        callbacks.append(CheckpointPolicyTuner(policy=policy, max_memory=args.act_ckpt_memory))
+    if args.profile:
+        # first, so that the optimizer stage ends before the other callbacks run
+        callbacks.insert(0, StageProfiler(chrome_trace=args.profile_trace))
     if args.name is None:
         args.name = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
     trainer = pl.Trainer(
-        strategy='ddp', accelerator='gpu', devices=-1, accumulate_grad_batches=args.gradacc, replace_sampler_ddp=False,
-        max_steps=args.max_steps, precision=args.precision, callbacks=[logger_img, logger_checkpoint],
+        strategy=TaskLoRADDPPlugin(find_unused_parameters=args.find_unused_parameters), accelerator='gpu', devices=-1, accumulate_grad_batches=args.gradacc, replace_sampler_ddp=False,
+        max_steps=args.max_steps, precision=args.precision, callbacks=callbacks,
         default_root_dir=os.path.join('runs', args.name),
     )
 
     # Train!
-    trainer.fit(model, dataloader)
+    trainer.fit(model, dataloader, ckpt_path=args.resume)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+FID / KID between a generated set and a reference set of images, with the InceptionV3 of torch-fidelity (the
+same network and weights as `fidelity --fid --kid`, through torchmetrics).
+
+The features of a set are extracted in streaming batches into a memory-mapped .npy file, together with their
+mean and covariance, in a cache keyed by the hash of the set (file names, sizes and modification times). The
+reference set is thus only extracted once, and each new checkpoint is scored against the cached statistics.
+"""
+
+import os
+import json
+import hashlib
+
+import cv2
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+IMG_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.webp')
+FEATURE_NAME = 'inception-v3-compat'
+FEATURE_DIM = 2048
+
+
+# ----------------------------Features----------------------------
+def list_images(image_dir):
+    files = []
+    for root, _, names in os.walk(image_dir):
+        files.extend(os.path.join(root, name) for name in names if name.lower().endswith(IMG_EXTENSIONS))
+    return sorted(files)
+
+
+def dataset_hash(image_dir, files=None):
+    '''Hash of the images of image_dir, changing when an image is added, removed or modified.'''
+    files = list_images(image_dir) if files is None else files
+    h = hashlib.sha1(f'{FEATURE_NAME}-{FEATURE_DIM}'.encode())
+    for file in files:
+        st = os.stat(file)
+        h.update(f'{os.path.relpath(file, image_dir)}:{st.st_size}:{st.st_mtime_ns}\n'.encode())
+    return h.hexdigest()
+
+
+class ImageDataset(Dataset):
+    def __init__(self, files):
+        self.files = files
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, item):
+        image = cv2.imread(self.files[item])[..., ::-1]  # np.uint8, [0, 255], RGB
+        return torch.from_numpy(image.transpose(2, 0, 1).copy())  # torch.uint8, c x h x w
+
+
+def collate_list(batch):
+    return batch
+
+
+class InceptionFeatures:
+    '''Pool features of InceptionV3 (2048-d), for uint8 images of any size, resized to 299x299 by the network.'''
+    def __init__(self, device=None):
+        from torchmetrics.image.fid import NoTrainInceptionV3
+        self.device = torch.device(device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+        self.model = NoTrainInceptionV3(name=FEATURE_NAME, features_list=[str(FEATURE_DIM)]).to(self.device).eval()
+
+    @torch.no_grad()
+    def __call__(self, images):
+        '''
+        Input:
+            images: list of c x h x w uint8 tensors, batched by size
+        Output:
+            n x 2048, float32 numpy array, in the order of images
+        '''
+        out = np.empty((len(images), FEATURE_DIM), dtype=np.float32)
+        by_shape = dict()
+        for i, im in enumerate(images):
+            by_shape.setdefault(tuple(im.shape), []).append(i)
+        for indices in by_shape.values():
+            x = torch.stack([images[i] for i in indices]).to(self.device, non_blocking=True)
+            out[indices] = self.model(x).reshape(len(indices), -1).float().cpu().numpy()
+        return out
+
+
+def extract_features(extractor, image_dir, cache_dir, batch_size=64, num_workers=8, verbose=True):
+    '''
+    Features, mean and covariance of the images of image_dir, from the cache if already extracted.
+    Output:
+        (n x 2048 read-only memory-mapped float32 array, mean: 2048 float64, cov: 2048 x 2048 float64)
+    '''
+    files = list_images(image_dir)
+    if len(files) < 2:
+        raise ValueError(f'Expect at least 2 images in {image_dir}, found {len(files)}')
+    key = dataset_hash(image_dir, files)
+    feat_file = os.path.join(cache_dir, f'{key}.npy')
+    stats_file = os.path.join(cache_dir, f'{key}_stats.npz')
+
+    if not (os.path.exists(feat_file) and os.path.exists(stats_file)):
+        os.makedirs(cache_dir, exist_ok=True)
+        dataloader = DataLoader(
+            ImageDataset(files), batch_size=batch_size, shuffle=False, num_workers=num_workers,
+            collate_fn=collate_list, pin_memory=True,
+        )
+        tmp_file = f'{feat_file}.tmp.npy'
+        feats = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32, shape=(len(files), FEATURE_DIM))
+        # streaming sums in float64, for the mean and covariance
+        total = np.zeros(FEATURE_DIM, dtype=np.float64)
+        total_outer = np.zeros((FEATURE_DIM, FEATURE_DIM), dtype=np.float64)
+        n = 0
+        iterator = dataloader
+        if verbose:
+            import tqdm
+            iterator = tqdm.tqdm(dataloader, desc=f'Extracting features of {image_dir}')
+        for images in iterator:
+            f = extractor(images)
+            feats[n:n + len(f)] = f
+            f = f.astype(np.float64)
+            total += f.sum(axis=0)
+            total_outer += f.T @ f
+            n += len(f)
+        feats.flush()
+        del feats
+        mean = total / n
+        cov = (total_outer - n * np.outer(mean, mean)) / (n - 1)
+        np.savez(stats_file, mean=mean, cov=cov)
+        os.replace(tmp_file, feat_file)  # the features are complete
+        with open(os.path.join(cache_dir, f'{key}.json'), 'w') as fp:
+            json.dump(dict(image_dir=os.path.abspath(image_dir), n_images=n, features=FEATURE_NAME), fp)
+    elif verbose:
+        print(f'Loaded cached features of {image_dir} ({key})')
+
+    stats = np.load(stats_file)
+    return np.load(feat_file, mmap_mode='r'), stats['mean'], stats['cov']
+
+
+# -----------------------------Metrics-----------------------------
+def _sqrt_psd(cov):
+    eigvals, eigvecs = np.linalg.eigh(cov)
+    return (eigvecs * np.sqrt(np.clip(eigvals, 0, None))) @ eigvecs.T
+
+
+def _fid(mean_gen, cov_gen, mean_ref, cov_ref, sqrt_cov_ref):
+    # tr(sqrtm(cov_gen @ cov_ref)) = tr(sqrtm(sqrt_cov_ref @ cov_gen @ sqrt_cov_ref)), the latter being
+    # symmetric PSD, whose eigenvalues are computed much faster and more stably than scipy.linalg.sqrtm
+    eigvals = np.linalg.eigvalsh(sqrt_cov_ref @ cov_gen @ sqrt_cov_ref)
+    tr_covmean = np.sqrt(np.clip(eigvals, 0, None)).sum()
+    diff = mean_gen - mean_ref
+    return float(diff @ diff + np.trace(cov_gen) + np.trace(cov_ref) - 2 * tr_covmean)
+
+
+def _normal_ci(value, std, confidence):
+    from scipy.stats import norm
+    z = norm.ppf(0.5 + confidence / 2)
+    return float(value - z * std), float(value + z * std)
+
+
+def fid_with_ci(feats_gen, mean_ref, cov_ref, n_bootstrap=100, confidence=0.95, seed=0):
+    '''
+    FID of the generated features against the reference statistics, and its confidence interval from the
+    bootstrap standard error over resamplings of the generated set (the reference statistics being fixed).
+    The interval is the normal one around the FID: the bootstrap percentiles are not used, as the duplicated
+    images of a resampling bias its FID upwards.
+    Output:
+        (fid, (low, high))
+    '''
+    feats_gen = np.asarray(feats_gen, dtype=np.float64)
+    sqrt_cov_ref = _sqrt_psd(cov_ref)
+    fid = _fid(feats_gen.mean(axis=0), np.cov(feats_gen, rowvar=False), mean_ref, cov_ref, sqrt_cov_ref)
+    if n_bootstrap <= 0:
+        return fid, (float('nan'), float('nan'))
+    rng = np.random.default_rng(seed)
+    n = len(feats_gen)
+    fids = []
+    for _ in range(n_bootstrap):
+        f = feats_gen[rng.integers(0, n, n)]
+        fids.append(_fid(f.mean(axis=0), np.cov(f, rowvar=False), mean_ref, cov_ref, sqrt_cov_ref))
+    return fid, _normal_ci(fid, np.std(fids, ddof=1), confidence)
+
+
+def _mmd2_unbiased(x, y, degree=3, coef0=1):
+    # polynomial kernel k(x, y) = (x.y / d + coef0) ** degree, as in torch-fidelity
+    d = x.shape[1]
+    k_xx = (x @ x.T / d + coef0) ** degree
+    k_yy = (y @ y.T / d + coef0) ** degree
+    k_xy = (x @ y.T / d + coef0) ** degree
+    m = len(x)
+    return float((k_xx.sum() - np.trace(k_xx)) / (m * (m - 1)) + (k_yy.sum() - np.trace(k_yy)) / (m * (m - 1))
+                 - 2 * k_xy.mean())
+
+
+def kid_with_ci(feats_gen, feats_ref, n_subsets=100, subset_size=1000, confidence=0.95, seed=0):
+    '''
+    KID as in torch-fidelity: the mean of the unbiased MMD^2 over random subsets of both sets, with the
+    percentile interval of the subset estimates.
+    Output:
+        (kid mean, kid std, (low, high))
+    '''
+    rng = np.random.default_rng(seed)
+    subset_size = min(subset_size, len(feats_gen), len(feats_ref))
+    mmds = []
+    for _ in range(n_subsets):
+        x = np.asarray(feats_gen[np.sort(rng.choice(len(feats_gen), subset_size, replace=False))], dtype=np.float64)
+        y = np.asarray(feats_ref[np.sort(rng.choice(len(feats_ref), subset_size, replace=False))], dtype=np.float64)
+        mmds.append(_mmd2_unbiased(x, y))
+    mmds = np.array(mmds)
+    alpha = (1 - confidence) / 2 * 100
+    ci = float(np.percentile(mmds, alpha)), float(np.percentile(mmds, 100 - alpha))
+    return float(mmds.mean()), float(mmds.std()), ci
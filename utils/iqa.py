@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import os
+import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import pyiqa
+from PIL import Image
+
+# name: (pyiqa metric, options, full-reference)
+METRICS = {
+    "CLIP-IQA": ('clipiqa', {}, False),
+    "MUSIQ": ('musiq', {}, False),
+    "NIQE": ('niqe', {}, False),
+    "BRISQUE": ('brisque', {}, False),
+    "NRQM": ('nrqm', {}, False),
+    "PSNR": ('psnr', dict(test_y_channel=True, color_space='ycbcr'), True),
+    "SSIM": ('ssim', dict(test_y_channel=True, color_space='ycbcr'), True),
+    "LPIPS": ('lpips', {}, True),
+    "ST-LPIPS": ('stlpips', {}, True),
+}
+
+
+def to_uint8(im):
+    '''
+    Input:
+        im: PIL image, h x w x c / h x w uint8 numpy array, or c x h x w float [0,1] torch tensor
+    Output:
+        h x w x 3, uint8 numpy array, i.e., what would be saved to and read back from a PNG file
+    '''
+    if isinstance(im, Image.Image):
+        im = np.asarray(im.convert('RGB'))
+    elif isinstance(im, torch.Tensor):
+        im = (im.detach().float().clamp(0, 1) * 255.0).round().to(torch.uint8).permute(1, 2, 0).cpu().numpy()
+    if im.dtype != np.uint8:
+        raise TypeError(f'uint8 image expected, got {im.dtype}')
+    if im.ndim == 2:
+        im = im[:, :, None]
+    if im.shape[2] == 1:
+        im = np.concatenate([im] * 3, axis=2)
+    return np.ascontiguousarray(im[:, :, :3])
+
+
+def content_hash(im):
+    return hashlib.sha1(str(im.shape).encode() + im.tobytes()).hexdigest()
+
+
+class IQAService:
+    '''
+    Image quality assessment of in-memory images with pyiqa, batched per metric, e.g.:
+        iqa = IQAService(cache_file='iqa_cache.json')
+        results = iqa.evaluate(images, refs)               # list of {metric: score}, one per image
+        future = iqa.submit(images, refs)                  # the same in a background thread
+        ...                                                # e.g., generate the next images meanwhile
+        results = future.result()
+
+    The no-reference metrics (image only) and the full-reference metrics (image and ground truth, skipped for
+    the images without one) are evaluated in two groups: the images of the same size are stacked into batches
+    of `batch_size`, uploaded to the device once per batch and scored by all the metrics of the group. The
+    scores are cached by the content of the images (and of the ground truth), so that only new images are
+    scored; the cache is kept in `cache_file` if given, see save_cache(). If a group fails (e.g., a full-reference
+    metric on an unusual ground truth), the scores of the other group are still returned, and the images missing
+    scores get an "Error" entry with the message instead.
+
+    On CUDA, submit() runs the metrics on a separate stream, so that they overlap with the generation running on
+    the default stream.
+    '''
+    def __init__(self, metrics=None, device=None, batch_size=16, amp=True, cache_file=None):
+        self.device = torch.device(device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+        self.batch_size = batch_size
+        self.amp = amp and self.device.type == 'cuda'
+        names = list(METRICS) if metrics is None else list(metrics)
+        unknown = [name for name in names if name not in METRICS]
+        if unknown:
+            raise ValueError(f'Unknown metrics {unknown}, expect some of {list(METRICS)}')
+
+        # metrics with the same pyiqa name and options share the same instance
+        self.metrics = dict()
+        instances = dict()
+        for name in names:
+            metric, options, _ = METRICS[name]
+            key = (metric, json.dumps(options, sort_keys=True))
+            if key not in instances:
+                instances[key] = pyiqa.create_metric(metric, **options).to(self.device).eval()
+            self.metrics[name] = instances[key]
+        self.groups = [
+            ('nr', [name for name in names if not METRICS[name][2]]),
+            ('fr', [name for name in names if METRICS[name][2]]),
+        ]
+
+        self.cache_file = cache_file
+        self.cache = dict()
+        if cache_file is not None and os.path.exists(cache_file):
+            with open(cache_file, 'r') as f:
+                self.cache = json.load(f)
+
+        self._lock = threading.Lock()
+        self._executor = None
+        self._stream = None
+
+    def _score(self, metric_names, images, refs):
+        x = torch.from_numpy(np.stack(images)).to(self.device).permute(0, 3, 1, 2).float() / 255.0
+        y = None
+        if refs is not None:
+            y = torch.from_numpy(np.stack(refs)).to(self.device).permute(0, 3, 1, 2).float() / 255.0
+        scores = dict()
+        for name in metric_names:
+            with torch.cuda.amp.autocast(enabled=self.amp):
+                out = self.metrics[name](x) if y is None else self.metrics[name](x, y)
+            scores[name] = out.float().flatten().tolist()
+        return scores
+
+    @torch.no_grad()
+    def evaluate(self, images, refs=None):
+        '''
+        Input:
+            images: list of images, see to_uint8()
+            refs: list of ground-truth images (or None) of the same length, for the full-reference metrics
+        Output:
+            list of {metric: score}, one per image
+        '''
+        images = [to_uint8(im) for im in images]
+        refs = [None] * len(images) if refs is None else [None if r is None else to_uint8(r) for r in refs]
+        if len(refs) != len(images):
+            raise ValueError(f'Expect {len(images)} reference images, got {len(refs)}')
+        img_hashes = [content_hash(im) for im in images]
+        keys = {
+            'nr': img_hashes,
+            'fr': [None if r is None else f'{h}:{content_hash(r)}' for h, r in zip(img_hashes, refs)],
+        }
+
+        errors = dict()
+        with self._lock:
+            for kind, names in self.groups:
+                if not names:
+                    continue
+                # images with a missing score, by size
+                todo = dict()
+                for i, key in enumerate(keys[kind]):
+                    if key is None or all(name in self.cache.get(key, {}) for name in names):
+                        continue
+                    shape = (images[i].shape, None if refs[i] is None else refs[i].shape)
+                    todo.setdefault(shape, []).append(i)
+                try:
+                    for indices in todo.values():
+                        for s in range(0, len(indices), self.batch_size):
+                            batch = indices[s:s + self.batch_size]
+                            scores = self._score(
+                                names, [images[i] for i in batch], None if kind == 'nr' else [refs[i] for i in batch],
+                            )
+                            for j, i in enumerate(batch):
+                                self.cache.setdefault(keys[kind][i], {}).update(
+                                    {name: scores[name][j] for name in names}
+                                )
+                except Exception as e:
+                    # the scores of the other group (and of the batches done so far) are still returned
+                    errors[kind] = f'{", ".join(names)}: {type(e).__name__}: {e}'
+
+        results = []
+        for i in range(len(images)):
+            result, failed = dict(), []
+            for kind, names in self.groups:
+                key = keys[kind][i]
+                if key is None:
+                    continue
+                cached = self.cache.get(key, {})
+                result.update({name: cached[name] for name in names if name in cached})
+                if kind in errors and not all(name in cached for name in names):
+                    failed.append(errors[kind])
+            result = {name: result[name] for name in self.metrics if name in result}
+            if failed:
+                result['Error'] = '; '.join(failed)
+            results.append(result)
+        return results
+
+    def _evaluate_on_stream(self, images, refs):
+        if self._stream is None:
+            return self.evaluate(images, refs)
+        with torch.cuda.stream(self._stream):
+            results = self.evaluate(images, refs)
+        self._stream.synchronize()
+        return results
+
+    def submit(self, images, refs=None):
+        '''Same as evaluate(), in a background thread, returns a concurrent.futures.Future of the results.'''
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+            if self.device.type == 'cuda':
+                self._stream = torch.cuda.Stream(self.device)
+        # convert in the calling thread, so that the inputs can be modified or freed right after
+        images = [to_uint8(im) for im in images]
+        refs = None if refs is None else [None if r is None else to_uint8(r) for r in refs]
+        return self._executor.submit(self._evaluate_on_stream, images, refs)
+
+    def save_cache(self):
+        if self.cache_file is None:
+            return
+        with self._lock:
+            tmp = f'{self.cache_file}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.cache, f)
+            os.replace(tmp, self.cache_file)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self.save_cache()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+Content-addressed cache of generated images on local disk, with a size-bounded LRU eviction.
+
+A sample drawn with a per-sample seed is a pure function of its inputs (condition pixels, prompts, sampler
+params, seed and model weights), so its result is stored under the hash of these inputs, as
+    cache_dir/ab/abcdef....png
+The PNGs are lossless, so a hit returns exactly the uint8 image the model gave. The recency of an entry is the
+modification time of its file, touched on each hit, so that several processes can share the cache directory.
+"""
+
+import os
+import json
+import uuid
+import hashlib
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+
+def array_hash(im):
+    '''sha256 of the shape, dtype and pixels of a numpy array.'''
+    im = np.ascontiguousarray(im)
+    return hashlib.sha256(f'{im.shape}{im.dtype}'.encode() + im.tobytes()).hexdigest()
+
+
+def files_fingerprint(*files):
+    '''
+    Fingerprint of weight files, changing when one of them is replaced or modified. It is computed from the
+    paths, sizes and modification times, as hashing checkpoints of several GB would take longer than sampling.
+    '''
+    h = hashlib.sha256()
+    for file in files:
+        st = os.stat(file)
+        h.update(f'{os.path.abspath(file)}:{st.st_size}:{st.st_mtime_ns}\n'.encode())
+    return h.hexdigest()
+
+
+class ResultCache:
+    '''
+    e.g.:
+        cache = ResultCache('./tmp/gen_cache', max_bytes=10 * 2 ** 30)
+        key = cache.key(cond=array_hash(cond), prompt=prompt, seed=seed, ...)
+        image = cache.get(key)               # h x w x 3 uint8 RGB array, or None
+        if image is None:
+            image = generate(...)
+            cache.put(key, image)
+    '''
+    def __init__(self, cache_dir, max_bytes=10 * 2 ** 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits, self.misses = 0, 0
+        self._lock = threading.Lock()
+        # key -> size in bytes, from the least to the most recently used
+        self._entries = OrderedDict()
+        self._total = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        found = []
+        for root, _, names in os.walk(cache_dir):
+            for name in names:
+                if name.endswith('.png'):
+                    st = os.stat(os.path.join(root, name))
+                    found.append((st.st_mtime_ns, name[:-4], st.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._total += size
+
+    @staticmethod
+    def key(**fields):
+        '''Content address of a result: the hash of everything it depends on.'''
+        return hashlib.sha256(json.dumps(fields, sort_keys=True, default=str).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f'{key}.png')
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def total_bytes(self):
+        return self._total
+
+    def get(self, key):
+        '''The cached RGB uint8 image of key, or None.'''
+        image = cv2.imread(self.path(key), cv2.IMREAD_COLOR)
+        with self._lock:
+            if image is None:
+                self.misses += 1
+                if key in self._entries:  # evicted by another process
+                    self._total -= self._entries.pop(key)
+                return None
+            self.hits += 1
+            if key not in self._entries:  # written by another process
+                self._entries[key] = os.path.getsize(self.path(key))
+                self._total += self._entries[key]
+            self._entries.move_to_end(key)
+        try:
+            os.utime(self.path(key))
+        except OSError:
+            pass
+        return image[..., ::-1].copy()
+
+    def put(self, key, image):
+        '''Store an RGB uint8 image under key, then evict the least recently used entries beyond max_bytes.'''
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = cv2.imencode('.png', np.ascontiguousarray(image[..., ::-1]))[1].tobytes()
+        tmp = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)  # readers never see a partial file
+        with self._lock:
+            self._total += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            evicted = []
+            while self._total > self.max_bytes and len(self._entries) > 1:
+                old, size = self._entries.popitem(last=False)
+                self._total -= size
+                evicted.append(old)
+        for old in evicted:
+            try:
+                os.remove(self.path(old))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        return dict(entries=len(self._entries), bytes=self._total, hits=self.hits, misses=self.misses)
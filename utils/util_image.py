@@ -5,8 +5,10 @@
 import sys
 import cv2
 import math
+import functools
 import torch
 import random
+import torch.nn.functional as F
 import numpy as np
 from scipy import fft
 from pathlib import Path
@@ -115,6 +117,122 @@ def batch_SSIM(img, imclean, border=0, ycbcr=False):
         SSIM += calculate_ssim(Iclean[i,:,].transpose((1,2,0)), Img[i,:,].transpose((1,2,0)), border)
     return SSIM
 
+# The functions below compute the same metrics as batch_PSNR / batch_SSIM, but on whole batches on the device
+# of the inputs, without the round trip through numpy. The images are quantized to [0, 255] levels as
+# img_as_ubyte does, so that the values match calculate_psnr / calculate_ssim (MATLAB) up to float precision.
+def quantize_th(im, border=0, ycbcr=False, dtype=torch.float32):
+    '''
+    Input:
+        im: b x c x h x w, float [0,1], torch tensor
+    Output:
+        b x c x h x w (c=1 if ycbcr), the uint8 levels [0,255] of im as float tensor, with the borders cropped
+    '''
+    if ycbcr:
+        im = rgb2ycbcrTorch(im, True)
+    h, w = im.shape[-2:]
+    im = im[..., border:h-border, border:w-border]
+    return (im.to(dtype).clamp(0, 1) * 255.0).round()
+
+def ssim_th(im1, im2):
+    '''
+    SSIM of each image, the same as ssim() averaged over the channels.
+    Input:
+        im1, im2: b x c x h x w, [0, 255], float torch tensor
+    Output:
+        b, torch tensor
+    '''
+    C1 = (0.01 * 255)**2
+    C2 = (0.03 * 255)**2
+
+    chn = im1.shape[1]
+    x = torch.arange(11, dtype=im1.dtype, device=im1.device) - 5
+    kernel = torch.exp(-x**2 / (2 * 1.5**2))
+    kernel = kernel / kernel.sum()  # cv2.getGaussianKernel(11, 1.5)
+
+    # the 5 maps are filtered at once, with the separable gaussian window, keeping the valid part only
+    maps = torch.cat([im1, im2, im1 * im1, im2 * im2, im1 * im2], dim=1)
+    maps = F.conv2d(maps, kernel.view(1, 1, 11, 1).expand(5 * chn, 1, 11, 1), groups=5 * chn)
+    maps = F.conv2d(maps, kernel.view(1, 1, 1, 11).expand(5 * chn, 1, 1, 11), groups=5 * chn)
+    mu1, mu2, im1_sq, im2_sq, im12 = maps.chunk(5, dim=1)
+
+    mu1_sq = mu1**2
+    mu2_sq = mu2**2
+    mu1_mu2 = mu1 * mu2
+    sigma1_sq = im1_sq - mu1_sq
+    sigma2_sq = im2_sq - mu2_sq
+    sigma12 = im12 - mu1_mu2
+
+    ssim_map = ((2 * mu1_mu2 + C1) * (2 * sigma12 + C2)) / ((mu1_sq + mu2_sq + C1) *
+                                                            (sigma1_sq + sigma2_sq + C2))
+    return ssim_map.flatten(1).mean(dim=1)
+
+def psnr_th(im1, im2):
+    '''
+    PSNR of each image, the same as calculate_psnr().
+    Input:
+        im1, im2: b x c x h x w, [0, 255], float torch tensor
+    Output:
+        b, torch tensor, inf for identical images
+    '''
+    mse = (im1 - im2).pow(2).flatten(1).mean(dim=1)
+    return 20 * torch.log10(255.0 / mse.sqrt())
+
+@torch.no_grad()
+def batch_PSNR_th(img, imclean, border=0, ycbcr=False, dtype=torch.float32):
+    '''
+    Same as batch_PSNR, but returns the PSNR of each image as a tensor on the device of the inputs.
+    img, imclean: b x c x h x w, float [0,1], torch tensor
+    '''
+    if not img.shape == imclean.shape:
+        raise ValueError('Input images must have the same dimensions.')
+    return psnr_th(quantize_th(imclean, border, ycbcr, dtype), quantize_th(img, border, ycbcr, dtype))
+
+@torch.no_grad()
+def batch_SSIM_th(img, imclean, border=0, ycbcr=False, dtype=torch.float32):
+    '''
+    Same as batch_SSIM, but returns the SSIM of each image as a tensor on the device of the inputs.
+    img, imclean: b x c x h x w, float [0,1], torch tensor
+    '''
+    if not img.shape == imclean.shape:
+        raise ValueError('Input images must have the same dimensions.')
+    return ssim_th(quantize_th(imclean, border, ycbcr, dtype), quantize_th(img, border, ycbcr, dtype))
+
+class MetricMeter:
+    '''
+    Streaming mean of the PSNR / SSIM of batches of images, accumulated on the device, e.g.:
+        meter = MetricMeter(border=4, ycbcr=True)
+        for img, imclean in loader:
+            meter.update(img.cuda(), imclean.cuda())
+        psnr, ssim = meter.compute()
+    The only host synchronization is in compute().
+    '''
+    def __init__(self, border=0, ycbcr=False, dtype=torch.float32):
+        self.border = border
+        self.ycbcr = ycbcr
+        self.dtype = dtype
+        self.reset()
+
+    def reset(self):
+        self.psnr_sum = 0
+        self.ssim_sum = 0
+        self.count = 0
+
+    @torch.no_grad()
+    def update(self, img, imclean):
+        if not img.shape == imclean.shape:
+            raise ValueError('Input images must have the same dimensions.')
+        im1 = quantize_th(imclean, self.border, self.ycbcr, self.dtype)
+        im2 = quantize_th(img, self.border, self.ycbcr, self.dtype)
+        self.psnr_sum = self.psnr_sum + psnr_th(im1, im2).sum()
+        self.ssim_sum = self.ssim_sum + ssim_th(im1, im2).sum()
+        self.count += img.shape[0]
+
+    def compute(self):
+        '''Mean PSNR and SSIM over the images seen since the last reset(), as floats.'''
+        if self.count == 0:
+            raise ValueError('No image was accumulated.')
+        return float(self.psnr_sum) / self.count, float(self.ssim_sum) / self.count
+
 def normalize_np(im, mean=0.5, std=0.5, reverse=False):
     '''
     Input:
@@ -204,7 +322,8 @@ def rgb2ycbcrTorch(im, only_y=True):
                                                   [128.553, -74.203, -93.786],
                                                   [24.966,  112.0,   -18.214]],
                                                   device=im.device, dtype=im.dtype)/255.0) + \
-                                                    torch.tensor([16, 128, 128]).view([-1, 1, 1, 3])
+                                                    torch.tensor([16, 128, 128], device=im.device,
+                                                                 dtype=im.dtype).view([-1, 1, 1, 3])
     rlt /= 255.0
     rlt.clamp_(0.0, 1.0)
     return rlt.permute([0, 3, 1, 2])
@@ -313,73 +432,11 @@ def imresize_np(img, scale, antialiasing=True):
     # Now the scale should be the same for H and W
     # input: img: Numpy, HWC or HW [0,1]
     # output: HWC or HW [0,1] w/o round
-    img = torch.from_numpy(img)
-    need_squeeze = True if img.dim() == 2 else False
-    if need_squeeze:
-        img.unsqueeze_(2)
-
-    in_H, in_W, in_C = img.size()
-    out_C, out_H, out_W = in_C, math.ceil(in_H * scale), math.ceil(in_W * scale)
-    kernel_width = 4
-    kernel = 'cubic'
-
-    # Return the desired dimension order for performing the resize.  The
-    # strategy is to perform the resize first along the dimension with the
-    # smallest scale factor.
-    # Now we do not support this.
-
-    # get weights and indices
-    weights_H, indices_H, sym_len_Hs, sym_len_He = calculate_weights_indices(
-        in_H, out_H, scale, kernel, kernel_width, antialiasing)
-    weights_W, indices_W, sym_len_Ws, sym_len_We = calculate_weights_indices(
-        in_W, out_W, scale, kernel, kernel_width, antialiasing)
-    # process H dimension
-    # symmetric copying
-    img_aug = torch.FloatTensor(in_H + sym_len_Hs + sym_len_He, in_W, in_C)
-    img_aug.narrow(0, sym_len_Hs, in_H).copy_(img)
-
-    sym_patch = img[:sym_len_Hs, :, :]
-    inv_idx = torch.arange(sym_patch.size(0) - 1, -1, -1).long()
-    sym_patch_inv = sym_patch.index_select(0, inv_idx)
-    img_aug.narrow(0, 0, sym_len_Hs).copy_(sym_patch_inv)
-
-    sym_patch = img[-sym_len_He:, :, :]
-    inv_idx = torch.arange(sym_patch.size(0) - 1, -1, -1).long()
-    sym_patch_inv = sym_patch.index_select(0, inv_idx)
-    img_aug.narrow(0, sym_len_Hs + in_H, sym_len_He).copy_(sym_patch_inv)
-
-    out_1 = torch.FloatTensor(out_H, in_W, in_C)
-    kernel_width = weights_H.size(1)
-    for i in range(out_H):
-        idx = int(indices_H[i][0])
-        for j in range(out_C):
-            out_1[i, :, j] = img_aug[idx:idx + kernel_width, :, j].transpose(0, 1).mv(weights_H[i])
-
-    # process W dimension
-    # symmetric copying
-    out_1_aug = torch.FloatTensor(out_H, in_W + sym_len_Ws + sym_len_We, in_C)
-    out_1_aug.narrow(1, sym_len_Ws, in_W).copy_(out_1)
-
-    sym_patch = out_1[:, :sym_len_Ws, :]
-    inv_idx = torch.arange(sym_patch.size(1) - 1, -1, -1).long()
-    sym_patch_inv = sym_patch.index_select(1, inv_idx)
-    out_1_aug.narrow(1, 0, sym_len_Ws).copy_(sym_patch_inv)
-
-    sym_patch = out_1[:, -sym_len_We:, :]
-    inv_idx = torch.arange(sym_patch.size(1) - 1, -1, -1).long()
-    sym_patch_inv = sym_patch.index_select(1, inv_idx)
-    out_1_aug.narrow(1, sym_len_Ws + in_W, sym_len_We).copy_(sym_patch_inv)
-
-    out_2 = torch.FloatTensor(out_H, out_W, in_C)
-    kernel_width = weights_W.size(1)
-    for i in range(out_W):
-        idx = int(indices_W[i][0])
-        for j in range(out_C):
-            out_2[:, i, j] = out_1_aug[:, idx:idx + kernel_width, j].mv(weights_W[i])
-    if need_squeeze:
-        out_2.squeeze_()
-
-    return out_2.numpy()
+    img = torch.from_numpy(img).float()
+    if img.dim() == 2:
+        return imresize_th(img, scale, antialiasing).numpy()
+    out = imresize_th(img.permute(2, 0, 1), scale, antialiasing)
+    return out.permute(1, 2, 0).contiguous().numpy()
 
 def calculate_weights_indices(in_length, out_length, scale, kernel, kernel_width, antialiasing):
     if (scale < 1) and (antialiasing):
@@ -443,6 +500,37 @@ def cubic(x):
     return (1.5*absx3 - 2.5*absx2 + 1) * ((absx <= 1).type_as(absx)) + \
         (-0.5*absx3 + 2.5*absx2 - 4*absx + 2) * (((absx > 1)*(absx <= 2)).type_as(absx))
 
+@functools.lru_cache(maxsize=128)
+def resize_matrix(in_length, out_length, scale, antialiasing=True, device=None, dtype=torch.float32):
+    '''
+    The out_length x in_length matrix of MATLAB's bicubic imresize along one dimension, i.e., the weights of
+    calculate_weights_indices with the symmetric padding of the borders folded in. Cached, as it only depends
+    on the sizes, the scale, the device and the dtype.
+    '''
+    weights, indices, sym_len_s, _ = calculate_weights_indices(
+        in_length, out_length, scale, 'cubic', 4, antialiasing)
+    # position of each tap in the input, mirroring those in the padding
+    src = indices.long() - sym_len_s
+    src = torch.where(src < 0, -src - 1, src)
+    src = torch.where(src >= in_length, 2 * in_length - 1 - src, src)
+    matrix = torch.zeros(out_length, in_length)
+    matrix.scatter_add_(1, src, weights)
+    return matrix.to(device=device, dtype=dtype)
+
+def imresize_th(img, scale, antialiasing=True):
+    '''
+    MATLAB's bicubic imresize as imresize_np, but batched and on the device of img, as two matrix products.
+    input: img: pytorch tensor, BCHW, CHW or HW [0,1]
+    output: BCHW, CHW or HW [0,1] w/o round
+    '''
+    if not img.is_floating_point():
+        img = img.float()
+    in_H, in_W = img.shape[-2:]
+    out_H, out_W = math.ceil(in_H * scale), math.ceil(in_W * scale)
+    weights_H = resize_matrix(in_H, out_H, scale, antialiasing, img.device, img.dtype)
+    weights_W = resize_matrix(in_W, out_W, scale, antialiasing, img.device, img.dtype)
+    return torch.matmul(torch.matmul(weights_H, img), weights_W.t())
+
 # ------------------------Image I/O-----------------------------
 def imread(path, chn='rgb', dtype='float32'):
     '''